@@ -0,0 +1,119 @@
+"""
+Recursive copy benchmark: the SCP protocol against one tar stream.
+
+    python benchmarks/copy_tree.py                        # 2000 files, fake node
+    python benchmarks/copy_tree.py --files 20000 --host 10.0.0.5 --key ~/.ssh/id_rsa
+
+Builds a tree of small files, shaped like a virtualenv or node_modules
+(--files spread --per-dir to a directory), then copies it to one node both
+ways and prints the wall time, files per second and bytes that went over.
+
+By default the node is the in-process fake SSH server. SCP pays for a round
+trip per file and directory, and the fake server's acks tend to sit out
+TCP's delayed ACK, so SCP looks a good deal worse there than against a real
+sshd; use --host for numbers to quote. --host copies to a real node, under
+--dest, which is removed before every run.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import paramiko
+from scp import SCPClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import herd.pool  # noqa: E402
+from herd.fake import FakeSSHServer  # noqa: E402
+from herd.fake import loopback_addresses  # noqa: E402
+from herd.handler import copy  # noqa: E402
+from herd.handler import execute  # noqa: E402
+from herd.handler import NodeHandler  # noqa: E402
+
+
+def make_tree(root, files, per_dir, size):
+    payload = (b'# generated by herd benchmarks\n' * (size // 31 + 1))[:size]
+    for idx in range(files):
+        directory = os.path.join(root, 'pkg{}'.format(idx // per_dir), 'mod{}'.format(idx % 7))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file{}.py'.format(idx)), 'wb') as f:
+            f.write(payload)
+
+
+def scp_copy(handler, src, dest):
+    """What copy(recursive=True) did before trees went over as a tar stream"""
+    SCPClient(handler.client.get_transport()).put(src, dest, recursive=True)
+
+
+def run(name, config, address, dest, action, files, server):
+    handler = NodeHandler.connect(config, address)
+    try:
+        # Start from a dest that doesn't exist, as every copy would
+        list(execute(handler, 'rm -rf {}'.format(dest)))
+        before = server.received.get(address, 0) if server else 0
+        started = time.time()
+        action(handler)
+        elapsed = time.time() - started
+    finally:
+        handler.release()
+
+    sent = '{:.1f}'.format((server.received.get(address, 0) - before) / 1e6) if server else '-'
+    print('{:<8} {:>7} {:>9.2f} {:>9.0f} {:>9}'.format(
+        name, files, elapsed, files / elapsed if elapsed else 0, sent,
+    ))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='herd recursive copy benchmark')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--per-dir', type=int, default=200,
+                        help='files to a package directory')
+    parser.add_argument('--size', type=int, default=2048, help='bytes in every file')
+    parser.add_argument('--host', help='copy to this node instead of a fake one')
+    parser.add_argument('--key', help='private key for --host')
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--port', type=int, default=22)
+    parser.add_argument('--dest', default='/tmp/herd-bench-tree')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='herd-bench-')
+    server = None
+    try:
+        src = os.path.join(workdir, 'tree')
+        make_tree(src, args.files, args.per_dir, args.size)
+
+        if args.host:
+            address, key_path, port = args.host, os.path.expanduser(args.key), args.port
+        else:
+            key_path = os.path.join(workdir, 'id_ecdsa')
+            paramiko.ECDSAKey.generate().write_private_key_file(key_path)
+            address = loopback_addresses(1)[0]
+            server = FakeSSHServer([address]).start()
+            port = server.port
+        config = {'ssh': {'path': key_path, 'user': args.user, 'port': port}}
+
+        print('{:<8} {:>7} {:>9} {:>9} {:>9}'.format(
+            'method', 'files', 'total s', 'files/s', 'sent MB',
+        ))
+        run('scp', config, address, args.dest, lambda handler: scp_copy(
+            handler, src, args.dest,
+        ), args.files, server)
+        run('tar', config, address, args.dest, lambda handler: copy(
+            handler, src, args.dest, recursive=True,
+        ), args.files, server)
+    finally:
+        herd.pool.close_pool()
+        if server:
+            server.stop()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
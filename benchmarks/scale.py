@@ -0,0 +1,192 @@
+"""
+Scale benchmarks against the fake provider and in-process SSH server.
+
+    python benchmarks/scale.py                  # 10, 100 and 1000 nodes
+    python benchmarks/scale.py --nodes 10 100 --latency 0.05
+
+For every scenario and node count it prints the wall time, throughput in
+nodes per second and the p50 / p99 of the time each node took to finish
+(measured from the start of the run). Needs Linux, every fake node listens
+on its own 127.0.0.0/8 address.
+
+Both ends of every SSH session run in this one interpreter, so at 1000
+nodes the fake server's handshakes compete with herd for the GIL and the
+tail latencies are as much about it as about herd. Compare runs with each
+other, not with real deployments.
+"""
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import herd.pool  # noqa: E402
+from herd.cluster import manager_for_cluster  # noqa: E402
+from herd.command import parse_command  # noqa: E402
+from herd.fake import FakeCloud  # noqa: E402
+from herd.fake import FakeSSHServer  # noqa: E402
+from herd.fake import loopback_addresses  # noqa: E402
+from herd.fake import register_cloud  # noqa: E402
+from herd.handler import ClusterExecutionException  # noqa: E402
+from herd.handler import ClusterExecutor  # noqa: E402
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return float('nan')
+    idx = max(0, int(round(pct / 100.0 * len(ordered))) - 1)
+    return ordered[idx]
+
+
+def finish_times(output_file, started):
+    """Seconds from the start until each node reported COMPLETED or FAILED"""
+    times = {}
+    with open(output_file) as f:
+        for line in f:
+            event = json.loads(line)
+            message = event.get('message', '')
+            if event['event'] == 'info' and message.startswith(('COMPLETED', 'FAILED')):
+                times[event['node']] = event['time'] - started
+    return list(times.values())
+
+
+class Bench(object):
+
+    def __init__(self, args, workdir, key_path):
+        self.args = args
+        self.workdir = workdir
+        self.key_path = key_path
+
+    def setup(self, name, nodes, existing, backend='thread'):
+        addresses = loopback_addresses(nodes)
+        server = FakeSSHServer(
+            addresses, latency=self.args.latency, failure_rate=self.args.failure_rate,
+        ).start()
+        cloud = register_cloud(FakeCloud(
+            '{}-{}'.format(name, nodes), addresses, api_latency=self.args.api_latency,
+        ))
+        if existing:
+            cloud.add_nodes('bench', nodes)
+
+        output_file = os.path.join(self.workdir, '{}-{}.jsonl'.format(name, nodes))
+        config = {
+            'herd': {
+                'cache_dir': os.path.join(self.workdir, 'cache'),
+                'output': 'json',
+                'output_file': output_file,
+                'executor': backend,
+                'max_sessions': self.args.sessions,
+                'max_open_connections': max(nodes, self.args.sessions),
+                'provision_concurrency': self.args.sessions,
+                'provision_rate': 10000,
+                'provision_burst': 10000,
+            },
+            'ssh': {'path': self.key_path, 'port': server.port},
+            'providers': {'fake': {'cloud': cloud.name}},
+            'clusters': {'bench': {'provider': 'fake', 'server_count': nodes}},
+        }
+        return config, cloud, server
+
+    def run(self, name, nodes, action, backend='thread', existing=True):
+        config, cloud, server = self.setup(name, nodes, existing, backend)
+        # Every scenario starts from cold connections
+        herd.pool.close_pool()
+        started = time.time()
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                action(config, cloud)
+        except ClusterExecutionException as e:
+            node, error = sorted(e.failures.items())[0]
+            print('  {} nodes failed, e.g. {}: {!r}'.format(len(e.failures), node, error),
+                  file=sys.stderr)
+        finally:
+            elapsed = time.time() - started
+            herd.pool.close_pool()
+            server.stop()
+
+        if existing:
+            latencies = finish_times(config['herd']['output_file'], started)
+        else:
+            latencies = [
+                finished - started
+                for action_name, _, finished in cloud.calls if action_name == 'create'
+            ]
+        report(name, nodes, elapsed, latencies)
+
+
+def report(name, nodes, elapsed, latencies):
+    print('{:<16} {:>6} {:>9.2f} {:>10.1f} {:>9.1f} {:>9.1f}'.format(
+        name, nodes, elapsed, nodes / elapsed if elapsed else 0,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+    ))
+    sys.stdout.flush()
+
+
+def commands():
+    return [
+        parse_command('update', None),
+        parse_command('install', 'nginx git'),
+        parse_command('start', 'nginx'),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='herd scale benchmarks')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--sessions', type=int, default=64,
+                        help='[herd] max_sessions for every run')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds every remote command takes')
+    parser.add_argument('--api-latency', type=float, default=0.05,
+                        help='seconds every provider API call takes')
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--copy-size', type=int, default=64 * 1024,
+                        help='bytes copied to every node')
+    args = parser.parse_args(argv)
+
+    # Client and server ends of every session are both in this process
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    workdir = tempfile.mkdtemp(prefix='herd-bench-')
+    try:
+        key_path = os.path.join(workdir, 'id_ecdsa')
+        paramiko.ECDSAKey.generate().write_private_key_file(key_path)
+        src = os.path.join(workdir, 'payload')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(args.copy_size))
+
+        bench = Bench(args, workdir, key_path)
+        print('{:<16} {:>6} {:>9} {:>10} {:>9} {:>9}'.format(
+            'scenario', 'nodes', 'total s', 'nodes/s', 'p50 ms', 'p99 ms',
+        ))
+        for nodes in args.nodes:
+            bench.run('execute', nodes, lambda config, cloud: ClusterExecutor.execute_parallel(
+                config, commands(), 'bench',
+            ))
+            bench.run('execute-asyncio', nodes, lambda config, cloud: ClusterExecutor.execute_parallel(
+                config, commands(), 'bench',
+            ), backend='asyncio')
+            bench.run('copy', nodes, lambda config, cloud: ClusterExecutor.copy_parallel(
+                config, src, '/tmp/payload', 'bench',
+            ))
+            bench.run('start_cluster', nodes, lambda config, cloud: manager_for_cluster(
+                config, 'bench',
+            ).start('bench'), existing=False)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+A long lived herd process that CLI invocations hand their work to.
+
+Everything herd keeps process wide stays warm in the agent between
+commands: pooled, authenticated SSH transports (no key decryption or
+handshake for a node it has talked to before), the in-memory inventory,
+node facts and compiled configs.
+
+The agent listens on a unix socket only its user can use. A request is
+one JSON line, {"argv": [...], "cwd": "..."}; the reply is a JSON line per
+chunk of output, {"out": "..."} or {"err": "..."}, then {"exit": status}.
+Requests run one at a time, each with the client's working directory and
+its own stdout and stderr.
+"""
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import traceback
+
+import herd.pool
+from herd.inventory import DEFAULT_CACHE_DIR
+
+
+DEFAULT_SOCKET = os.path.join(DEFAULT_CACHE_DIR, 'agent.sock')
+
+
+def socket_path(path=None):
+    return os.path.expanduser(path or DEFAULT_SOCKET)
+
+
+def send(stream, message):
+    stream.write((json.dumps(message) + '\n').encode('utf-8'))
+    stream.flush()
+
+
+class _ReplyWriter(object):
+    """File-like, every write becomes one reply line to the client"""
+
+    def __init__(self, stream, key, lock):
+        self.stream = stream
+        self.key = key
+        self.lock = lock
+
+    def write(self, text):
+        if not text:
+            return 0
+        with self.lock:
+            try:
+                send(self.stream, {self.key: text})
+            except (IOError, OSError):
+                # The client went away, the request still runs to the end
+                pass
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        if not self.server.trusted(self.request):
+            return
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+
+        if request.get('stop'):
+            send(self.wfile, {'exit': 0})
+            threading.Thread(target=self.server.shutdown).start()
+            return
+
+        lock = threading.Lock()
+        out = _ReplyWriter(self.wfile, 'out', lock)
+        err = _ReplyWriter(self.wfile, 'err', lock)
+        status = self.server.run_request(request['argv'], request.get('cwd'), out, err)
+        with lock:
+            try:
+                send(self.wfile, {'exit': status})
+            except (IOError, OSError):
+                pass
+
+
+class AgentServer(socketserver.UnixStreamServer):
+    """
+    :path: unix socket to listen on
+    :dispatch: callable taking a CLI argv, as herd.cli.dispatch
+    """
+
+    def __init__(self, path, dispatch):
+        self.path = socket_path(path)
+        self.dispatch = dispatch
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        if os.path.exists(self.path):
+            if agent_running(self.path):
+                raise OSError('An agent is already listening on {}'.format(self.path))
+            # Left behind by an agent that didn't shut down cleanly
+            os.unlink(self.path)
+
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, self.path, _Handler)
+        finally:
+            os.umask(old_umask)
+
+    def trusted(self, connection):
+        """Only the agent's own user, where the platform can tell"""
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        creds = connection.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'),
+        )
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+    def run_request(self, argv, cwd, out, err):
+        """
+        :return: int exit status
+        """
+        previous_cwd = os.getcwd()
+        try:
+            if cwd:
+                os.chdir(cwd)
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                try:
+                    return self.dispatch(argv) or 0
+                except SystemExit as e:
+                    if e.code is None or isinstance(e.code, int):
+                        return e.code or 0
+                    print(e.code, file=sys.stderr)
+                    return 1
+                except Exception:
+                    traceback.print_exc()
+                    return 1
+        finally:
+            os.chdir(previous_cwd)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def serve(dispatch, path=None):
+    """Run an agent until it is stopped or interrupted"""
+    server = AgentServer(path, dispatch)
+    print('herd agent listening on {}'.format(server.path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        herd.pool.close_pool()
+
+
+def connect(path=None):
+    """
+    :return: a socket connected to the agent, or None if none is running
+    """
+    path = socket_path(path)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    return sock
+
+
+def agent_running(path=None):
+    sock = connect(path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def _request(sock, message, stdout, stderr):
+    with sock, sock.makefile('rwb') as stream:
+        send(stream, message)
+        for line in stream:
+            reply = json.loads(line.decode('utf-8'))
+            if 'exit' in reply:
+                return reply['exit']
+            out = stdout if 'out' in reply else stderr
+            out.write(reply.get('out', reply.get('err')))
+            out.flush()
+    # The agent died mid request
+    return 1
+
+
+def forward(argv, path=None, stdout=None, stderr=None):
+    """
+    Run a CLI command in the agent, echoing its output
+
+    :return: its exit status, or None if no agent is running
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+    return _request(
+        sock, {'argv': list(argv), 'cwd': os.getcwd()},
+        stdout or sys.stdout, stderr or sys.stderr,
+    )
+
+
+def stop(path=None):
+    """
+    :return: True if an agent was running
+    """
+    sock = connect(path)
+    if sock is None:
+        return False
+    _request(sock, {'stop': True}, sys.stdout, sys.stderr)
+    return True
@@ -0,0 +1,256 @@
+"""asyncio execution backend
+
+paramiko is blocking, so the short blocking steps (handshake, opening a
+channel) run on a small thread pool while the long part of every command,
+waiting on and reading its output, is multiplexed on a single event loop
+through each channel's pollable file descriptor. That keeps hundreds of
+sessions in flight without a thread per node.
+"""
+from __future__ import print_function
+
+import asyncio
+from concurrent import futures
+
+import herd.config
+import herd.timing
+from herd.cluster import manager_for_cluster
+from herd.output import flush_buffers
+from herd.output import line_buffers
+from herd.output import read_available
+from herd.output import MultiSink
+from herd.output import sink_for_config
+from herd.readiness import ReadinessTracker
+from herd.scheduler import get_scheduler
+from herd.timing import span
+from herd.script import Script
+
+
+DEFAULT_BLOCKING_WORKERS = 32
+
+
+def open_channel(client, command):
+    channel = client.get_transport().open_session()
+    channel.exec_command(command)
+    channel.shutdown_write()
+    return channel
+
+
+async def run_remote(loop, pool, client, command, on_line):
+    """
+    Execute a command, reading its output without blocking the loop
+
+    :param on_line: callable taking an OutputLine
+    :return: int, the command's exit status
+    """
+    channel = await loop.run_in_executor(pool, open_channel, client, command)
+    buffers = line_buffers()
+    done = loop.create_future()
+
+    def on_readable():
+        if done.done():
+            return
+        for line in read_available(channel, buffers):
+            on_line(line)
+        # The status event is also set when the channel closes without one
+        if channel.exit_status_ready() and not (
+            channel.recv_ready() or channel.recv_stderr_ready()
+        ):
+            done.set_result(channel.exit_status)
+
+    # paramiko signals this pipe on new data and again when the channel closes
+    fd = channel.fileno()
+    loop.add_reader(fd, on_readable)
+    try:
+        on_readable()
+        status = await done
+    finally:
+        loop.remove_reader(fd)
+        channel.close()
+
+    for line in flush_buffers(buffers):
+        on_line(line)
+
+    return status
+
+
+async def session_slot(loop, scheduler, cluster, host):
+    """
+    Wait on the loop for a SessionScheduler slot, without holding a thread
+
+    :return: the granted SessionRequest, release it on the scheduler
+    """
+    granted = loop.create_future()
+
+    def on_granted(request):
+        loop.call_soon_threadsafe(
+            lambda: granted.done() or granted.set_result(request)
+        )
+
+    request = scheduler.request(cluster, host, on_granted)
+    try:
+        await granted
+    except BaseException:
+        scheduler.release(request)
+        raise
+    return request
+
+
+async def run_plan_async(plan, run_task, max_parallel=1):
+    """
+    asyncio counterpart of herd.graph.run_plan: tasks start as soon as their
+    dependencies are done, dependents of a failed task never start, and the
+    first error is raised once everything else has settled.
+
+    :param run_task: coroutine function taking a task name
+    """
+    semaphore = asyncio.Semaphore(max(max_parallel, 1))
+    scheduled = {}
+
+    async def run(task):
+        await asyncio.gather(*[scheduled[dep] for dep in plan.dependencies[task]])
+        async with semaphore:
+            await run_task(task)
+
+    # plan.tasks is topologically ordered, dependencies are scheduled first
+    for task in plan.tasks:
+        scheduled[task] = asyncio.ensure_future(run(task))
+
+    results = await asyncio.gather(*scheduled.values(), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+
+
+class AsyncClusterExecutor(object):
+
+    @staticmethod
+    async def execute(loop, pool, plan, config, manager, node, sink):
+        # Imported here, herd.handler picks this backend at call time
+        from herd.handler import CommandFailedException
+        from herd.handler import CommandStatus
+        from herd.handler import NodeHandler
+        from herd.handler import report
+        from herd.handler import skip_satisfied_commands
+
+        with span(herd.timing.CONNECT, 'connect', node):
+            handler = await loop.run_in_executor(
+                pool, NodeHandler.connect, config, manager.ip_for_node(node),
+            )
+
+        async def run_script(script):
+            statuses = []
+
+            def on_line(line):
+                for out in script.parse_line(line):
+                    if out is not None:
+                        report(sink, node, out)
+                        if isinstance(out, CommandStatus):
+                            statuses.append(out)
+
+            status = await run_remote(loop, pool, handler.client, script.command, on_line)
+            script.check(statuses, status)
+
+        async def run_task(task):
+            for command in plan.commands[task]:
+                sink.info(node, "Executing {} on {}".format(command, node))
+                with span(command.phase, command, node):
+                    if isinstance(command, Script):
+                        await run_script(command)
+                    else:
+                        await loop.run_in_executor(
+                            pool,
+                            lambda: [report(sink, node, out) for out in command.run(handler)],
+                        )
+                sink.step_done(node, command)
+
+        try:
+            plan = await loop.run_in_executor(
+                pool, skip_satisfied_commands, config, plan, handler, node, sink,
+            )
+            await run_plan_async(plan, run_task, herd.config.parallel_tasks(config))
+        except CommandFailedException:
+            handler.release()
+            raise
+        except Exception:
+            handler.discard()
+            raise
+        else:
+            handler.release()
+
+    @staticmethod
+    async def execute_all(loop, config, plan, manager, cluster, ready, sink, journal=None):
+        """
+        :param ready: iterator of (node name, exception or None), the way
+            ReadinessTracker.ready_nodes yields them. It may block, so it is
+            drained off the event loop and every node starts as it arrives
+        :param journal: herd.journal.RunJournal, see ClusterExecutor.execute_parallel
+        :return: dict of node name -> exception, for every node that failed
+        """
+        from herd.handler import finish_node
+
+        scheduler = get_scheduler(config)
+        pool = futures.ThreadPoolExecutor(
+            max_workers=min(herd.config.max_sessions(config), DEFAULT_BLOCKING_WORKERS),
+        )
+        failures = {}
+
+        async def execute_node(node):
+            node_plan = plan if journal is None else journal.node_plan(node)
+            if journal is not None and not any(node_plan.commands.values()):
+                # Done in the run being resumed
+                finish_node(sink, node, None, failures)
+                return
+            request = await session_slot(loop, scheduler, cluster, node)
+            error = None
+            try:
+                await AsyncClusterExecutor.execute(
+                    loop, pool, node_plan, config, manager, node, sink,
+                )
+            except Exception as e:
+                error = e
+            finally:
+                scheduler.release(request)
+            finish_node(sink, node, error, failures)
+
+        tasks = []
+        try:
+            while True:
+                node, error = await loop.run_in_executor(None, next, ready, (None, None))
+                if node is None:
+                    break
+                if error is not None:
+                    finish_node(sink, node, error, failures)
+                else:
+                    tasks.append(loop.create_task(execute_node(node)))
+            await asyncio.gather(*tasks)
+        finally:
+            pool.shutdown(wait=False)
+
+        return failures
+
+    @staticmethod
+    def execute_parallel(config, plan, cluster, journal=None):
+        from herd.handler import ClusterExecutionException
+
+        manager = manager_for_cluster(config, cluster)
+        nodes = manager.node_names(cluster)
+
+        if not nodes:
+            return
+
+        sink = sink_for_config(config)
+        if journal is not None:
+            sink = MultiSink([sink, journal.sink()])
+        loop = asyncio.new_event_loop()
+        try:
+            failures = loop.run_until_complete(AsyncClusterExecutor.execute_all(
+                loop, config, plan, manager, cluster,
+                ReadinessTracker.for_config(config, manager).ready_nodes(nodes),
+                sink, journal,
+            ))
+        finally:
+            loop.close()
+            sink.close()
+
+        if failures:
+            raise ClusterExecutionException(cluster, failures)
@@ -0,0 +1,228 @@
+"""
+Provider API client for DigitalOcean, on one pooled HTTP session.
+
+Every call of a process goes through the same keep-alive connections
+(python-digitalocean's objects each make their own, and POSTs none at
+all). Listings fetch their first page, then all the others at once;
+droplets can be filtered by tag on the server; catalog listings (sizes,
+regions, images) are conditional on their ETag, so an unchanged catalog
+costs a 304 with no body. The ETags are kept with the listings in the
+inventory cache, so the next process sends them too.
+
+Droplets and sizes come back as plain records holding no credentials,
+so they can be cached on disk as they are.
+"""
+import math
+import threading
+import time
+from collections import namedtuple
+from concurrent import futures
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+API_URL = 'https://api.digitalocean.com/v2/'
+PER_PAGE = 200
+PAGE_WORKERS = 8
+TIMEOUT = 30
+# Long enough for a resize, which needs the droplet shut down first
+ACTION_TIMEOUT = 10 * 60
+
+
+class APIException(Exception):
+
+    def __init__(self, status_code, message):
+        super(APIException, self).__init__('{} {}'.format(status_code, message))
+        self.status_code = status_code
+        self.message = message
+
+    @property
+    def throttled(self):
+        return self.status_code == 429
+
+
+class Droplet(namedtuple('Droplet', [
+    'id', 'name', 'status', 'size_slug', 'ip_address', 'private_ip_address', 'tags',
+])):
+
+    @classmethod
+    def from_json(cls, data):
+        addresses = {}
+        for network in data.get('networks', {}).get('v4', []):
+            addresses[network['type']] = network['ip_address']
+        return cls(
+            data['id'], data['name'], data['status'], data.get('size_slug'),
+            addresses.get('public'), addresses.get('private'), tuple(data.get('tags', ())),
+        )
+
+
+class Size(namedtuple('Size', ['slug', 'vcpus', 'memory', 'disk', 'price_monthly'])):
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['slug'], data['vcpus'], data['memory'], data['disk'], data['price_monthly'])
+
+
+class DigitalOceanClient(object):
+    """
+    :token: API token
+    :max_connections: keep-alive connections kept to the API, should be at
+        least the number of API calls made at once
+    """
+
+    def __init__(self, token, max_connections=PAGE_WORKERS, url=API_URL, timeout=TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': 'Bearer {}'.format(token),
+            'Content-Type': 'application/json',
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def send(self, method, path, params=None, body=None, headers=None):
+        """
+        :return: requests.Response
+        :raises APIException: for an error status
+        """
+        response = self.session.request(
+            method, self.url + path, params=params, json=body,
+            headers=headers, timeout=self.timeout,
+        )
+        if not response.ok:
+            try:
+                message = response.json().get('message', response.reason)
+            except ValueError:
+                message = response.reason
+            raise APIException(response.status_code, message)
+        return response
+
+    def request(self, method, path, params=None, body=None):
+        """
+        :return: decoded JSON body, None if there is none
+        """
+        response = self.send(method, path, params, body)
+        if response.status_code == 204 or not response.content:
+            return None
+        return response.json()
+
+    def list(self, path, key, params=None):
+        """
+        Every item of a paginated listing. The first page says how many
+        there are, the rest are fetched at once.
+
+        :param key: the listing's key in each page, e.g. 'droplets'
+        """
+        params = dict(params or {}, per_page=PER_PAGE)
+        first = self.request('GET', path, dict(params, page=1))
+        return self._rest(path, key, params, first)
+
+    def _rest(self, path, key, params, first):
+        """Every item of a listing, given its first page"""
+        items = list(first[key])
+        total = first.get('meta', {}).get('total', len(items))
+        pages = int(math.ceil(total / float(PER_PAGE)))
+        if pages <= 1:
+            return items
+
+        with futures.ThreadPoolExecutor(max_workers=min(PAGE_WORKERS, pages - 1)) as executor:
+            rest = executor.map(
+                lambda page: self.request('GET', path, dict(params, page=page)),
+                range(2, pages + 1),
+            )
+            for page in rest:
+                items.extend(page[key])
+        return items
+
+    def catalog(self, path, key, etag=None):
+        """
+        A catalog listing, conditional on the ETag of an earlier one
+
+        :param etag: ETag the earlier listing came with, None for none
+        :return: (items, etag). items is None if nothing changed since the
+            etag passed in. etag is None for catalogs of more than one page,
+            every page has one of its own
+        """
+        params = {'per_page': PER_PAGE}
+        response = self.send(
+            'GET', path, dict(params, page=1), headers={'If-None-Match': etag} if etag else None,
+        )
+        if response.status_code == 304:
+            return None, etag
+
+        first = response.json()
+        items = self._rest(path, key, params, first)
+        return items, response.headers.get('ETag') if len(items) <= PER_PAGE else None
+
+    def list_droplets(self, tag=None):
+        params = {'tag_name': tag} if tag else None
+        return [Droplet.from_json(data) for data in self.list('droplets', 'droplets', params)]
+
+    def list_sizes(self, etag=None):
+        """See catalog"""
+        sizes, etag = self.catalog('sizes', 'sizes', etag)
+        if sizes is not None:
+            sizes = [Size.from_json(data) for data in sizes]
+        return sizes, etag
+
+    def list_regions(self, etag=None):
+        return self.catalog('regions', 'regions', etag)
+
+    def list_images(self, etag=None):
+        return self.catalog('images', 'images', etag)
+
+    def create_droplet(self, **kwargs):
+        return Droplet.from_json(self.request('POST', 'droplets', body=kwargs)['droplet'])
+
+    def destroy(self, droplet_id):
+        self.request('DELETE', 'droplets/{}'.format(droplet_id))
+
+    def action(self, droplet_id, action_type, **params):
+        """
+        :return: the action's JSON, see wait_for_action
+        """
+        return self.request(
+            'POST', 'droplets/{}/actions'.format(droplet_id),
+            body=dict(params, type=action_type),
+        )['action']
+
+    def rename(self, droplet_id, name):
+        return self.action(droplet_id, 'rename', name=name)
+
+    def shutdown(self, droplet_id):
+        return self.action(droplet_id, 'shutdown')
+
+    def power_on(self, droplet_id):
+        return self.action(droplet_id, 'power_on')
+
+    def resize(self, droplet_id, size_slug):
+        # disk=True grows the disk too, which can't be undone
+        return self.action(droplet_id, 'resize', size=size_slug, disk=True)
+
+    def wait_for_action(self, action, timeout=ACTION_TIMEOUT, interval=3, sleep=None):
+        """
+        :return: True once the action completed, False if it errored or
+            didn't finish in time
+        """
+        sleep = sleep or time.sleep
+        waited = 0
+        while action['status'] == 'in-progress' and waited < timeout:
+            sleep(interval)
+            waited += interval
+            action = self.request('GET', 'actions/{}'.format(action['id']))['action']
+        return action['status'] == 'completed'
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client_for(token, max_connections=PAGE_WORKERS):
+    """Process wide client for one account, so every call shares its connections"""
+    with _clients_lock:
+        if token not in _clients:
+            _clients[token] = DigitalOceanClient(token, max_connections=max_connections)
+        return _clients[token]
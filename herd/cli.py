@@ -0,0 +1,380 @@
+"""
+The herd command line. Each subcommand imports what it needs itself:
+provider SDKs and paramiko take far longer to import than most of
+`herd info` takes to run.
+
+When a `herd agent` is running, commands are handed to it instead (see
+herd.agent), unless asked not to or profiling.
+"""
+import argparse
+
+
+def parse_args(parser, args):
+    """
+    Adds the options every subcommand shares, parses, then loads the
+    compiled config and checks the cluster or role asked for is in it
+
+    :return: (args, herd.plan.HerdPlan)
+    """
+    parser.add_argument('--config', action='store', help='Specify path to config file', default="config.toml")
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='Ignore cached provider inventory and fetch it again',
+    )
+    parser.add_argument(
+        '--profile', action='store', metavar='TRACE_FILE',
+        help='Time every phase on every node, write a Chrome trace to TRACE_FILE '
+             'and print the slowest nodes and phases',
+    )
+    parser.add_argument(
+        '--no-agent', action='store_true',
+        help='Run in this process even if a herd agent is running',
+    )
+    args = parser.parse_args(args)
+
+    from herd.config import ConfigException
+    from herd.plan import load_plan
+    try:
+        plan = load_plan(args.config)
+        clusters = getattr(args, 'cluster', None)
+        for cluster in clusters if isinstance(clusters, list) else [clusters]:
+            if cluster is not None:
+                plan.cluster(cluster)
+        if getattr(args, 'role', None) is not None:
+            plan.role(args.role)
+    except (IOError, ConfigException) as e:
+        parser.error(str(e))
+
+    if args.refresh:
+        from herd import inventory
+        inventory.refresh_all()
+    if args.profile:
+        import atexit
+        from herd import timing
+        timing.enable()
+        atexit.register(write_profile, args.profile)
+    return args, plan
+
+
+def write_profile(path):
+    from herd import timing
+    profiler = timing.disable()
+    profiler.write_trace(path)
+    print(profiler.summary())
+    print('Trace written to {}'.format(path))
+
+
+def manage_clusters(config, action, clusters, dry_run=False):
+    """
+    Run a herd.cluster.manage_clusters action and print how it went for
+    each cluster
+
+    :return: exit status
+    """
+    from herd.cluster import format_results
+    from herd.cluster import manage_clusters
+    from herd.cluster import MultiClusterSyncException
+
+    try:
+        results = manage_clusters(config, action, clusters, dry_run=dry_run)
+    except MultiClusterSyncException as e:
+        print(format_results(e.results, e.failures))
+        return 1
+    print(format_results(results))
+    return 0
+
+
+def run_on_cluster(run):
+    """
+    Run commands through herd.handler.ClusterExecutor and print what failed
+    on each node
+
+    :param run: callable making the ClusterExecutor calls
+    :return: exit status
+    """
+    from herd.handler import ClusterExecutionException
+    from herd.handler import format_failures
+
+    try:
+        run()
+    except ClusterExecutionException as e:
+        print(format_failures(e.cluster, e.failures))
+        return 1
+    return 0
+
+
+def configured_clusters(config, names):
+    """
+    :return: list of (cluster, provider) pairs for the named clusters,
+        every configured cluster if none are named
+    """
+    names = names or sorted(config.get('clusters', {}))
+    return [(name, config['clusters'][name]['provider']) for name in names]
+
+
+def destroy_cluster(args):
+    parser = argparse.ArgumentParser(description='Cluster config runner')
+    # Not checked against the config, the cluster may already be gone from it
+    parser.add_argument(
+        'names', metavar='cluster', action='store', nargs='+',
+        help='Cluster names to destroy all nodes for',
+    )
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    clusters = []
+    for name in args.names:
+        if name in config.get('clusters', {}):
+            clusters.append((name, config['clusters'][name]['provider']))
+        else:
+            clusters.extend((name, provider) for provider in sorted(config['providers']))
+    return manage_clusters(config, 'destroy', clusters)
+
+
+def start_cluster(args):
+    parser = argparse.ArgumentParser(description='Cluster config runner')
+    parser.add_argument(
+        'cluster', action='store', nargs='*',
+        help='Names of clusters to start, all of them if none are given',
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Only print what would be created, destroyed, renamed and resized',
+    )
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    return manage_clusters(
+        config, 'start', configured_clusters(config, args.cluster), dry_run=args.dry_run,
+    )
+
+
+def stop_cluster(args):
+    parser = argparse.ArgumentParser(description='Cluster config runner')
+    parser.add_argument(
+        'cluster', action='store', nargs='*',
+        help='Names of clusters to stop, all of them if none are given',
+    )
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    return manage_clusters(config, 'stop', configured_clusters(config, args.cluster))
+
+
+def cluster_info(args):
+    parser = argparse.ArgumentParser(description='Cluster config runner')
+    parser.add_argument('cluster', action='store', help='Name of cluster to get info for')
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    from herd.cluster import manager_for_cluster
+
+    manager = manager_for_cluster(config, args.cluster)
+    print(manager.cluster_info(args.cluster))
+
+
+def cluster_install(args):
+    parser = argparse.ArgumentParser(description='Install program on all nodes in a luster')
+    parser.add_argument('cluster', action='store', help='Name of cluster to install program on')
+    parser.add_argument('program', action='store', help='Name of program to install')
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    from herd.command import parse_command
+    from herd.handler import ClusterExecutor
+
+    return run_on_cluster(lambda: ClusterExecutor.execute_parallel(
+        config, [parse_command('install', args.program)], args.cluster,
+    ))
+
+
+def cluster_uninstall(args):
+    parser = argparse.ArgumentParser(description='Install program on all nodes in a luster')
+    parser.add_argument('cluster', action='store', help='Name of cluster to uninstall program on')
+    parser.add_argument('program', action='store', help='Name of program to uninstall')
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    from herd.command import parse_command
+    from herd.handler import ClusterExecutor
+
+    return run_on_cluster(lambda: ClusterExecutor.execute_parallel(
+        config, [parse_command('uninstall', args.program)], args.cluster,
+    ))
+
+
+def postsync(args):
+    """Run commands that should happen after a machine is synced"""
+    parser = argparse.ArgumentParser(description='Install program on all nodes in a luster')
+    parser.add_argument('cluster', action='store', help='Name of cluster to install program on')
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    from herd.command import parse_command
+    from herd.handler import ClusterExecutor
+
+    def update_and_upgrade():
+        ClusterExecutor.execute_parallel(
+            config, [parse_command('update', None)], args.cluster,
+        )
+        ClusterExecutor.execute_parallel(
+            config, [parse_command('upgrade', None)], args.cluster,
+        )
+
+    return run_on_cluster(update_and_upgrade)
+
+
+def run(args):
+    parser = argparse.ArgumentParser(description='Install program on all nodes in a luster')
+    parser.add_argument('cluster', action='store', help='Name of cluster to start program on')
+    parser.add_argument('program', action='store', help='Name of program to start')
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    from herd.command import parse_command
+    from herd.handler import ClusterExecutor
+
+    return run_on_cluster(lambda: ClusterExecutor.execute_parallel(
+        config, [parse_command('start', args.program)], args.cluster,
+    ))
+
+
+def stop(args):
+    parser = argparse.ArgumentParser(description='Install program on all nodes in a luster')
+    parser.add_argument('cluster', action='store', help='Name of cluster to stop program on')
+    parser.add_argument('program', action='store', help='Name of program to stop')
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    from herd.command import parse_command
+    from herd.handler import ClusterExecutor
+
+    return run_on_cluster(lambda: ClusterExecutor.execute_parallel(
+        config, [parse_command('stop', args.program)], args.cluster,
+    ))
+
+
+def execute(args):
+    parser = argparse.ArgumentParser(description='Install program on all nodes in a luster')
+    parser.add_argument('cluster', action='store', help='Name of cluster to stop program on')
+    parser.add_argument('command', action='store', help='Name of program to stop', nargs='+')
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    from herd.command import parse_command
+    from herd.handler import ClusterExecutor
+
+    return run_on_cluster(lambda: ClusterExecutor.execute_parallel(
+        config, [parse_command('exec', args.command)], args.cluster,
+    ))
+
+
+def copy(args):
+    parser = argparse.ArgumentParser(description='Install program on all nodes in a luster')
+    parser.add_argument('cluster', action='store', help='Name of cluster to stop program on')
+    parser.add_argument('src', action='store', help='Local path of file to copy')
+    parser.add_argument('dest', action='store', help='Remote destination for file')
+    parser.add_argument('-r', action='store_true', help='Copy recursively?')
+    parser.add_argument('--sync', action='store_true', help='Only send files that differ on each node')
+    parser.add_argument('--compress', action='store_true', help='Compress synced files in flight')
+    parser.add_argument(
+        '--fanout', action='store_true',
+        help='Upload once, then have nodes relay to each other over the private network',
+    )
+    args, plan = parse_args(parser, args)
+    config = plan.config
+
+    from herd.handler import ClusterExecutor
+
+    return run_on_cluster(lambda: ClusterExecutor.copy_parallel(
+        config, args.src, args.dest, args.cluster,
+        recursive=args.r, sync=args.sync, compress=args.compress, fanout=args.fanout,
+    ))
+
+
+def deploy(args):
+    parser = argparse.ArgumentParser(description='Deploy a given role')
+    parser.add_argument(
+        'role', action='store', nargs='?',
+        help='Name of role, when resuming the role of the run resumed',
+    )
+    parser.add_argument(
+        '--resume', action='store', metavar='RUN_ID',
+        help='Resume a run, only running what did not finish or failed on each node',
+    )
+    args, plan = parse_args(parser, args)
+
+    from herd.herd import Herd
+    from herd.journal import JournalException
+    from herd.journal import run_role
+
+    role = args.role
+    try:
+        if args.resume is not None and role is None:
+            role = run_role(plan.config, args.resume)
+        if role is None:
+            parser.error('a role is needed, unless resuming a run')
+        Herd(plan=plan).deploy(role, resume=args.resume)
+    except JournalException as e:
+        parser.error(str(e))
+
+
+def run_agent(args):
+    parser = argparse.ArgumentParser(
+        description='Keep SSH sessions and inventory warm for the herd commands that follow',
+    )
+    parser.add_argument('--stop', action='store_true', help='Stop the running agent')
+    args = parser.parse_args(args)
+
+    from herd import agent
+
+    if args.stop:
+        if not agent.stop():
+            print('No herd agent is running')
+            return 1
+        return 0
+    agent.serve(dispatch)
+
+
+action_to_handler = {
+    'up': start_cluster,
+    'down': stop_cluster,
+    'destroy': destroy_cluster,
+    'info': cluster_info,
+    'install': cluster_install,
+    'uninstall': cluster_uninstall,
+    'run': run,
+    'stop': stop,
+    'postsync': postsync,
+    'exec': execute,
+    'copy': copy,
+    'deploy': deploy,
+    'agent': run_agent,
+}
+
+# Options whose effect has to stay in the invoking process
+LOCAL_OPTIONS = ('--profile', '--no-agent')
+
+
+def dispatch(argv):
+    """
+    :return: exit status
+    """
+    cmd = argv[0] if argv else None
+    if cmd not in action_to_handler:
+        print("action must be one of {}".format(', '.join(sorted(action_to_handler))))
+        return 1
+
+    return action_to_handler[cmd](argv[1:]) or 0
+
+
+def main(argv):
+    if argv and argv[0] in action_to_handler and argv[0] != 'agent' and not any(
+        arg.partition('=')[0] in LOCAL_OPTIONS for arg in argv
+    ):
+        from herd import agent
+        status = agent.forward(argv)
+        if status is not None:
+            return status
+
+    return dispatch(argv)
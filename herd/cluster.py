@@ -1,9 +1,20 @@
-import re
-import time
+from concurrent import futures
+from functools import partial
 from operator import attrgetter
 
-from cached_property import cached_property
-import digitalocean
+import herd.config
+import herd.timing
+from herd.inventory import cache_for
+from herd.inventory import InventoryIndex
+from herd.inventory import parse_node_name
+from herd.provision import ProvisionCall
+from herd.provision import ProvisionPool
+from herd.readiness import ReadinessTracker
+from herd.sync import apply_actions
+from herd.sync import ClusterSyncException
+from herd.sync import diff_cluster
+from herd.sync import format_plan
+from herd.timing import span
 
 
 # Represents the configuration options to create a server
@@ -12,38 +23,312 @@ class ServerConfig(object):
 
 
 class ClusterManager(object):
+    """
+    Everything herd needs from a cloud provider. A provider implements the
+    methods below that raise NotImplementedError (ABSTRACT_METHODS); node
+    lookups, sync, start, stop and destroy are shared, built on them.
 
-    def best_node_match(self):
+    Providers outside herd register their subclass under the
+    herd.providers entry point group, named as in [providers], e.g.
+
+        entry_points={'herd.providers': ['linode = herd_linode:LinodeClusterManager']}
+
+    :config: the whole herd config
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._index = None
+        self._provision_pool = ProvisionPool(
+            self.is_throttled,
+            concurrency=herd.config.provision_concurrency(config),
+            rate=herd.config.provision_rate(config),
+            burst=herd.config.provision_burst(config),
+        )
+
+    @property
+    def provider(self):
+        """Name of the provider, its table under [providers]"""
         raise NotImplementedError("")
 
-    def launch_nodes(self):
-        pass
+    @property
+    def nodes_list(self):
+        """
+        :return: list of every node of the provider herd can see, each with
+            name, status ('new', 'active', 'off' or 'archive'), size_slug,
+            ip_address and private_ip_address
+        """
+        raise NotImplementedError("")
 
-    def create(self):
+    def refresh_nodes_list(self):
+        """Drop any cached node list, then list again"""
         raise NotImplementedError("")
 
-    def list_nodes(self):
+    def best_node_size_match(self, min_cores, min_ram, min_disk, max_monthly_cost):
+        """
+        :return: the cheapest size with at least this much, None if there
+            is none. It needs a slug, it's what node_config is passed
+        """
         raise NotImplementedError("")
 
-    def shutdown_node(self):
+    def node_fits(self, node, node_size_config):
         raise NotImplementedError("")
 
-    def shutdown_all_nodes(self):
+    def resizable(self, node, size):
+        """Whether node can be resized to size in place"""
+        return False
+
+    def node_config(self, name, size_slug, cluster_config):
+        raise NotImplementedError("")
+
+    def launch_node(self, node_configuration):
+        raise NotImplementedError("")
+
+    def destroy_node(self, node):
+        raise NotImplementedError("")
+
+    def rename_node(self, node, new_name):
         raise NotImplementedError("")
 
-    def list_regions(self):
+    def resize_node(self, node, size):
         raise NotImplementedError("")
 
-    def sync(self):
-        """Sync the config state with cluster state"""
+    def shutdown_node(self, node):
         raise NotImplementedError("")
 
+    def is_throttled(self, error):
+        """Whether an API error means we went over the rate limit"""
+        return False
+
+    @property
+    def provision_pool(self):
+        """
+        One per manager, so the clusters of a provider managed at once
+        share its rate limit
+        """
+        return self._provision_pool
+
+    @property
+    def index(self):
+        """InventoryIndex over the current node list, rebuilt when it changes"""
+        nodes = self.nodes_list
+        if self._index is None or self._index.nodes is not nodes:
+            self._index = InventoryIndex(nodes)
+        return self._index
+
+    def node_in_cluster(self, cluster):
+        return list(self.index.cluster_nodes(cluster))
+
+    def node_index(self, cluster_name, node_name):
+        cluster, index = parse_node_name(node_name)
+        if cluster != cluster_name:
+            raise ValueError('{} is not a node of cluster {}'.format(node_name, cluster_name))
+        return index
+
+    def cluster_info(self, cluster_name):
+        nodes_in_cluster = self.node_in_cluster(cluster_name)
+
+        if not nodes_in_cluster:
+            print("No nodes found in cluster {}".format(cluster_name))
+            return
+
+        return [
+            {
+                'name': node.name,
+                'public_ips': node.ip_address,
+                'private_ips': node.private_ip_address,
+                'status': node.status
+            }
+            for node in nodes_in_cluster
+        ]
+
+    def cluster_status(self, cluster_name, refresh=False):
+        if refresh:
+            self.refresh_nodes_list()
+        index = self.index
+
+        return {
+            status: list(index.cluster_nodes_with_status(cluster_name, status))
+            for status in ('active', 'new', 'off', 'archive')
+        }
+
+    def node_names(self, cluster_name):
+        return [node.name for node in self.node_in_cluster(cluster_name)]
+
+    def name_for_node(self, cluster_name, idx):
+        return '{}{}'.format(cluster_name, idx)
+
+    def ip_for_node(self, node_name):
+        node = self.index.node(node_name)
+        return node.ip_address if node is not None else None
+
+    def private_ip_for_node(self, node_name):
+        node = self.index.node(node_name)
+        return node.private_ip_address if node is not None else None
+
+    def parse_node_size_config(self, cfg):
+        return {
+            'min_cores': cfg.get('min_cores', 1),
+            'min_ram': cfg.get('min_ram', 256),
+            'min_disk': cfg.get('min_disk', 10),
+            'max_monthly_cost': cfg.get('max_monthly_cost', 20),
+        }
+
+    def plan_sync(self, cluster_name, cluster_config):
+        """
+        :return: (list of SyncActions turning the cluster into what its
+            config asks for, the size of new nodes)
+        """
+        node_size_config = self.parse_node_size_config(cluster_config)
+        node_size = self.best_node_size_match(**node_size_config)
+        if not node_size:
+            raise ClusterSyncException(
+                (
+                    'No valid node was found matching cores: {min_cores}, '
+                    'ram: {min_ram}mb, disk: {min_disk}gb, cost: ${max_monthly_cost}'
+                ).format(**node_size_config)
+            )
+
+        actions = diff_cluster(
+            cluster_name, self.node_in_cluster(cluster_name),
+            cluster_config['server_count'], node_size,
+            fits=partial(self.node_fits, node_size_config=node_size_config),
+            resizable=self.resizable,
+        )
+        return actions, node_size
+
+    def call_for_action(self, cluster_config, nodes, node_size, action):
+        """
+        :param nodes: dict of node name -> node, as listed when planning
+        :return: callable running a SyncAction
+        """
+        if action.action == 'destroy':
+            return partial(self.destroy_node, nodes[action.node])
+        if action.action == 'rename':
+            return partial(self.rename_node, nodes[action.node], action.target)
+        if action.action == 'resize':
+            return partial(self.resize_node, nodes[action.node], node_size)
+        return partial(self.launch_node, self.node_config(
+            action.node, action.target, cluster_config,
+        ))
+
+    def sync(self, cluster_name, cluster_config, dry_run=False):
+        """
+        Sync the config state with cluster state. Prints the plan, then
+        unless dry_run runs it; a failing action doesn't stop the ones that
+        don't depend on it and every action's result is reported.
+
+        :return: list of ProvisionResults, empty if nothing was run
+        """
+        print('Syncing cluster: {}'.format(cluster_name))
+        actions, node_size = self.plan_sync(cluster_name, cluster_config)
+        print(format_plan(cluster_name, actions))
+        if dry_run or not actions:
+            return []
+
+        if any(node.status == 'new' for node in self.node_in_cluster(cluster_name)):
+            print('Nodes of cluster {} are still spawning, leaving them be'.format(cluster_name))
+
+        nodes = {node.name: node for node in self.node_in_cluster(cluster_name)}
+        results = apply_actions(
+            actions, partial(self.call_for_action, cluster_config, nodes, node_size),
+            self.provision_pool,
+        )
+
+        failed = [result for result in results if not result.ok]
+        if failed:
+            raise ClusterSyncException(
+                'Cluster {} is only partially synced: {}'.format(
+                    cluster_name, '; '.join(str(result) for result in failed),
+                )
+            )
+
+        print('Cluster %s is operational!' % cluster_name)
+        return results
+
+    def each_node(self, what, cluster_name, act):
+        """
+        act on every node of a cluster at once, through the provision pool
+
+        :param what: what is being done, e.g. 'shutdown'
+        :param act: callable taking a node
+        :return: list of ProvisionResults
+        :raises ClusterSyncException: if it failed on any node
+        """
+        nodes = self.node_in_cluster(cluster_name)
+        if not nodes:
+            print("No nodes found in cluster {}, taking no action.".format(cluster_name))
+            return []
+
+        results = self.provision_pool.run([
+            ProvisionCall(what, node.name, partial(act, node)) for node in nodes
+        ])
+        failed = [result for result in results if not result.ok]
+        if failed:
+            raise ClusterSyncException('{} of cluster {} failed: {}'.format(
+                what.capitalize(), cluster_name, '; '.join(str(result) for result in failed),
+            ))
+        return results
+
+    def cluster_config(self, cluster_name):
+        """
+        :raises ClusterSyncException: if the cluster isn't in the config or
+            isn't one of this provider's
+        """
+        cluster_config = self.config['clusters'].get(cluster_name)
+        if not cluster_config:
+            raise ClusterSyncException('Config not found for cluster {}'.format(cluster_name))
+        if cluster_config['provider'] != self.provider:
+            raise ClusterSyncException('The provider for {} is not {}'.format(
+                cluster_name, self.provider,
+            ))
+        return cluster_config
+
+    def start_cluster(self, cluster_name, cluster_config, dry_run=False):
+        return self.sync(cluster_name, cluster_config, dry_run=dry_run)
+
+    def start(self, cluster_name, dry_run=False):
+        return self.start_cluster(cluster_name, self.cluster_config(cluster_name), dry_run=dry_run)
+
+    def stop_cluster(self, cluster_name, cluster_config):
+        return self.each_node('shutdown', cluster_name, self.shutdown_node)
+
+    def stop(self, cluster_name):
+        return self.stop_cluster(cluster_name, self.cluster_config(cluster_name))
+
+    def destroy_cluster(self, cluster_name):
+        return self.each_node('destroy', cluster_name, self.destroy_node)
+
+    def wait_for_ready(self, cluster_name):
+        """
+        Block until every node of the cluster answers on its SSH port
+
+        :return: dict of node name -> NodeUnavailableException, for the
+            nodes that are off or never came up
+        """
+        nodes = self.node_names(cluster_name)
+        new_nodes = self.cluster_status(cluster_name)['new']
+        if new_nodes:
+            print('Waiting for nodes to come online: {}'.format([n.name for n in new_nodes]))
+
+        unavailable = {}
+        tracker = ReadinessTracker.for_config(self.config, self)
+        for node, error in tracker.ready_nodes(nodes):
+            if error is not None:
+                unavailable[node] = error
+
+        if unavailable:
+            print('WARNING: Some nodes are NOT online, and commands cannot be run on them')
+            print('Offline nodes: {}'.format(sorted(unavailable)))
+
+        return unavailable
+
 
 class DigitalOceanNodeConfig(ServerConfig):
 
     def __init__(
         self, name, region, size, ssh_keys, image, backups=False, ipv6=False,
-        private_networking=False
+        private_networking=False, tags=None,
     ):
         self.name = name
         self.region = region
@@ -53,6 +338,7 @@ class DigitalOceanNodeConfig(ServerConfig):
         self.backups = backups
         self.ipv6 = ipv6
         self.private_networking = private_networking
+        self.tags = tags
 
     def as_kwargs_dict(self):
         kwargs = {}
@@ -72,39 +358,55 @@ class DigitalOceanNodeConfig(ServerConfig):
             kwargs['ipv6'] = self.ipv6
         if self.private_networking is not None:
             kwargs['private_networking'] = self.private_networking
+        if self.tags is not None:
+            kwargs['tags'] = self.tags
 
         return kwargs
 
 
-class ClusterSyncException(Exception):
-    pass
+def cluster_tag(cluster_name):
+    """Tag herd puts on every node it creates for a cluster"""
+    return 'herd-{}'.format(cluster_name)
 
 
 class DigitalOceanClusterManager(ClusterManager):
 
     def __init__(self, config):
+        super(DigitalOceanClusterManager, self).__init__(config)
         self.token = config['providers']['digitalocean']['token']
-        self.manager = digitalocean.Manager(token=self.token)
-        self.config = config
+        self.client = self.make_client()
+        self.inventory = cache_for(config, self.provider, self.token, records=self.records())
+
+    def records(self):
+        """What the API client's listings are made of, see InventoryCache"""
+        # Imported here, the CLI only pays for requests when it's used
+        from herd.api import Droplet
+        from herd.api import Size
+        return {'nodes': Droplet, 'sizes': Size}
+
+    def make_client(self):
+        # Imported here, the CLI only pays for requests when it's used
+        from herd.api import client_for
+        from herd.api import PAGE_WORKERS
+        return client_for(self.token, max_connections=max(
+            herd.config.provision_concurrency(self.config), PAGE_WORKERS,
+        ))
+
+    @property
+    def list_by_tag(self):
+        """
+        List only the nodes tagged for one of the configured clusters, one
+        listing per cluster, instead of every node of the account
+        """
+        return self.config['providers'].get(self.provider, {}).get('list_by_tag', False)
 
     @property
     def provider(self):
         return 'digitalocean'
 
-    def parse_config(self):
-        pass
-
     def default_region(self):
         return 'sfo1'
 
-    def parse_node_size_config(self, cfg):
-        return {
-            'min_cores': cfg.get('min_cores', 1),
-            'min_ram': cfg.get('min_ram', 256),
-            'min_disk': cfg.get('min_disk', 10),
-            'max_monthly_cost': cfg.get('max_monthly_cost', 20),
-        }
-
     def size_for_slug(self, slug):
         return next(
             (
@@ -114,6 +416,18 @@ class DigitalOceanClusterManager(ClusterManager):
             None,
         )
 
+    def node_fits(self, node, node_size_config):
+        size = self.size_for_slug(node.size_slug)
+        return size is not None and self.size_meets_requirements(size, **node_size_config)
+
+    def resizable(self, node, size):
+        """
+        Resizing grows the disk for good, so only to sizes with at least as
+        much of it
+        """
+        current = self.size_for_slug(node.size_slug)
+        return current is not None and size.disk >= current.disk
+
     def size_meets_requirements(self, size, min_cores, min_ram, min_disk, max_monthly_cost):
         return all((
             size.vcpus >= min_cores,
@@ -129,7 +443,7 @@ class DigitalOceanClusterManager(ClusterManager):
         :param min_disk: int Least disk allowed (in GB) default = 20
         :param max_monthly_cost: int Highest monthly price allowed default = 5
 
-        :return: digitalocean.Size.Size
+        :return: herd.api.Size
         """
         all_matching = [
             size for size in self.sizes_list
@@ -139,260 +453,313 @@ class DigitalOceanClusterManager(ClusterManager):
         return next(iter(sorted(all_matching, key=attrgetter("price_monthly"))), None)
 
     def rename_node(self, node, new_name):
-        node.rename(new_name)
+        with span(herd.timing.API, 'rename to {}'.format(new_name), node.name):
+            self.client.rename(node.id, new_name)
+        self.inventory.invalidate('nodes')
+
+    def node_config(self, name, size_slug, cluster_config):
+        return DigitalOceanNodeConfig(
+            name=name,
+            region=cluster_config.get('region', self.default_region()),
+            size=size_slug,
+            image=cluster_config.get('image', None),
+            ssh_keys=cluster_config.get('ssh_keys', None),
+            backups=cluster_config.get('backups', False),
+            ipv6=cluster_config.get('ipv6', False),
+            private_networking=cluster_config.get('private_networking', False),
+            tags=[cluster_tag(parse_node_name(name)[0])],
+        )
 
     def launch_node(self, node_configuration):
         """
-        :param size: digitalocean.Size.Size
+        :param node_configuration: DigitalOceanNodeConfig
         """
         print("Launching node {}".format(node_configuration.name))
-        droplet = digitalocean.Droplet(
-            token=self.token,
-            **node_configuration.as_kwargs_dict()
-        )
-
-        droplet.create()
+        with span(herd.timing.API, 'create', node_configuration.name):
+            droplet = self.client.create_droplet(**node_configuration.as_kwargs_dict())
+        self.inventory.invalidate('nodes')
         return droplet
 
+    def wait_for_action(self, action, node, what):
+        if not self.client.wait_for_action(action):
+            raise ClusterSyncException('{} of {} did not finish'.format(what, node.name))
+
+    def resize_node(self, node, size):
+        """
+        Resizes in place, so the node keeps its name and addresses. It has
+        to be powered off for that and is powered back on after
+        """
+        with span(herd.timing.API, 'resize to {}'.format(size.slug), node.name):
+            if node.status != 'off':
+                self.wait_for_action(self.client.shutdown(node.id), node, 'Shutdown')
+            self.wait_for_action(self.client.resize(node.id, size.slug), node, 'Resize')
+            self.client.power_on(node.id)
+        self.inventory.invalidate('nodes')
+
     def destroy_node(self, node):
         if node.status == 'new':
             print("Can't destroy node {} yet, it's currently being created".format(node.name))
 
         print("Destroying node id:{} name:{}".format(node.id, node.name))
-        node.destroy()
+        with span(herd.timing.API, 'destroy', node.name):
+            self.client.destroy(node.id)
+        self.inventory.invalidate('nodes')
+
+    def shutdown_node(self, node):
+        with span(herd.timing.API, 'shutdown', node.name):
+            self.client.shutdown(node.id)
+        self.inventory.invalidate('nodes')
+
+    def fetch(self, resource, fetch, conditional=False):
+        """Read a provider listing through the inventory cache, see InventoryCache.get"""
+        def timed_fetch(*etag):
+            with span(herd.timing.API, 'list {}'.format(resource)):
+                return fetch(*etag)
+        return self.inventory.get(resource, timed_fetch, conditional)
 
-    def destroy_nodes(self, nodes):
-        for node in nodes:
-            self.destroy_node(node)
-
-    def shutdown(self, node):
-        node.shutdown()
-
-    def node_in_cluster(self, cluster):
-        cluster_name_scheme = '{}\d+'.format(cluster)
-        return [
-            n for n in self.nodes_list
-            if re.match(cluster_name_scheme, n.name)
-        ]
-
-    def node_index(self, cluster_name, node_name):
-        cluster_name_scheme = '{}(\d+)'.format(cluster_name)
-        return int(re.findall(cluster_name_scheme, node_name)[0])
-
-    @cached_property
+    @property
     def nodes_list(self):
-        return self._nodes_list()
+        return self.fetch('nodes', self._nodes_list)
 
     def _nodes_list(self):
-        return self.manager.get_all_droplets()
+        if not self.list_by_tag:
+            return self.client.list_droplets()
+
+        clusters = sorted(
+            name for name, cluster in self.config.get('clusters', {}).items()
+            if cluster.get('provider') == self.provider
+        )
+        if not clusters:
+            return []
+        with futures.ThreadPoolExecutor(max_workers=min(len(clusters), 8)) as executor:
+            listings = executor.map(
+                lambda cluster: self.client.list_droplets(tag=cluster_tag(cluster)), clusters,
+            )
+            return [node for listing in listings for node in listing]
 
-    @cached_property
+    def refresh_nodes_list(self):
+        self.inventory.invalidate('nodes')
+        return self.nodes_list
+
+    @property
     def regions_list(self):
-        return self.manager.get_all_regions()
+        return self.fetch('regions', self.client.list_regions, conditional=True)
 
-    @cached_property
+    @property
     def sizes_list(self):
-        return self.manager.get_all_sizes()
+        return self.fetch('sizes', self.client.list_sizes, conditional=True)
 
-    @cached_property
+    @property
     def images_list(self):
-        return self.manager.get_all_images()
+        return self.fetch('images', self.client.list_images, conditional=True)
 
-    def list_clusters(self, cluster_name):
-        pass
+    def is_throttled(self, error):
+        """Whether an API error means we went over the rate limit"""
+        return getattr(error, 'throttled', False)
 
-    def destroy_cluster(self, cluster_name):
-        nodes_in_cluster = self.node_in_cluster(cluster_name)
 
-        if not nodes_in_cluster:
-            print("No nodes found in cluster {}, taking no action.".format(cluster_name))
-            return
+class FakeClusterManager(DigitalOceanClusterManager):
+    """
+    DigitalOcean's cluster management run against an in-memory
+    herd.fake.FakeCloud, for tests and benchmarks. [providers.fake] cloud
+    names the registered FakeCloud to use.
+    """
 
-        self.destroy_nodes(nodes_in_cluster)
+    def __init__(self, config):
+        ClusterManager.__init__(self, config)
+        self.token = config['providers'].get('fake', {}).get('cloud', 'default')
+        self.client = self.make_client()
+        self.inventory = cache_for(config, self.provider, self.token, records=self.records())
 
-    def cluster_info(self, cluster_name):
-        nodes_in_cluster = self.node_in_cluster(cluster_name)
+    def make_client(self):
+        # Imported here, herd.fake needs paramiko for its SSH server
+        from herd.fake import fake_cloud
+        return fake_cloud(self.token)
 
-        if not nodes_in_cluster:
-            print("No nodes found in cluster {}".format(cluster_name))
-            return
+    @property
+    def provider(self):
+        return 'fake'
 
-        return [
-            {
-                'name': node.name,
-                'public_ips': node.ip_address,
-                'private_ips': node.private_ip_address,
-                'status': node.status
-            }
-            for node in nodes_in_cluster
-        ]
 
-    def cluster_status(self, cluster_name):
-        nodes = self._nodes_list()
+# Entry point group provider packages register their ClusterManager under.
+# herd's own providers are only in PROVIDER_TO_CLUSTER_MANAGER
+PROVIDER_ENTRY_POINTS = 'herd.providers'
 
-        def filter_nodes(status):
-            def filter_node(node):
-                return (
-                    node.status == status and
-                    re.match('{}\d+'.format(cluster_name), node.name)
-                )
+# What a provider has to implement, see ClusterManager
+ABSTRACT_METHODS = (
+    'provider', 'nodes_list', 'refresh_nodes_list', 'best_node_size_match', 'node_fits',
+    'node_config', 'launch_node', 'destroy_node', 'rename_node', 'resize_node',
+    'shutdown_node',
+)
 
-            return filter_node
+PROVIDER_TO_CLUSTER_MANAGER = {
+    'digitalocean': DigitalOceanClusterManager,
+    'fake': FakeClusterManager,
+}
 
-        return {
-            'active': list(filter(filter_nodes('active'), nodes)),
-            'new': list(filter(filter_nodes('new'), nodes)),
-            'off': list(filter(filter_nodes('off'), nodes)),
-            'archive': list(filter(filter_nodes('archive'), nodes)),
-        }
 
-    def node_names(self, cluster_name):
-        return [c['name'] for c in self.cluster_info(cluster_name)]
+class ProviderException(Exception):
+    pass
 
-    def name_for_node(self, cluster_name, idx):
-        return '{}{}'.format(cluster_name, idx)
 
-    def ip_for_node(self, node_name):
-        return next(
-            (
-                node.ip_address
-                for node in self.nodes_list
-                if node.name == node_name
-            ),
-            None
-        )
+_entry_points = None
 
-    def stop_cluster(self, cluster_name, cluster_config):
-        nodes_in_cluster = self.node_in_cluster(cluster_name)
-        for node in nodes_in_cluster:
-            self.shutdown(node)
 
-    def start_cluster(self, cluster_name, cluster_config):
-        """Refactor this. Gross"""
-        print('Syncing cluster: {}'.format(cluster_name))
-        nodes_in_cluster = self.node_in_cluster(cluster_name)
-        node_size_config = self.parse_node_size_config(cluster_config)
-        node_size = self.best_node_size_match(**node_size_config)
-        desired_count = cluster_config['server_count']
+def provider_entry_points():
+    """
+    :return: dict of provider name -> entry point, for the providers
+        installed packages register under herd.providers
+    """
+    global _entry_points
+    if _entry_points is None:
+        # Imported here, it's slow to import and only needed for providers
+        # herd doesn't ship
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            import pkg_resources
+            found = pkg_resources.iter_entry_points(PROVIDER_ENTRY_POINTS)
+        else:
+            installed = entry_points()
+            if hasattr(installed, 'select'):
+                found = installed.select(group=PROVIDER_ENTRY_POINTS)
+            else:
+                found = installed.get(PROVIDER_ENTRY_POINTS, ())
+        _entry_points = {entry_point.name: entry_point for entry_point in found}
+    return _entry_points
 
-        if any(node.status == 'new' for node in nodes_in_cluster):
-            print(
-                'Can\'t modify cluster {} right now, '
-                'nodes currently spawning'.format(cluster_name)
-            )
 
-        if not node_size:
-            raise ClusterSyncException(
-                (
-                    'No valid node was found matching cores: {min_cores}, '
-                    'ram: {min_ram}mb, disk: {min_disk}gb, cost: ${max_monthly_cost}'
-                ).format(**node_size_config)
-            )
+def known_provider(provider):
+    # Package metadata is only read for providers herd doesn't ship
+    return provider in PROVIDER_TO_CLUSTER_MANAGER or provider in provider_entry_points()
 
-        def destroy_nonmatching_node(node):
-            meets_size_requirements = self.size_meets_requirements(
-                self.size_for_slug(node.size_slug), **node_size_config
-            )
-            if not meets_size_requirements:
-                print(
-                    'Destroying node {} - doesn\'t meet size requirement'.format(
-                        node.name,
-                    )
-                )
-                self.destroy_node(node)
 
-            return meets_size_requirements
+def provider_names():
+    return sorted(set(PROVIDER_TO_CLUSTER_MANAGER) | set(provider_entry_points()))
 
-        # Remove nodes if they dont match size config & sort by name
-        nodes_in_cluster = list(sorted(
-            filter(destroy_nonmatching_node, nodes_in_cluster),
-            key=attrgetter('name'),
+
+def missing_methods(manager_class):
+    """
+    :return: list of the ABSTRACT_METHODS manager_class doesn't implement
+    """
+    return [
+        name for name in ABSTRACT_METHODS
+        if getattr(manager_class, name) is getattr(ClusterManager, name)
+    ]
+
+
+def cluster_manager_for_provider(provider):
+    """
+    :return: the ClusterManager subclass for provider, built in or from an
+        installed package
+    :raises ProviderException: if an installed provider is not a complete
+        ClusterManager
+    """
+    if provider in PROVIDER_TO_CLUSTER_MANAGER:
+        return PROVIDER_TO_CLUSTER_MANAGER[provider]
+
+    entry_point = provider_entry_points().get(provider)
+    if entry_point is None:
+        raise ValueError('provider must be one of {}'.format(', '.join(provider_names())))
+
+    manager_class = entry_point.load()
+    if not isinstance(manager_class, type) or not issubclass(manager_class, ClusterManager):
+        raise ProviderException('Provider {} is not a herd.cluster.ClusterManager'.format(provider))
+    missing = missing_methods(manager_class)
+    if missing:
+        raise ProviderException('Provider {} does not implement {}'.format(
+            provider, ', '.join(missing),
         ))
+    return manager_class
 
-        if len(nodes_in_cluster) > desired_count:
-            print('Destroying extraneous nodes')
-            for node in nodes_in_cluster[desired_count:]:
-                self.destroy_node(node)
-            nodes_in_cluster == nodes_in_cluster[:desired_count]
-
-        # Rename nodes if nonsequential
-        for idx, node in enumerate(nodes_in_cluster, start=1):
-            name_for_node = self.name_for_node(cluster_name, idx)
-            if name_for_node != node.name:
-                self.rename_node(node, name_for_node)
-
-        for idx in range(len(nodes_in_cluster), desired_count):
-            node_configuration = DigitalOceanNodeConfig(
-                name=self.name_for_node(cluster_name, idx + 1),
-                region=cluster_config.get('region', self.default_region()),
-                size=self.best_node_size_match(**node_size_config).slug,
-                image=cluster_config.get('image', None),
-                ssh_keys=cluster_config.get('ssh_keys', None),
-                backups=cluster_config.get('backups', False),
-                ipv6=cluster_config.get('ipv6', False),
-                private_networking=cluster_config.get('private_networking', False),
-            )
-            self.launch_node(node_configuration)
 
-        print('Cluster %s is operational!' % cluster_name)
+def manager_for_cluster(config, cluster_name):
+    return cluster_manager_for_provider(
+        config['clusters'][cluster_name]['provider']
+    )(config)
 
-    def start(self, cluster_name):
-        cluster_config = self.config['clusters'].get(cluster_name)
-        if not cluster_config:
-            print('Config not found for cluster %s ' % cluster_name)
-        elif cluster_config['provider'] != self.provider:
-            print('The provider for %s is not %s' % (cluster_name, self.provider))
-        else:
-            self.start_cluster(cluster_name, cluster_config)
 
-    def stop(self, cluster_name):
-        cluster_config = self.config['clusters'].get(cluster_name)
-        if not cluster_config:
-            print('Config not found for cluster %s ' % cluster_name)
-        elif cluster_config['provider'] != self.provider:
-            print('The provider for %s is not %s' % (cluster_name, self.provider))
-        else:
-            self.stop_cluster(cluster_name, cluster_config)
+class MultiClusterSyncException(Exception):
 
-    def wait_for_ready(self, cluster_name):
-        cluster_status = self.cluster_status(cluster_name)
-        waited = False
-        while(len(cluster_status['new']) > 0):
-            waited = True
-            print('Waiting for nodes to come online: {}'.format(
-                [n.name for n in cluster_status['new']]
+    def __init__(self, failures, results):
+        """
+        :param failures: dict of (cluster, provider) -> exception it failed with
+        :param results: dict of (cluster, provider) -> ProvisionResults, for
+            the clusters that didn't fail
+        """
+        super(MultiClusterSyncException, self).__init__(
+            'Failed on clusters {}'.format(', '.join(
+                '{} ({})'.format(cluster, provider) for cluster, provider in sorted(failures)
             ))
-            time.sleep(10)
-            cluster_status = self.cluster_status(cluster_name)
-
-        if waited:
-            print('Giving the cluster 15 seconds to cool down')
-            time.sleep(15)
-
-        if len(cluster_status['off']) or len(cluster_status['archive']):
-            nodes = [
-                n.name
-                for n in cluster_status['off'] + cluster_status['archive']
-            ]
-            print(
-                'WARNING: Some nodes are NOT online, and commands cannot ',
-                'be run on them'
-            )
-            print('Offline nodes: {}'.format(nodes))
+        )
+        self.failures = failures
+        self.results = results
 
 
-PROVIDER_TO_CLUSTER_MANAGER = {
-    'digitalocean': DigitalOceanClusterManager
+# How each manage_clusters action is run by a manager
+CLUSTER_ACTIONS = {
+    'start': lambda manager, cluster, dry_run: manager.start(cluster, dry_run=dry_run),
+    'stop': lambda manager, cluster, dry_run: manager.stop(cluster),
+    'destroy': lambda manager, cluster, dry_run: manager.destroy_cluster(cluster),
 }
 
 
-def cluster_manager_for_provider(provider):
-    if provider not in PROVIDER_TO_CLUSTER_MANAGER:
-        raise ValueError('provider must be one of {}'.format(PROVIDER_TO_CLUSTER_MANAGER.keys()))
-    return PROVIDER_TO_CLUSTER_MANAGER[provider]
-
+def manage_clusters(config, action, clusters, dry_run=False):
+    """
+    Start, stop or destroy many clusters at once, across providers. Each
+    provider gets one manager, shared by all of its clusters, so they share
+    its node listing and rate limit.
+
+    :param action: 'start', 'stop' or 'destroy'
+    :param clusters: list of (cluster name, provider) pairs
+    :param dry_run: for start, only print what would change
+    :return: dict of (cluster, provider) -> list of ProvisionResults
+    :raises MultiClusterSyncException: naming every cluster that failed
+    """
+    run = CLUSTER_ACTIONS[action]
+    results = {}
+    failures = {}
+
+    managers = {}
+    for provider in sorted(set(provider for _, provider in clusters)):
+        try:
+            managers[provider] = cluster_manager_for_provider(provider)(config)
+        except Exception as e:
+            managers[provider] = e
+
+    runnable = []
+    for cluster, provider in clusters:
+        if isinstance(managers[provider], Exception):
+            failures[(cluster, provider)] = managers[provider]
+        else:
+            runnable.append((cluster, provider))
 
-def manager_for_cluster(config, cluster_name):
-    return cluster_manager_for_provider(
-        config['clusters'][cluster_name]['provider']
-    )(config)
+    if runnable:
+        with futures.ThreadPoolExecutor(max_workers=len(runnable)) as executor:
+            future_to_cluster = {
+                executor.submit(run, managers[provider], cluster, dry_run): (cluster, provider)
+                for cluster, provider in runnable
+            }
+            for future in futures.as_completed(future_to_cluster):
+                key = future_to_cluster[future]
+                if future.exception() is not None:
+                    failures[key] = future.exception()
+                else:
+                    results[key] = future.result() or []
+
+    if failures:
+        raise MultiClusterSyncException(failures, results)
+    return results
+
+
+def format_results(results, failures=None):
+    """One line per cluster, as returned and raised by manage_clusters"""
+    failures = failures or {}
+    lines = []
+    for cluster, provider in sorted(set(results) | set(failures)):
+        if (cluster, provider) in failures:
+            outcome = 'FAILED {}'.format(failures[(cluster, provider)])
+        else:
+            outcome = 'ok, {} changes'.format(len(results[(cluster, provider)]))
+        lines.append('{} ({}): {}'.format(cluster, provider, outcome))
+    return '\n'.join(lines)
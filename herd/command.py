@@ -1,4 +1,14 @@
-from herd import handler
+import threading
+
+from herd import timing
+from herd.delta import digest_cache
+from herd.delta import Manifest
+from herd.output import OutputLine
+from herd.output import STDOUT
+
+
+# Update is skipped on nodes whose apt lists are younger than this
+UPDATE_MAX_AGE = 60 * 60
 
 
 class Command(object):
@@ -7,6 +17,9 @@ class Command(object):
     on a machine
     """
 
+    # What running it counts as in timing profiles
+    phase = timing.EXECUTE
+
     def __init__(self, sudo=False):
         self.sudo = sudo
 
@@ -17,34 +30,100 @@ class Command(object):
     def parse(self, to_parse):
         raise NotImplementedError()
 
+    @classmethod
+    def check(cls, to_parse):
+        """
+        :param to_parse: the command's value in a task's config
+        :return: str saying what's wrong with it, or None if it parses
+        """
+        return None
+
     def run(self, node_handler):
+        # Imported here, so parsing and checking config never loads paramiko
+        from herd import handler
         return handler.execute(node_handler, self.command)
 
+    def satisfied(self, facts):
+        """
+        :param facts: herd.facts.NodeFacts of the node about to run this
+        :return: bool, True if running it would change nothing
+        """
+        return False
+
+    def touches(self):
+        """
+        :return: set of what running this changes, e.g. ('package', 'nginx'),
+            or None if it could change anything
+        """
+        return None
+
+    def __str__(self):
+        return self.command
+
+
+def package_list(to_parse):
+    if isinstance(to_parse, list):
+        return [str(s) for s in to_parse]
+    return str(to_parse).split()
+
+
+def check_words(to_parse, what):
+    if isinstance(to_parse, list):
+        if to_parse and all(isinstance(s, str) and s for s in to_parse):
+            return None
+    elif isinstance(to_parse, str) and to_parse.strip():
+        return None
+    return 'needs {} as a string or a list of strings, got {!r}'.format(what, to_parse)
+
+
+def check_name(to_parse, what):
+    if isinstance(to_parse, str) and to_parse.strip():
+        return None
+    return 'needs {} as a string, got {!r}'.format(what, to_parse)
+
 
 class Install(Command):
 
+    @classmethod
+    def check(cls, to_parse):
+        return check_words(to_parse, 'packages')
+
     @property
     def _format(self):
         return "apt-get install -y {}"
 
     def parse(self, to_parse):
-        if isinstance(to_parse, list):
-            self.command = self.format.format(' '.join(str(s) for s in to_parse))
-        else:
-            self.command = self.format.format(to_parse)
+        self.packages = package_list(to_parse)
+        self.command = self.format.format(' '.join(self.packages))
+
+    def satisfied(self, facts):
+        return all(facts.has_package(p) for p in self.packages)
+
+    def touches(self):
+        return {('package', p.partition('=')[0]) for p in self.packages}
 
 
 class Uninstall(Command):
 
+    @classmethod
+    def check(cls, to_parse):
+        return check_words(to_parse, 'packages')
+
     @property
     def _format(self):
         return "apt-get remove -y {}"
 
     def parse(self, to_parse):
-        if isinstance(to_parse, list):
-            self.command = self.format.format(' '.join(str(s) for s in to_parse))
-        else:
-            self.command = self.format.format(to_parse)
+        self.packages = package_list(to_parse)
+        self.command = self.format.format(' '.join(self.packages))
+
+    def satisfied(self, facts):
+        return facts.packages is not None and not any(
+            facts.has_package(p.partition('=')[0]) for p in self.packages
+        )
+
+    def touches(self):
+        return {('package', p.partition('=')[0]) for p in self.packages}
 
 
 class Upgrade(Command):
@@ -68,29 +147,98 @@ class Update(Command):
     def parse(self):
         self.command = self._format
 
+    def satisfied(self, facts):
+        return facts.apt_age is not None and facts.apt_age < UPDATE_MAX_AGE
+
+    def touches(self):
+        return {('apt',)}
+
 
 class Start(Command):
 
+    @classmethod
+    def check(cls, to_parse):
+        return check_name(to_parse, 'a service')
+
     @property
     def _format(self):
         return "service {} start"
 
     def parse(self, to_parse):
+        self.service = to_parse
         self.command = self.format.format(to_parse)
 
+    def satisfied(self, facts):
+        return facts.service_state(self.service) == 'running'
+
+    def touches(self):
+        return {('service', self.service)}
+
 
 class Stop(Command):
 
+    @classmethod
+    def check(cls, to_parse):
+        return check_name(to_parse, 'a service')
+
     @property
     def _format(self):
         return "service {} stop"
 
     def parse(self, to_parse):
+        self.service = to_parse
+        self.command = self.format.format(to_parse)
+
+    def satisfied(self, facts):
+        return facts.service_state(self.service) == 'stopped'
+
+    def touches(self):
+        return {('service', self.service)}
+
+
+class Execute(Command):
+    """An arbitrary shell command, e.g. from `herd exec`"""
+
+    @classmethod
+    def check(cls, to_parse):
+        return check_words(to_parse, 'a command')
+
+    @property
+    def _format(self):
+        return "{}"
+
+    def parse(self, to_parse):
+        if isinstance(to_parse, list):
+            to_parse = ' '.join(to_parse)
         self.command = self.format.format(to_parse)
 
 
 class Copy(Command):
-    """ A more unique command :D Copy files via scp"""
+    """ A more unique command :D Copy files via scp
+
+    With sync, only files whose content differs on the node are sent. With
+    cache, files go through a content-addressed store on the node, and
+    content it already has is linked from there instead of sent
+    """
+
+    phase = timing.COPY
+
+    FLAGS = ('recursive', 'sync', 'compress', 'cache')
+
+    @classmethod
+    def check(cls, to_parse):
+        if not isinstance(to_parse, dict):
+            return 'needs a table with src and dest, got {!r}'.format(to_parse)
+        for key in ('src', 'dest'):
+            if not isinstance(to_parse.get(key), str) or not to_parse[key]:
+                return 'needs {} as a string, got {!r}'.format(key, to_parse.get(key))
+        for key, value in sorted(to_parse.items()):
+            if key in cls.FLAGS:
+                if not isinstance(value, bool):
+                    return 'needs {} as true or false, got {!r}'.format(key, value)
+            elif key not in ('src', 'dest'):
+                return 'has unknown option {}'.format(key)
+        return None
 
     @property
     def _format(self):
@@ -103,10 +251,54 @@ class Copy(Command):
         self.src = to_parse['src']
         self.dest = to_parse['dest']
         self.recursive = to_parse.get('recursive', False)
+        self.sync = to_parse.get('sync', False)
+        self.compress = to_parse.get('compress', False)
+        self.cache = to_parse.get('cache', False)
+        self._manifests = {}
+        self._manifest_lock = threading.Lock()
         return self
 
+    def manifest(self, config, target):
+        """
+        Local file digests, computed once and shared by every node the copy
+        lands at the same target on
+
+        :param target: where src goes on the node, see handler.copy_target
+        """
+        with self._manifest_lock:
+            if target not in self._manifests:
+                self._manifests[target] = Manifest.build(
+                    self.src, target, self.recursive, digests=digest_cache(config),
+                )
+            return self._manifests[target]
+
     def run(self, node_handler):
-        return handler.copy(node_handler, self.src, self.dest, self.recursive)
+        from herd import handler
+        if not (self.sync or self.cache):
+            handler.copy(node_handler, self.src, self.dest, self.recursive)
+            return []
+
+        manifest = self.manifest(
+            node_handler.config, handler.copy_target(node_handler, self.src, self.dest),
+        )
+        if self.cache:
+            placed, sent = handler.cached_copy(
+                node_handler, manifest, self.sync, self.compress,
+            )
+            return [OutputLine(STDOUT, 'Placed {} of {} files, sent {} new blobs'.format(
+                len(placed), len(manifest.files), len(sent),
+            ))]
+
+        changed = handler.sync(node_handler, manifest, self.compress)
+        return [OutputLine(STDOUT, 'Sent {} of {} files'.format(
+            len(changed), len(manifest.files),
+        ))]
+
+    def touches(self):
+        return {('file', self.dest)}
+
+    def __str__(self):
+        return 'copy {} to {}'.format(self.src, self.dest)
 
 
 def parse_command(key, value, sudo=False):
@@ -130,4 +322,5 @@ COMMANDS = {
     'install': Install,
     'uninstall': Uninstall,
     'copy': Copy,
+    'exec': Execute,
 }
@@ -1,5 +1,116 @@
+class ConfigException(Exception):
+    pass
+
+
 def parallel_connections(config):
     if 'herd' not in config:
         return None
 
     return config['herd'].get('concurrent_connections')
+
+
+def herd_option(config, key, default=None):
+    return config.get('herd', {}).get(key, default)
+
+
+def max_open_connections(config):
+    return herd_option(config, 'max_open_connections')
+
+
+def connection_idle_timeout(config):
+    return herd_option(config, 'connection_idle_timeout')
+
+
+def ssh_user(config):
+    return config['ssh'].get('user', 'root')
+
+
+def executor_backend(config):
+    return herd_option(config, 'executor', 'thread')
+
+
+def async_concurrent_sessions(config):
+    return herd_option(config, 'async_concurrent_sessions')
+
+
+def parallel_tasks(config):
+    return herd_option(config, 'parallel_tasks', 1)
+
+
+def cache_dir(config):
+    return herd_option(config, 'cache_dir')
+
+
+def cache_ttls(config):
+    return herd_option(config, 'cache_ttl', {})
+
+
+def provision_concurrency(config):
+    return herd_option(config, 'provision_concurrency', 8)
+
+
+def provision_rate(config):
+    return herd_option(config, 'provision_rate', 4)
+
+
+def provision_burst(config):
+    return herd_option(config, 'provision_burst', 10)
+
+
+def ssh_port(config):
+    return config['ssh'].get('port', 22)
+
+
+def ready_timeout(config):
+    return herd_option(config, 'ready_timeout', 600)
+
+
+def max_sessions(config):
+    """SSH sessions running commands at once, across every cluster and role"""
+    sessions = herd_option(config, 'max_sessions')
+    if sessions is None:
+        if executor_backend(config) == 'asyncio':
+            sessions = async_concurrent_sessions(config) or 256
+        else:
+            sessions = parallel_connections(config) or 4
+    return min(sessions, max_open_connections(config) or sessions)
+
+
+def cluster_sessions(config):
+    return herd_option(config, 'cluster_sessions')
+
+
+def host_sessions(config):
+    return herd_option(config, 'host_sessions', 1)
+
+
+def gather_facts(config):
+    return herd_option(config, 'gather_facts', True)
+
+
+def facts_ttl(config):
+    return herd_option(config, 'facts_ttl', 300)
+
+
+def output(config):
+    return herd_option(config, 'output', 'console')
+
+
+def output_file(config):
+    return herd_option(config, 'output_file')
+
+
+def output_spill_bytes(config):
+    return herd_option(config, 'output_spill_bytes', 64 * 1024)
+
+
+def log_dir(config):
+    return herd_option(config, 'log_dir')
+
+
+def log_max_bytes(config):
+    return herd_option(config, 'log_max_bytes', 10 * 1024 * 1024)
+
+
+def log_backups(config):
+    return herd_option(config, 'log_backups', 5)
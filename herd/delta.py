@@ -0,0 +1,367 @@
+"""
+Delta copies: only send the files whose content differs on the node.
+
+The local side hashes every file once, the node hashes its copy in a single
+remote sha256sum call, and whatever differs goes over in one tar stream
+(optionally gzipped) that is unpacked on the far end.
+
+Local digests are computed several files at once, large files read through
+mmap, and kept in a DigestCache for as long as a file's size and mtime stay
+the same, so an unchanged release tree isn't read again on the next run.
+
+Plain recursive copies skip the digests: the whole tree goes over as one
+gzipped tar stream on a single channel, instead of the SCP protocol's round
+trip for every file and directory.
+
+Cached copies go through a content-addressed store on each node
+(STORE_DIR, one file per blob named after its digest and mode): only blobs
+the node doesn't have yet are sent, then every destination file is hard
+linked to its blob, or copied from it where a link can't be made. A blob
+whose content no longer matches its name, from a destination edited in
+place, counts as missing.
+"""
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import posixpath
+import shlex
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+import herd.config
+from herd.inventory import DEFAULT_CACHE_DIR
+
+
+HASH_CHUNK = 1024 * 1024
+# Files at least this big are hashed through mmap instead of read()
+MMAP_THRESHOLD = 4 * HASH_CHUNK
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+# A file modified this recently may change again within its mtime's
+# resolution, so its digest isn't cached yet
+RACY_SECONDS = 2
+DIGEST_CACHE_FILE = 'digests.json'
+STORE_DIR = '"$HOME"/.cache/herd/blobs'
+# Trees are mostly small text files, the fastest level gets most of the
+# gain without making the local CPU the bottleneck
+TREE_COMPRESS_LEVEL = 1
+
+
+def file_digest(path):
+    """
+    sha256 hex digest of a file. hashlib releases the GIL while it hashes,
+    so several files can be hashed at once from threads
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+                digest.update(chunk)
+            return digest.hexdigest()
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, HASH_CHUNK):
+                    digest.update(view[offset:offset + HASH_CHUNK])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+class DigestCache(object):
+    """
+    Digests of local files, each kept for as long as the file's size and
+    mtime don't change
+
+    :path: JSON file it is kept in between runs, None for memory only
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = None  # absolute path -> (size, mtime_ns, digest)
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            self._entries = {path: tuple(entry) for path, entry in entries.items()}
+        except (IOError, OSError, ValueError, TypeError, AttributeError):
+            pass
+
+    def digest(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+
+        digest = file_digest(path)
+        if time.time() - stat.st_mtime > RACY_SECONDS:
+            with self._lock:
+                self._entries[key] = (stat.st_size, stat.st_mtime_ns, digest)
+                self._dirty = True
+        return digest
+
+    def digests(self, paths, workers=HASH_WORKERS):
+        """
+        :return: dict of path -> digest, hashing the files not cached at once
+        """
+        paths = list(paths)
+        if len(paths) <= 1:
+            return {path: self.digest(path) for path in paths}
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(paths, executor.map(self.digest, paths)))
+
+    def save(self):
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError):
+            # Only a cache, the digests get computed again next time
+            pass
+
+
+_digest_caches = {}
+_digest_caches_lock = threading.Lock()
+
+
+def digest_cache(config):
+    """The process wide DigestCache of a config's cache directory"""
+    path = os.path.join(
+        os.path.expanduser(herd.config.cache_dir(config) or DEFAULT_CACHE_DIR),
+        DIGEST_CACHE_FILE,
+    )
+    with _digest_caches_lock:
+        if path not in _digest_caches:
+            _digest_caches[path] = DigestCache(path)
+        return _digest_caches[path]
+
+
+class Manifest(object):
+    """
+    What a copy should leave on the node
+
+    :remote_dir: directory on the node every file is relative to
+    :files: dict of relative path -> (local path, sha256 hex digest)
+    """
+
+    def __init__(self, remote_dir, files):
+        self.remote_dir = remote_dir
+        self.files = files
+
+    @classmethod
+    def build(cls, src, dest, recursive=False, digests=None):
+        """
+        A file is synced to exactly `dest`. A directory (recursive only) has
+        its contents synced into `dest`. Copies work out that dest the way
+        scp would first, see herd.handler.copy_target
+
+        :param digests: DigestCache to hash through, by default one that
+            lasts only this call
+        """
+        digests = digests or DigestCache()
+        if not os.path.isdir(src):
+            remote_dir, name = posixpath.split(dest.rstrip('/'))
+            manifest = cls(remote_dir or '.', {name: (src, digests.digest(src))})
+            digests.save()
+            return manifest
+
+        if not recursive:
+            raise ValueError('{} is a directory, copy it recursively'.format(src))
+
+        paths = {}
+        for root, _, names in os.walk(src):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    paths[os.path.relpath(path, src).replace(os.sep, '/')] = path
+
+        hashed = digests.digests(paths.values())
+        digests.save()
+        return cls(dest.rstrip('/') or '/', {
+            relpath: (path, hashed[path]) for relpath, path in paths.items()
+        })
+
+    def remote_digest_command(self):
+        """Prints 'digest  ./relpath' for every file under remote_dir"""
+        return (
+            'cd {} 2>/dev/null && find . -type f -exec sha256sum {{}} + || true'
+        ).format(shlex.quote(self.remote_dir))
+
+    def blob(self, relpath):
+        """
+        Name of a file's blob in the node's store. The mode is part of it,
+        since every hard link to a blob shares its mode
+        """
+        path, digest = self.files[relpath]
+        return '{}-{:o}'.format(digest, os.stat(path).st_mode & 0o777)
+
+    def changed(self, remote_digests):
+        """
+        :param remote_digests: dict of relative path -> digest on the node
+        :return: sorted list of relative paths that need to be sent
+        """
+        return sorted(
+            relpath for relpath, (_, digest) in self.files.items()
+            if remote_digests.get(relpath) != digest
+        )
+
+
+def parse_remote_digests(lines):
+    digests = {}
+    for line in lines:
+        digest, _, path = line.partition('  ')
+        if path:
+            digests[path[2:] if path.startswith('./') else path] = digest
+    return digests
+
+
+def unpack_command(remote_dir, compress=False):
+    return 'mkdir -p {0} && tar -x{1}f - -C {0}'.format(
+        shlex.quote(remote_dir), 'z' if compress else '',
+    )
+
+
+def write_tar(fileobj, manifest, relpaths, compress=False):
+    """
+    Streams the given files as a tar archive to fileobj, one file at a time
+    straight from disk, never holding the archive in memory
+    """
+    with tarfile.open(fileobj=fileobj, mode='w|gz' if compress else 'w|') as tar:
+        for relpath in relpaths:
+            tar.add(
+                manifest.files[relpath][0], arcname=relpath, recursive=False,
+                filter=_as_remote_user,
+            )
+
+
+def tree_unpack_command(src, dest):
+    """
+    Unpacks a tree sent by write_tree_tar where scp -r would have put it:
+    under dest if that is an existing directory, as dest otherwise
+    """
+    return (
+        'dest={}; if [ -d "$dest" ]; then dest="$dest"/{}; fi; '
+        'mkdir -p "$dest" && tar -xzf - -C "$dest"'
+    ).format(shlex.quote(dest), shlex.quote(os.path.basename(os.path.normpath(src))))
+
+
+def _as_remote_user(tarinfo):
+    # Files belong to whoever unpacks them, as they would with scp, not to
+    # whatever uid happens to own them locally
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    return tarinfo
+
+
+def write_tree_tar(fileobj, src):
+    """
+    Streams the directory src, empty directories and symlinks included, as
+    a gzipped tar archive to fileobj, one file at a time straight from disk.
+    Symlinks stay links, where scp would have copied what they point to
+    """
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=TREE_COMPRESS_LEVEL) as gz:
+        with tarfile.open(fileobj=gz, mode='w|') as tar:
+            tar.add(src, arcname='.', filter=_as_remote_user)
+
+
+def store_query_command():
+    """
+    Reads blob names on stdin, prints the ones the node's store has. Every
+    destination is a hard link to its blob, so editing one in place edits
+    the blob: each is hashed again, and one that no longer matches the
+    digest in its name is dropped, to be sent again
+    """
+    return '\n'.join([
+        'mkdir -p {0} && cd {0} || exit 1'.format(STORE_DIR),
+        'while read -r blob; do',
+        '  [ -f "$blob" ] || continue',
+        '  sum=$(sha256sum < "$blob") && [ "${sum%% *}" = "${blob%%-*}" ] && echo "$blob" && continue',
+        '  rm -f "$blob"',
+        'done',
+    ])
+
+
+def store_upload_command(compress=False):
+    """
+    Unpacks a tar of blobs (see write_blob_tar) into the node's store. They
+    land in a scratch directory first, so a cut off upload never leaves a
+    partial blob behind
+    """
+    return '\n'.join([
+        'mkdir -p {0} && cd {0} && incoming=$(mktemp -d .incoming.XXXXXX) || exit 1'.format(STORE_DIR),
+        'tar -x{}f - -C "$incoming" && for blob in "$incoming"/*; do mv -f "$blob" .; done'.format(
+            'z' if compress else '',
+        ),
+        'status=$?; rm -rf "$incoming"; exit $status',
+    ])
+
+
+def link_command(remote_dir):
+    """
+    Reads 'dir - <path>' and 'file <blob> <path>' lines on stdin, paths
+    relative to remote_dir: makes each directory, then hard links each file
+    to its blob, copying it instead across filesystems
+    """
+    return '\n'.join([
+        'store={}'.format(STORE_DIR),
+        'mkdir -p {0} && cd {0} || exit 1'.format(shlex.quote(remote_dir)),
+        'while read -r kind blob path; do',
+        '  if [ "$kind" = dir ]; then mkdir -p "$path" || exit 1; continue; fi',
+        '  [ "$path" -ef "$store/$blob" ] && continue',
+        '  ln -f "$store/$blob" "$path" 2>/dev/null || cp -p "$store/$blob" "$path" || exit 1',
+        'done',
+    ])
+
+
+def link_lines(manifest, relpaths):
+    """
+    :return: the input of link_command putting relpaths in place
+    """
+    dirs = sorted(set(
+        posixpath.dirname(relpath) for relpath in relpaths if '/' in relpath
+    ))
+    return (
+        ['dir - {}'.format(path) for path in dirs] +
+        ['file {} {}'.format(manifest.blob(relpath), relpath) for relpath in relpaths]
+    )
+
+
+def write_blob_tar(fileobj, manifest, blobs, compress=False):
+    """
+    Streams the given blobs as a tar archive to fileobj, each named after
+    itself, see store_upload_command
+
+    :param blobs: dict of blob name -> relative path of a file it is the blob of
+    """
+    with tarfile.open(fileobj=fileobj, mode='w|gz' if compress else 'w|') as tar:
+        for blob, relpath in sorted(blobs.items()):
+            tar.add(
+                manifest.files[relpath][0], arcname=blob, recursive=False,
+                filter=_as_remote_user,
+            )
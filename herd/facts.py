@@ -0,0 +1,185 @@
+"""
+Facts about a node: OS release, installed packages, service states and how
+long ago the apt lists were refreshed.
+
+They are gathered with a single remote call and cached per node, so a
+command can tell whether it would change anything (see Command.satisfied)
+and be skipped if not. Whatever a node can't report (no dpkg, no service
+manager) stays None, and commands never count as satisfied on missing facts.
+"""
+import threading
+import time
+from collections import namedtuple
+
+import herd.config
+
+
+DEFAULT_TTL = 300
+MARKER = '__HERD_FACTS__'
+
+GATHER_COMMAND = '\n'.join([
+    "echo {marker} os; cat /etc/os-release 2>/dev/null",
+    "if command -v dpkg-query >/dev/null 2>&1; then "
+    "echo {marker} packages; "
+    "dpkg-query -W -f='${{Status}} ${{Package}} ${{Version}}\\n' 2>/dev/null; fi",
+    "if command -v systemctl >/dev/null 2>&1; then "
+    "echo {marker} systemd; "
+    "systemctl list-units --type=service --all --no-legend --plain 2>/dev/null; "
+    "elif command -v service >/dev/null 2>&1; then "
+    "echo {marker} sysv; service --status-all 2>&1; fi",
+    "if [ -e /var/cache/apt/pkgcache.bin ]; then "
+    "echo {marker} apt_age; "
+    "echo $(( $(date +%s) - $(stat -c %Y /var/cache/apt/pkgcache.bin) )); fi",
+    "true",
+]).format(marker=MARKER)
+
+
+class NodeFacts(namedtuple('NodeFacts', ['os_release', 'packages', 'services', 'apt_age'])):
+    """
+    :os_release: dict of /etc/os-release fields
+    :packages: dict of installed package name -> version, or None
+    :services: dict of service name -> 'running' or 'stopped', or None
+    :apt_age: seconds since the apt lists were last updated, or None
+    """
+
+    def has_package(self, spec):
+        """
+        :param spec: package name as given to apt-get, optionally pinned
+            to a version with name=version
+        """
+        if self.packages is None:
+            return False
+        name, _, version = spec.partition('=')
+        installed = self.packages.get(name)
+        return installed is not None and (not version or installed == version)
+
+    def service_state(self, service):
+        if self.services is None:
+            return None
+        return self.services.get(service)
+
+
+def _parse_os_release(lines):
+    release = {}
+    for line in lines:
+        key, sep, value = line.partition('=')
+        if sep:
+            release[key.strip()] = value.strip().strip('"')
+    return release
+
+
+def _parse_packages(lines):
+    packages = {}
+    for line in lines:
+        parts = line.split()
+        # "install ok installed nginx 1.18.0-0ubuntu1"
+        if len(parts) >= 4 and parts[2] == 'installed':
+            packages[parts[3]] = parts[4] if len(parts) > 4 else ''
+    return packages
+
+
+def _parse_systemd(lines):
+    services = {}
+    for line in lines:
+        parts = line.split()
+        # "nginx.service loaded active running A high performance web server"
+        if len(parts) >= 4 and parts[0].endswith('.service'):
+            name = parts[0][:-len('.service')]
+            services[name] = 'running' if parts[3] == 'running' else 'stopped'
+    return services
+
+
+def _parse_sysv(lines):
+    services = {}
+    for line in lines:
+        parts = line.split()
+        # " [ + ]  nginx"
+        if len(parts) == 4 and parts[0] == '[' and parts[2] == ']':
+            if parts[1] == '+':
+                services[parts[3]] = 'running'
+            elif parts[1] == '-':
+                services[parts[3]] = 'stopped'
+    return services
+
+
+def parse_facts(lines):
+    """
+    :param lines: strings GATHER_COMMAND printed to stdout
+    :return: NodeFacts
+    """
+    sections = {}
+    current = None
+    for line in lines:
+        if line.startswith(MARKER):
+            current = sections.setdefault(line[len(MARKER):].strip(), [])
+        elif current is not None:
+            current.append(line)
+
+    services = None
+    if 'systemd' in sections:
+        services = _parse_systemd(sections['systemd'])
+    elif 'sysv' in sections:
+        services = _parse_sysv(sections['sysv'])
+
+    apt_age = None
+    try:
+        apt_age = int(sections['apt_age'][0])
+    except (KeyError, IndexError, ValueError):
+        pass
+
+    return NodeFacts(
+        _parse_os_release(sections.get('os', [])),
+        _parse_packages(sections['packages']) if 'packages' in sections else None,
+        services,
+        apt_age,
+    )
+
+
+class FactCache(object):
+    """
+    Facts per node, kept for ttl seconds or until invalidated. Anything that
+    runs a command on a node invalidates its facts.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._facts = {}  # node -> (gathered_at, NodeFacts)
+        self._lock = threading.Lock()
+
+    def get(self, node, gather):
+        """
+        :param gather: callable returning fresh NodeFacts for the node
+        """
+        with self._lock:
+            gathered_at, facts = self._facts.get(node, (0, None))
+        if facts is not None and self.clock() - gathered_at < self.ttl:
+            return facts
+
+        facts = gather()
+        with self._lock:
+            self._facts[node] = (self.clock(), facts)
+        return facts
+
+    def invalidate(self, node):
+        with self._lock:
+            self._facts.pop(node, None)
+
+    def clear(self):
+        with self._lock:
+            self._facts = {}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_fact_cache(config):
+    """Process wide fact cache, kept for as long as the config's facts_ttl says"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FactCache(herd.config.facts_ttl(config))
+        else:
+            _cache.ttl = herd.config.facts_ttl(config)
+        return _cache
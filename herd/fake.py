@@ -0,0 +1,430 @@
+"""
+Stand-ins for a cloud provider and for the nodes' sshd, so herd can be
+exercised end to end (and benchmarked) without any real machines.
+
+FakeCloud keeps droplets in memory and answers the calls of
+herd.api.DigitalOceanClient. The "fake" provider (FakeClusterManager, see
+herd.cluster) runs the same cluster management code against it.
+
+FakeSSHServer is a paramiko server listening on one loopback address per
+node (all of 127.0.0.0/8 is local on Linux). It runs no commands: Scripts get
+their status markers answered, scp uploads are acknowledged and counted, and
+everything else succeeds with no output, after a configurable latency and
+with a configurable chance of failing.
+"""
+import ipaddress
+import itertools
+import logging
+import random
+import re
+import selectors
+import socket
+import threading
+import time
+
+import paramiko
+
+from herd.api import APIException
+from herd.api import Droplet
+from herd.api import Size
+
+
+DEFAULT_SIZES = [
+    Size('s-1vcpu-1gb', 1, 1024, 25, 5),
+    Size('s-2vcpu-2gb', 2, 2048, 60, 15),
+    Size('s-4vcpu-8gb', 4, 8192, 160, 40),
+]
+
+# Actions finish by the time their call returns
+COMPLETED = {'id': 0, 'status': 'completed'}
+
+
+class _FakeDroplet(object):
+
+    def __init__(self, id, name, size_slug, ip_address, ready_at, tags):
+        self.id = id
+        self.name = name
+        self.size_slug = size_slug
+        self.ip_address = ip_address
+        self.ready_at = ready_at
+        self.tags = tuple(tags)
+        self.status = 'new'
+
+    def snapshot(self):
+        return Droplet(
+            self.id, self.name, self.status, self.size_slug,
+            self.ip_address, self.ip_address, self.tags,
+        )
+
+
+class FakeCloud(object):
+    """
+    Answers the same calls as herd.api.DigitalOceanClient
+
+    :name: registry name, see fake_cloud
+    :addresses: list of IPs handed to new droplets, i.e. FakeSSHServer's
+    :api_latency: seconds every API call takes
+    :api_failure_rate: chance an API call is throttled
+    :boot_time: seconds a droplet stays 'new' after being created
+    """
+
+    def __init__(
+        self, name='default', addresses=(), api_latency=0, api_failure_rate=0,
+        boot_time=0, sizes=None, seed=None,
+    ):
+        self.name = name
+        self.free_addresses = list(addresses)
+        self.api_latency = api_latency
+        self.api_failure_rate = api_failure_rate
+        self.boot_time = boot_time
+        self.sizes = sizes or DEFAULT_SIZES
+        self.droplets = {}  # id -> _FakeDroplet
+        self.calls = []  # (action, args, finished_at)
+        self._ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, action, *args):
+        time.sleep(self.api_latency)
+        with self._lock:
+            if self._random.random() < self.api_failure_rate:
+                raise APIException(429, 'API rate limit exceeded')
+            result = getattr(self, '_' + action)(*args)
+            self.calls.append((action, args, time.time()))
+            return result
+
+    def _list(self, tag):
+        now = time.time()
+        snapshots = []
+        for droplet in self.droplets.values():
+            if droplet.status == 'new' and droplet.ready_at <= now:
+                droplet.status = 'active'
+            if tag is None or tag in droplet.tags:
+                snapshots.append(droplet.snapshot())
+        return snapshots
+
+    def _create(self, name, size, tags=()):
+        if not self.free_addresses:
+            raise ValueError('Fake cloud {} is out of addresses'.format(self.name))
+        droplet = _FakeDroplet(
+            next(self._ids), name, size, self.free_addresses.pop(0),
+            time.time() + self.boot_time, tags,
+        )
+        self.droplets[droplet.id] = droplet
+        return droplet.snapshot()
+
+    def _rename(self, droplet_id, name):
+        self.droplets[droplet_id].name = name
+        return COMPLETED
+
+    def _destroy(self, droplet_id):
+        droplet = self.droplets.pop(droplet_id)
+        self.free_addresses.append(droplet.ip_address)
+
+    def _shutdown(self, droplet_id):
+        self.droplets[droplet_id].status = 'off'
+        return COMPLETED
+
+    def _resize(self, droplet_id, size):
+        droplet = self.droplets[droplet_id]
+        if droplet.status != 'off':
+            raise APIException(422, 'Droplet {} must be off to be resized'.format(droplet.name))
+        droplet.size_slug = size
+        return COMPLETED
+
+    def _power_on(self, droplet_id):
+        self.droplets[droplet_id].status = 'active'
+        return COMPLETED
+
+    def add_nodes(self, cluster, count, size='s-1vcpu-1gb'):
+        """Droplets that already exist and are up, named <cluster>1..count"""
+        with self._lock:
+            for idx in range(1, count + 1):
+                droplet = self._create('{}{}'.format(cluster, idx), size)
+                self.droplets[droplet.id].status = 'active'
+
+    # The calls of herd.api.DigitalOceanClient
+
+    def list_droplets(self, tag=None):
+        return self.call('list', tag)
+
+    def list_sizes(self, etag=None):
+        return list(self.sizes), None
+
+    def list_regions(self, etag=None):
+        return [], None
+
+    def list_images(self, etag=None):
+        return [], None
+
+    def create_droplet(self, name, size, tags=(), **kwargs):
+        return self.call('create', name, size, tags)
+
+    def destroy(self, droplet_id):
+        self.call('destroy', droplet_id)
+
+    def rename(self, droplet_id, name):
+        return self.call('rename', droplet_id, name)
+
+    def shutdown(self, droplet_id):
+        return self.call('shutdown', droplet_id)
+
+    def power_on(self, droplet_id):
+        return self.call('power_on', droplet_id)
+
+    def resize(self, droplet_id, size_slug):
+        return self.call('resize', droplet_id, size_slug)
+
+    def wait_for_action(self, action, **kwargs):
+        return action['status'] == 'completed'
+
+
+_clouds = {}
+
+
+def register_cloud(cloud):
+    _clouds[cloud.name] = cloud
+    return cloud
+
+
+def fake_cloud(name):
+    if name not in _clouds:
+        register_cloud(FakeCloud(name))
+    return _clouds[name]
+
+
+def loopback_addresses(count, start=2):
+    """127.0.0.2 onwards, skipping 127.0.0.1 so a real sshd never answers"""
+    first = int(ipaddress.IPv4Address('127.0.0.0')) + start
+    return [str(ipaddress.IPv4Address(first + idx)) for idx in range(count)]
+
+
+# Readiness probes hang up right after the banner, which the server side
+# would otherwise log as an error with a traceback every time
+TRANSPORT_LOG = 'herd.fake.transport'
+logging.getLogger(TRANSPORT_LOG).addHandler(logging.NullHandler())
+logging.getLogger(TRANSPORT_LOG).propagate = False
+
+SCRIPT_MARKER = re.compile(r"printf '(\S+ \d+) %d\\n'")
+
+
+class _Interface(paramiko.ServerInterface):
+
+    def __init__(self, server, address):
+        self.server = server
+        self.address = address
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(
+            target=self.server.exec_command,
+            args=(self.address, channel, command.decode('utf-8')),
+        )
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class _ChannelReader(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.buffer = b''
+
+    def _fill(self):
+        data = self.channel.recv(65536)
+        if not data:
+            raise EOFError()
+        self.buffer += data
+
+    def readline(self):
+        while b'\n' not in self.buffer:
+            self._fill()
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            self._fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class FakeSSHServer(object):
+    """
+    :addresses: loopback IPs to listen on, one per fake node
+    :port: port shared by every address, 0 picks a free one
+    :latency: seconds every command takes
+    :failure_rate: chance a command exits non zero
+    :connect_failure_rate: chance a connection is dropped before the handshake
+    """
+
+    def __init__(
+        self, addresses, port=0, latency=0, failure_rate=0,
+        connect_failure_rate=0, seed=None,
+    ):
+        self.addresses = list(addresses)
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.connect_failure_rate = connect_failure_rate
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.commands = []  # (address, command)
+        self.received = {}  # address -> bytes uploaded, over scp or piped in
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._listeners = []
+        self._transports = []
+        self._running = False
+
+    def _chance(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def start(self):
+        for address in self.addresses:
+            listener = socket.socket()
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((address, self.port))
+            listener.listen(128)
+            listener.setblocking(False)
+            # Every address shares the port the first one was given
+            self.port = listener.getsockname()[1]
+            self._listeners.append(listener)
+            self._selector.register(listener, selectors.EVENT_READ, address)
+
+        self._running = True
+        thread = threading.Thread(target=self._accept_loop)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        for listener in self._listeners:
+            self._selector.unregister(listener)
+            listener.close()
+        self._listeners = []
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                events = self._selector.select(timeout=0.1)
+            except (OSError, ValueError):
+                return
+            for key, _ in events:
+                try:
+                    sock, _ = key.fileobj.accept()
+                except (BlockingIOError, OSError):
+                    continue
+                if self._chance(self.connect_failure_rate):
+                    sock.close()
+                    continue
+                # The handshake blocks, don't hold up other connections
+                thread = threading.Thread(target=self._serve, args=(sock, key.data))
+                thread.daemon = True
+                thread.start()
+
+    def _serve(self, sock, address):
+        sock.setblocking(True)
+        transport = paramiko.Transport(sock)
+        transport.set_log_channel(TRANSPORT_LOG)
+        transport.add_server_key(self.host_key)
+        with self._lock:
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=_Interface(self, address))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def exec_command(self, address, channel, command):
+        with self._lock:
+            self.commands.append((address, command))
+
+        try:
+            if command.startswith('scp '):
+                status = self._scp_sink(address, channel)
+            else:
+                # Whatever was piped in (tar streams, ...) is counted and dropped
+                piped = 0
+                data = channel.recv(65536)
+                while data:
+                    piped += len(data)
+                    data = channel.recv(65536)
+                with self._lock:
+                    self.received[address] = self.received.get(address, 0) + piped
+                time.sleep(self.latency)
+                stdout, status = self.respond(command)
+                channel.sendall(stdout.encode('utf-8'))
+                if status:
+                    channel.sendall_stderr(b'simulated failure\n')
+            channel.send_exit_status(status)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            try:
+                channel.close()
+            except (EOFError, OSError, paramiko.SSHException):
+                # The server was stopped under us
+                pass
+
+    def respond(self, command):
+        """
+        :return: (stdout, exit status) for a command
+        """
+        failed = self._chance(self.failure_rate)
+        markers = SCRIPT_MARKER.findall(command)
+        if not markers:
+            return '', 1 if failed else 0
+
+        # Answer a Script's markers, failing its first command if need be
+        if failed:
+            return '{} 1\n'.format(markers[0]), 1
+        return ''.join('{} 0\n'.format(marker) for marker in markers), 0
+
+    def _scp_sink(self, address, channel):
+        reader = _ChannelReader(channel)
+        received = 0
+        channel.sendall(b'\0')
+        while True:
+            try:
+                line = reader.readline()
+            except EOFError:
+                break
+            if line.startswith(b'C'):
+                size = int(line.split(b' ')[1])
+                channel.sendall(b'\0')
+                received += size
+                reader.read(size + 1)  # file content plus a trailing \0
+            channel.sendall(b'\0')
+
+        time.sleep(self.latency)
+        with self._lock:
+            self.received[address] = self.received.get(address, 0) + received
+        if self._chance(self.failure_rate):
+            return 1
+        return 0
@@ -0,0 +1,149 @@
+from collections import namedtuple
+from concurrent import futures
+
+
+class TaskDependencyException(Exception):
+    pass
+
+
+def normalize_dependencies(task_config):
+    dependencies = task_config.get('dependencies', [])
+    if isinstance(dependencies, str):
+        dependencies = [dependencies]
+    return tuple(dependencies)
+
+
+class TaskGraph(object):
+    """
+    Dependency graph over every configured task. Built once per config load,
+    it validates that all dependencies exist and that there are no cycles
+    (of any length), and keeps a topological order of the tasks around.
+
+    :tasks: dict of task name -> task config, as found under [tasks]
+    """
+
+    def __init__(self, tasks):
+        self.dependencies = {
+            name: normalize_dependencies(task_config)
+            for name, task_config in tasks.items()
+        }
+
+        for name, dependencies in self.dependencies.items():
+            for dep in dependencies:
+                if dep not in self.dependencies:
+                    raise TaskDependencyException(
+                        'Task {} depends on unknown task {}'.format(name, dep)
+                    )
+
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        order = []
+        state = {}  # name -> 'visiting' | 'done'
+
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                cycle = path[path.index(name):] + [name]
+                raise TaskDependencyException(
+                    'Dependency cycle: {}'.format(' -> '.join(cycle))
+                )
+
+            state[name] = 'visiting'
+            for dep in self.dependencies[name]:
+                visit(dep, path + [name])
+            state[name] = 'done'
+            order.append(name)
+
+        for name in sorted(self.dependencies):
+            visit(name, [])
+
+        return tuple(order)
+
+    def closure(self, roots):
+        """
+        :param roots: list of task names
+        :return: tuple of the roots and everything they depend on, each task
+            once, dependencies before dependents and otherwise in the order
+            the roots are listed
+        """
+        order = []
+        seen = set()
+
+        def visit(name):
+            if name in seen:
+                return
+            if name not in self.dependencies:
+                raise TaskDependencyException('Unknown task {}'.format(name))
+            seen.add(name)
+            for dep in self.dependencies[name]:
+                visit(dep)
+            order.append(name)
+
+        for root in roots:
+            visit(root)
+        return tuple(order)
+
+
+class TaskPlan(namedtuple('TaskPlan', ['tasks', 'dependencies', 'commands'])):
+    """
+    What to run on every node of a cluster
+
+    :tasks: tuple of task names, dependencies before dependents
+    :dependencies: dict of task name -> tuple of task names it waits for
+    :commands: dict of task name -> list of Commands
+    """
+
+    @classmethod
+    def from_commands(cls, commands, name='commands'):
+        return cls((name,), {name: ()}, {name: list(commands)})
+
+
+def as_plan(commands):
+    if isinstance(commands, TaskPlan):
+        return commands
+    return TaskPlan.from_commands(commands)
+
+
+def run_plan(plan, run_task, max_parallel=1):
+    """
+    Run every task of a plan as soon as its dependencies are done, with up
+    to max_parallel independent tasks at a time. After a failure no new
+    tasks are started; running ones finish and the first error is raised.
+
+    :param run_task: callable taking a task name
+    """
+    if len(plan.tasks) == 1 or max_parallel <= 1:
+        for task in plan.tasks:
+            run_task(task)
+        return
+
+    waiting = list(plan.tasks)
+    finished = set()
+    running = {}
+    error = None
+
+    with futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while waiting or running:
+            if error is None:
+                for task in [
+                    t for t in waiting
+                    if all(dep in finished for dep in plan.dependencies[t])
+                ]:
+                    waiting.remove(task)
+                    running[executor.submit(run_task, task)] = task
+
+            if not running:
+                break
+
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    finished.add(task)
+
+    if error is not None:
+        raise error
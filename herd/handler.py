@@ -1,49 +1,413 @@
 from __future__ import print_function  # Sadly, fixes a flake8 issue
 
+import os
+import posixpath
+import selectors
+import shlex
+import threading
+from collections import Counter
+from collections import deque
 from collections import namedtuple
 from concurrent import futures
 
 import paramiko
+from paramiko.agent import Agent
+from paramiko.agent import AgentRequestHandler
 from scp import SCPClient
 
 import herd.config
+import herd.timing
 from herd.cluster import manager_for_cluster
+from herd.delta import link_command
+from herd.delta import link_lines
+from herd.delta import parse_remote_digests
+from herd.delta import store_query_command
+from herd.delta import store_upload_command
+from herd.delta import tree_unpack_command
+from herd.delta import unpack_command
+from herd.delta import write_blob_tar
+from herd.delta import write_tar
+from herd.delta import write_tree_tar
+from herd.facts import GATHER_COMMAND
+from herd.facts import get_fact_cache
+from herd.facts import parse_facts
+from herd.graph import as_plan
+from herd.graph import run_plan
+from herd.output import flush_buffers
+from herd.output import line_buffers
+from herd.output import read_available
+from herd.output import MultiSink
+from herd.output import sink_for_config
+from herd.output import STDOUT
+from herd.pool import get_pool
+from herd.pool import PoolKey
+from herd.readiness import ReadinessTracker
+from herd.scheduler import get_scheduler
+from herd.timing import span
+
+
+POLL_INTERVAL = 1
+# What ssh exits with when it couldn't connect or authenticate
+SSH_ERROR_STATUS = 255
+# Relays to a target that failed from this many holders blame the target
+RELAY_ATTEMPTS = 2
+
+
+class CommandStatus(namedtuple('CommandStatus', ['command', 'status'])):
+    """Exit status of a single command that ran as part of a Script"""
+
+
+class CommandFailedException(Exception):
+
+    def __init__(self, command, status):
+        super(CommandFailedException, self).__init__(
+            '{} exited with status {}'.format(command, status)
+        )
+        self.command = command
+        self.status = status
+
+
+class ClusterExecutionException(Exception):
+
+    def __init__(self, cluster, failures):
+        """
+        :param failures: dict of node name -> exception it failed with
+        """
+        super(ClusterExecutionException, self).__init__(
+            'Commands failed on {} of cluster {}: {}'.format(
+                ', '.join(sorted(failures)), cluster,
+                '; '.join('{}: {}'.format(n, e) for n, e in sorted(failures.items())),
+            )
+        )
+        self.cluster = cluster
+        self.failures = failures
+
+
+def format_failures(cluster, failures):
+    """One line per node, as raised in a ClusterExecutionException"""
+    return '\n'.join(
+        '{} ({}): FAILED {}'.format(node, cluster, error)
+        for node, error in sorted(failures.items())
+    )
+
+
+def report(sink, node, out):
+    """
+    :param out: an OutputLine, or a CommandStatus
+    """
+    if isinstance(out, CommandStatus):
+        sink.status(node, out.command, out.status)
+    else:
+        sink.line(node, out)
+
+
+def finish_node(sink, node, error, failures):
+    sink.finish(node, error)
+    if error is not None:
+        failures[node] = error
+
+
+class MultiClusterExecutionException(Exception):
+
+    def __init__(self, failures):
+        """
+        :param failures: dict of cluster name -> exception it failed with
+        """
+        super(MultiClusterExecutionException, self).__init__(
+            'Commands failed on clusters {}'.format(', '.join(sorted(failures)))
+        )
+        self.failures = failures
 
 
 class ClusterExecutor(namedtuple('ClusterExecutor', [])):
 
     @staticmethod
-    def execute(commands, config, manager, node):
-        handler = NodeHandler.connect(config, manager.ip_for_node(node))
-        for command in commands:
-            print("Executing {} on {}".format(command.command, node))
-            for out in command.run(handler):
-                print("{}: {}".format(node, out))
+    def execute(plan, config, manager, node, sink):
+        with span(herd.timing.CONNECT, 'connect', node):
+            handler = NodeHandler.connect(config, manager.ip_for_node(node))
+
+        def run_task(task):
+            for command in plan.commands[task]:
+                sink.info(node, "Executing {} on {}".format(command, node))
+                with span(command.phase, command, node):
+                    for out in command.run(handler):
+                        report(sink, node, out)
+                sink.step_done(node, command)
+
+        try:
+            plan = skip_satisfied_commands(config, plan, handler, node, sink)
+            run_plan(plan, run_task, herd.config.parallel_tasks(config))
+        except CommandFailedException:
+            # The command failed, the connection is fine
+            handler.release()
+            raise
+        except Exception:
+            handler.discard()
+            raise
+        else:
+            handler.release()
 
     @staticmethod
-    def execute_parallel(config, command, cluster, max_workers=None):
+    def execute_parallel(config, commands, cluster, max_workers=None, journal=None):
+        """
+        Run commands on every node in a cluster. Each node works through
+        the whole plan on its own, without waiting on other nodes, and stops
+        at its first failing command.
+
+        :param commands: list of Commands, or a TaskPlan
+        :param max_workers: worker threads for the thread backend. How many
+            sessions actually run at once is up to the process wide
+            SessionScheduler
+        :param journal: herd.journal.RunJournal to record every command's
+            outcome in, and to tell what is left to do on each node
+        :raises: ClusterExecutionException naming every node that failed
+        """
+        # Imported here, herd.script builds on herd.command which needs us
+        from herd.script import compile_plan
+
+        plan = compile_plan(as_plan(commands))
+        backend = herd.config.executor_backend(config)
+        if backend == 'asyncio':
+            # Imported here, herd.aio itself depends on this module
+            from herd.aio import AsyncClusterExecutor
+            return AsyncClusterExecutor.execute_parallel(config, plan, cluster, journal)
+        elif backend != 'thread':
+            raise ValueError(
+                'executor must be one of thread, asyncio, not {}'.format(backend)
+            )
+
         if not max_workers:
-            max_workers = herd.config.parallel_connections(config) or 4
+            max_workers = herd.config.max_sessions(config)
 
         manager = manager_for_cluster(config, cluster)
-        manager.wait_for_ready(cluster)
         nodes = manager.node_names(cluster)
 
         if not nodes:
             return
 
-        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_node = {
-                executor.submit(ClusterExecutor.execute, command, config, manager, node): node
-                for node in nodes
+        # Workers only hold threads, sessions are handed out by the
+        # scheduler shared with every other cluster running in this process
+        scheduler = get_scheduler(config)
+
+        def execute_node(node):
+            node_plan = plan if journal is None else journal.node_plan(node)
+            if journal is not None and not any(node_plan.commands.values()):
+                # Done in the run being resumed
+                return
+            with scheduler.session(cluster, node):
+                ClusterExecutor.execute(node_plan, config, manager, node, sink)
+
+        sink = sink_for_config(config)
+        if journal is not None:
+            sink = MultiSink([sink, journal.sink()])
+        failures = {}
+        try:
+            with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Nodes are handed off one by one as they become reachable
+                ready = ReadinessTracker.for_config(config, manager).ready_nodes(nodes)
+                for node, error in ready:
+                    if error is not None:
+                        finish_node(sink, node, error, failures)
+                        continue
+
+                    future = executor.submit(execute_node, node)
+                    future.add_done_callback(
+                        lambda f, node=node: finish_node(sink, node, f.exception(), failures)
+                    )
+        finally:
+            sink.close()
+
+        if failures:
+            raise ClusterExecutionException(cluster, failures)
+
+    @staticmethod
+    def execute_clusters(config, commands, clusters, journal=None):
+        """
+        execute_parallel on several clusters at once, all of them drawing
+        on the same session budget, and sharing journal if there is one
+
+        :raises: MultiClusterExecutionException naming every cluster that failed
+        """
+        if len(clusters) == 1:
+            return ClusterExecutor.execute_parallel(
+                config, commands, clusters[0], journal=journal,
+            )
+
+        failures = {}
+        with futures.ThreadPoolExecutor(max_workers=len(clusters)) as executor:
+            future_to_cluster = {
+                executor.submit(
+                    ClusterExecutor.execute_parallel, config, commands, cluster,
+                    journal=journal,
+                ): cluster
+                for cluster in clusters
             }
-            for future in futures.as_completed(future_to_node):
-                print("COMPLETED commands on {}".format(future_to_node[future]))
+            for future in futures.as_completed(future_to_cluster):
+                if future.exception() is not None:
+                    failures[future_to_cluster[future]] = future.exception()
+
+        if failures:
+            raise MultiClusterExecutionException(failures)
+
+    @staticmethod
+    def copy_parallel(
+        config, src, dest, cluster, recursive=False, sync=False, compress=False,
+        fanout=False,
+    ):
+        """
+        Copy src to dest on every node in a cluster, see Copy for sync and
+        compress
+
+        :param fanout: upload once to a seed node and let nodes that already
+            have the copy relay it to the rest over the private network, so
+            the local uplink carries it once and the number of rounds grows
+            with log N instead of N
+        """
+        # Imported here, herd.command needs this module
+        from herd.command import parse_command
+
+        copy_command = parse_command('copy', {
+            'src': src,
+            'dest': dest,
+            'recursive': recursive,
+            'sync': sync,
+            'compress': compress,
+        })
+        if not fanout:
+            return ClusterExecutor.execute_parallel(config, [copy_command], cluster)
+
+        if not Agent().get_keys():
+            raise ValueError(
+                'Fan-out copies need an ssh-agent holding the key for the '
+                'cluster, so nodes can authenticate to each other'
+            )
+
+        manager = manager_for_cluster(config, cluster)
+        failures = manager.wait_for_ready(cluster)
+        nodes = [node for node in manager.node_names(cluster) if node not in failures]
+
+        if not nodes:
+            if failures:
+                raise ClusterExecutionException(cluster, failures)
+            return
+
+        max_workers = herd.config.max_sessions(config)
+        sink = sink_for_config(config)
+        try:
+            seed = nodes[0]
+            sink.info(seed, "Seeding {} to {}".format(src, seed))
+            seed_error = None
+            try:
+                # Only what the copy wrote is relayed, not all of dest
+                seed_handler = NodeHandler.connect(config, manager.ip_for_node(seed))
+                try:
+                    path = copy_target(seed_handler, src, dest)
+                finally:
+                    seed_handler.release()
+                ClusterExecutor.execute(
+                    as_plan([copy_command]), config, manager, seed, sink,
+                )
+            except Exception as e:
+                seed_error = e
+            finish_node(sink, seed, seed_error, failures)
+
+            if seed_error is None:
+                ClusterExecutor.relay_tree(
+                    config, manager, seed, nodes[1:], path, max_workers, sink, failures,
+                    upload=lambda node: ClusterExecutor.execute(
+                        as_plan([copy_command]), config, manager, node, sink,
+                    ),
+                )
+            else:
+                for node in nodes[1:]:
+                    failures[node] = seed_error
+        finally:
+            sink.close()
+
+        if failures:
+            raise ClusterExecutionException(cluster, failures)
+
+    @staticmethod
+    def relay_tree(
+        config, manager, seed, targets, path, max_workers, sink, failures, upload=None,
+    ):
+        """
+        Every node holding a finished copy serves one more node at a time, so
+        the set of holders roughly doubles each round. A holder that fails to
+        serve gets no more targets, its target goes to another holder.
+
+        :param upload: callable copying path to a node straight from here,
+            for targets left with no holder to relay from
+        """
+        user = herd.config.ssh_user(config)
+        holders = deque([seed])
+        pending = deque(targets)
+        running = {}
+        attempts = Counter()
+
+        def relay_to(source, target):
+            handler = NodeHandler.connect(config, manager.ip_for_node(source))
+            try:
+                with span(herd.timing.COPY, 'relay {} from {}'.format(path, source), target):
+                    relay(
+                        handler, path,
+                        manager.private_ip_for_node(target) or manager.ip_for_node(target),
+                        user,
+                    )
+            finally:
+                handler.release()
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                while holders and pending and len(running) < max_workers:
+                    source, target = holders.popleft(), pending.popleft()
+                    sink.info(target, "Relaying {} from {} to {}".format(path, source, target))
+                    running[executor.submit(relay_to, source, target)] = (source, target)
+
+                if not running:
+                    # Every holder failed to serve, nothing left to relay from
+                    break
+
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    source, target = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        holders.extend([source, target])
+                        finish_node(sink, target, None, failures)
+                        continue
+
+                    attempts[target] += 1
+                    if target_unreachable(error) or attempts[target] >= RELAY_ATTEMPTS:
+                        # The target's fault, not the source's
+                        holders.append(source)
+                        finish_node(sink, target, error, failures)
+                    else:
+                        sink.info(target, "{} failed to relay to {}: {}".format(
+                            source, target, error,
+                        ))
+                        pending.appendleft(target)
+
+        if not pending:
+            return
+        if upload is None:
+            for target in pending:
+                finish_node(sink, target, RuntimeError('No node left to relay from'), failures)
+            return
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for target in pending:
+                sink.info(target, "No node left to relay from, uploading {} to {}".format(
+                    path, target,
+                ))
+            uploads = {executor.submit(upload, target): target for target in pending}
+            for future in futures.as_completed(uploads):
+                finish_node(sink, uploads[future], future.exception(), failures)
 
 
 class NodeHandler(namedtuple(
     'NodeHandler',
-    ['client', 'ip_address'],
+    ['client', 'ip_address', 'pool_key', 'pool', 'config'],
 )):
     """
     A NodeHandler executes SSH commands against a machine.
@@ -51,33 +415,151 @@ class NodeHandler(namedtuple(
     It's designed to be thread safe to run ssh commands in parallel. Turns
     out being immutable makes parallel super crazily easy
 
+    Clients are drawn from a process wide ConnectionPool, so hand them back
+    with `release` (or `discard` if something went wrong mid-command)
+
     :client: a paramiko SSHClient connection
-    :cluster_manager: cluster manager for node
-    :node_name: node name of node to talk to
+    :ip_address: address of the node to talk to
+    :pool_key: PoolKey the client was checked out under
+    :pool: ConnectionPool the client belongs to
+    :config: herd config the node is handled under
     """
 
     @classmethod
     def connect(cls, config, ip_address):
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
+        pool = get_pool(
+            lambda key: open_client(config, key),
+            max_connections=herd.config.max_open_connections(config),
+            idle_timeout=herd.config.connection_idle_timeout(config),
+            settings=config['ssh'].get('password'),
+        )
+        key = PoolKey(
             ip_address,
-            key_filename=config['ssh']['path'],
-            password=config['ssh']['password'],
-            username='root',  # TODO this is clearly suboptimal
+            herd.config.ssh_user(config),
+            config['ssh']['path'],
+            herd.config.ssh_port(config),
         )
 
-        return cls(client, ip_address)
+        return cls(pool.acquire(key), ip_address, key, pool, config)
+
+    def release(self):
+        self.pool.release(self.pool_key, self.client)
+
+    def discard(self):
+        self.pool.discard(self.client)
+
+
+def open_client(config, key):
+    """
+    :param config: herd config, for the key passphrase
+    :param key: PoolKey describing who to connect to and how
+    :return: a connected paramiko SSHClient
+    """
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        key.ip_address,
+        key_filename=key.key_filename,
+        password=config['ssh'].get('password'),
+        username=key.username,
+        port=key.port,
+    )
+
+    return client
 
 
 def execute(handler, command):
     """
+    Yields OutputLines from stdout and stderr as they arrive
+
     :param client: NodeHandler
     :command: string, command to execute on remote machine
+    :raises: CommandFailedException if the command exits non-zero
+    """
+    channel = handler.client.get_transport().open_session()
+    # Not select.select, which can't take descriptors past FD_SETSIZE (1024)
+    selector = selectors.DefaultSelector()
+    try:
+        channel.exec_command(command)
+        channel.shutdown_write()
+        selector.register(channel, selectors.EVENT_READ)
+        buffers = line_buffers()
+        while True:
+            lines = read_available(channel, buffers)
+            for line in lines:
+                yield line
+
+            if not lines:
+                if channel.exit_status_ready() and not (
+                    channel.recv_ready() or channel.recv_stderr_ready()
+                ):
+                    break
+                # Channels signal new data and closing through their fileno
+                selector.select(POLL_INTERVAL)
+
+        for line in flush_buffers(buffers):
+            yield line
+        status = channel.recv_exit_status()
+    finally:
+        selector.close()
+        channel.close()
+
+    if status != 0:
+        raise CommandFailedException(command, status)
+
+
+def gather_facts(handler):
+    """
+    :param client: NodeHandler
+    :return: herd.facts.NodeFacts, collected in one remote call
+    """
+    return parse_facts(
+        line.text for line in execute(handler, GATHER_COMMAND) if line.stream == STDOUT
+    )
+
+
+def skip_satisfied_commands(config, plan, handler, node, sink):
+    """
+    Drop what the node's facts say is already done from a compiled plan.
+    Facts are cached per node, and forgotten as soon as anything is left
+    to run since that may well change them. Plans no fact could shorten,
+    like exec and copy, don't gather them at all.
     """
-    _, stdout, stderr = handler.client.exec_command(command)
-    for line in stdout:
-        yield line.rstrip()
+    # Imported here, herd.script builds on herd.command which needs us
+    from herd.script import may_be_satisfied
+    from herd.script import skip_satisfied
+
+    if not herd.config.gather_facts(config) or not may_be_satisfied(plan):
+        return plan
+
+    def gather():
+        with span(herd.timing.FACTS, 'gather facts', node):
+            return gather_facts(handler)
+
+    cache = get_fact_cache(config)
+    plan, skipped = skip_satisfied(plan, cache.get(handler.ip_address, gather))
+    for command in skipped:
+        sink.info(node, "Skipping {} on {}, already done".format(command, node))
+    if any(plan.commands.values()):
+        cache.invalidate(handler.ip_address)
+    return plan
+
+
+def copy_target(handler, src, dest):
+    """
+    Where copying src to dest puts it on the node, the way scp decides: in
+    dest if that is a directory (or ends in a slash), as dest otherwise
+
+    :param client: NodeHandler
+    """
+    name = os.path.basename(os.path.normpath(src))
+    if dest.endswith('/'):
+        return posixpath.join(dest, name)
+    is_dir = any(
+        line.stream == STDOUT and line.text == 'dir'
+        for line in execute(handler, 'if [ -d {} ]; then echo dir; fi'.format(shlex.quote(dest)))
+    )
+    return posixpath.join(dest, name) if is_dir else dest
 
 
 def copy(handler, src, dest, recursive=False):
@@ -85,8 +567,181 @@ def copy(handler, src, dest, recursive=False):
     :param client: NodeHandler
     :param src: source file path (local)
     :param dest: destination file path (remote)
-    :recursive: folder + all subfolders, files?
+    :recursive: folder + all subfolders, files? Folders go over as one
+        tar stream, see herd.delta.write_tree_tar
     """
+    if recursive and os.path.isdir(src):
+        stream(handler, tree_unpack_command(src, dest), lambda stdin: write_tree_tar(stdin, src))
+        return
+
     # Context manager doesnt work properly? try later -_-
     scp = SCPClient(handler.client.get_transport())
     scp.put(src, dest, recursive=recursive)
+
+
+def stream(handler, command, write):
+    """
+    Run a command on the node, feeding its stdin from another thread while
+    its output is read, so neither side can stall the other
+
+    :param write: callable taking the channel's stdin file
+    :return: list of lines it printed, stderr included
+    :raises: CommandFailedException if the command exits non-zero, or
+        whatever write raised
+    """
+    channel = handler.client.get_transport().open_session()
+    errors = []
+
+    def feed():
+        try:
+            stdin = channel.makefile('wb')
+            write(stdin)
+            stdin.close()
+            channel.shutdown_write()
+        except Exception as e:
+            errors.append(e)
+            # Closing rather than sending EOF, the command mustn't take what
+            # was written so far as all there is, and reading its output
+            # must not wait on it
+            channel.close()
+
+    try:
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        output = channel.makefile('rb').read()
+        feeder.join()
+        if errors:
+            raise errors[0]
+        status = channel.recv_exit_status()
+    finally:
+        channel.close()
+
+    if status != 0:
+        raise CommandFailedException(command, status)
+    return output.decode('utf-8', 'replace').splitlines()
+
+
+def write_lines(lines):
+    return lambda stdin: stdin.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+
+
+def remote_changed(handler, manifest):
+    """
+    :return: sorted list of the manifest's relative paths whose content
+        differs on the node
+    """
+    remote_digests = parse_remote_digests(
+        line.text
+        for line in execute(handler, manifest.remote_digest_command())
+        if line.stream == STDOUT
+    )
+    return manifest.changed(remote_digests)
+
+
+def sync(handler, manifest, compress=False):
+    """
+    Copy only the files of a manifest whose content differs on the node
+
+    :param client: NodeHandler
+    :param manifest: herd.delta.Manifest of what should end up on the node
+    :param compress: gzip the files in flight
+    :return: list of relative paths that had to be sent
+    """
+    changed = remote_changed(handler, manifest)
+    if not changed:
+        return changed
+
+    stream(
+        handler, unpack_command(manifest.remote_dir, compress),
+        lambda stdin: write_tar(stdin, manifest, changed, compress),
+    )
+    return changed
+
+
+def cached_copy(handler, manifest, sync=False, compress=False):
+    """
+    Copy the files of a manifest through the node's content-addressed
+    store: blobs it already has, from an earlier copy or another file of
+    this one, aren't sent again. See herd.delta
+
+    :param client: NodeHandler
+    :param sync: leave alone the files whose content is already right
+    :param compress: gzip the blobs in flight
+    :return: (list of relative paths put in place, list of blobs sent)
+    """
+    relpaths = remote_changed(handler, manifest) if sync else sorted(manifest.files)
+    if not relpaths:
+        return [], []
+
+    blobs = {}
+    for relpath in relpaths:
+        blobs.setdefault(manifest.blob(relpath), relpath)
+    present = set(stream(handler, store_query_command(), write_lines(sorted(blobs))))
+    missing = {blob: relpath for blob, relpath in blobs.items() if blob not in present}
+
+    if missing:
+        stream(
+            handler, store_upload_command(compress),
+            lambda stdin: write_blob_tar(stdin, manifest, missing, compress),
+        )
+    stream(
+        handler, link_command(manifest.remote_dir),
+        write_lines(link_lines(manifest, relpaths)),
+    )
+    return relpaths, sorted(missing)
+
+
+def target_unreachable(error):
+    """Whether a relay failed because its source couldn't reach the target"""
+    return isinstance(error, CommandFailedException) and error.status == SSH_ERROR_STATUS
+
+
+def relay_command(path, target_ip, username):
+    """Streams path from the node it runs on to the same path on target_ip"""
+    parent, name = posixpath.split(path.rstrip('/'))
+    parent = parent or '/'
+    pipeline = (
+        'tar -C {parent} -cf - {name} | ssh -o StrictHostKeyChecking=no '
+        '-o UserKnownHostsFile=/dev/null -o BatchMode=yes {target} {unpack}'
+    ).format(
+        parent=shlex.quote(parent),
+        name=shlex.quote(name),
+        target=shlex.quote('{}@{}'.format(username, target_ip)),
+        unpack=shlex.quote('mkdir -p {0} && tar -xf - -C {0}'.format(shlex.quote(parent))),
+    )
+    # A tar that fails halfway still leaves ssh a well formed stream to
+    # unpack, pipefail is what makes it fail the relay. dash has no
+    # pipefail, hence bash
+    return 'bash -o pipefail -c {}'.format(shlex.quote(pipeline))
+
+
+def relay(handler, path, target_ip, username):
+    """
+    Have the node behind handler stream its copy of path to another node.
+    Authentication goes through the local ssh-agent, forwarded over this
+    session only.
+
+    :param client: NodeHandler of a node that already has path
+    :param path: remote file or directory to relay, same path on both nodes
+    :param target_ip: address the node can reach the target on, ideally private
+    """
+    command = relay_command(path, target_ip, username)
+    channel = handler.client.get_transport().open_session()
+    forwarding = AgentRequestHandler(channel)
+    try:
+        channel.exec_command(command)
+        channel.shutdown_write()
+        stderr = channel.makefile_stderr('rb').read()
+        status = channel.recv_exit_status()
+    finally:
+        forwarding.close()
+        channel.close()
+
+    if status != 0:
+        raise CommandFailedException(
+            '{} ({})'.format(command, stderr.decode('utf-8', 'replace').strip()),
+            status,
+        )
@@ -1,27 +1,59 @@
-import pytoml
-
-from herd.role import get_role_config
-from herd.task import TaskRunner
+from herd.handler import ClusterExecutor
+from herd.journal import RunJournal
+from herd.plan import compile_config
+from herd.plan import load_plan
 
 
 class Herd(object):
 
-    def __init__(self, config_filepath=None):
+    def __init__(self, config_filepath=None, config=None, plan=None):
+        """
+        :param config_filepath: path of a config file to load
+        :param config: an already parsed config, instead
+        :param plan: an already compiled herd.plan.HerdPlan, instead
+        """
         if config_filepath is not None:
-            self.load_config(config_filepath)
+            plan = load_plan(config_filepath)
+        elif config is not None:
+            plan = compile_config(config)
+        if plan is not None:
+            self.set_plan(plan)
 
     def load_config(self, filepath):
-        with open(filepath) as cfg:
-            self.config = pytoml.load(cfg)
-            self.task_runner = TaskRunner(self.config)
+        self.set_plan(load_plan(filepath))
 
-    def deploy(self, role):
+    def set_plan(self, plan):
+        self.plan = plan
+        self.config = plan.config
+
+    def deploy(self, role, resume=None):
         """
         Given a role, execute commands on all machines as specified
-        by definition
+        by definition. Every cluster of the role is deployed at once, and
+        every command's outcome on every node is journaled, see herd.journal
+
+        :param resume: id of an earlier run of the role to resume: only
+            what didn't finish or failed on each node runs again
+        :return: the run id
         """
-        role = get_role_config(self.config, role)
-        use_sudo = role.get('sudo', False)
-        cluster = role.get('clusters')[0]
-        for task in role.get('tasks'):
-            self.task_runner.execute_task(task, cluster, use_sudo)
+        role = self.plan.role(role)
+        task_plan = self.plan.task_plan(role.tasks, role.sudo)
+        if resume is None:
+            journal = RunJournal.start(self.config, task_plan, role.name, self.plan.digest)
+            print('Deploying {}, run {}'.format(role.name, journal.run_id))
+        else:
+            journal = RunJournal.resume(
+                self.config, resume, task_plan, role.name, self.plan.digest,
+            )
+            print('Resuming run {} of {}'.format(journal.run_id, role.name))
+
+        try:
+            ClusterExecutor.execute_clusters(self.config, task_plan, role.clusters, journal=journal)
+        except Exception:
+            print('Run {} failed, resume it with: herd deploy --resume {}'.format(
+                journal.run_id, journal.run_id,
+            ))
+            raise
+        finally:
+            journal.close()
+        return journal.run_id
@@ -0,0 +1,263 @@
+"""
+On-disk inventory cache shared by every herd process.
+
+Provider listings are kept per account, each resource type with its own TTL:
+catalogs (sizes, regions, images) hardly ever change and are kept for hours,
+the node list only for seconds. Anything that changes nodes invalidates the
+node list explicitly, and `refresh_all` makes the current process ignore
+whatever was cached before it started.
+
+Catalogs keep the ETag they were listed with, so once expired they are
+fetched conditionally, from any process, and cost a 304 if unchanged.
+
+Listings are written as JSON, never pickled, so a cache file can't run code
+when it is read. Namedtuple records (herd.api's Droplet, Size) go in as
+lists of their fields and come back as records for the resources they are
+registered for.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import herd.config
+
+
+DEFAULT_CACHE_DIR = '~/.cache/herd'
+DEFAULT_TTLS = {
+    'nodes': 15,
+    'sizes': 6 * 60 * 60,
+    'regions': 6 * 60 * 60,
+    'images': 6 * 60 * 60,
+}
+
+
+class InventoryCache(object):
+    """
+    :path: file the cache lives in
+    :ttls: dict of resource name -> seconds an entry stays fresh
+    :records: dict of resource name -> namedtuple class its listing is made
+        of, other listings are kept as plain JSON values
+    """
+
+    def __init__(self, path, ttls=None, records=None):
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.records = records or {}
+        self.not_before = 0
+        self._memory = {}  # resource -> (fetched_at, value, etag)
+        self._lock = threading.RLock()
+
+    def _fresh(self, resource, fetched_at):
+        ttl = self.ttls.get(resource, 0)
+        return fetched_at >= self.not_before and time.time() - fetched_at < ttl
+
+    def _read_disk(self):
+        """
+        :return: dict of resource -> [fetched_at, list of JSON values, etag]
+        """
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _decode(self, resource, value):
+        record = self.records.get(resource)
+        if record is None:
+            return value
+        # Records hold scalars and tuples, JSON gave the tuples back as lists
+        return [
+            record(*[tuple(field) if isinstance(field, list) else field for field in fields])
+            for fields in value
+        ]
+
+    def _write_disk(self, resource, entry):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+
+        # Merge with what other processes wrote since, then swap atomically
+        entries = self._read_disk()
+        if entry is None:
+            if resource not in entries:
+                return
+            del entries[resource]
+        else:
+            entries[resource] = entry
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _read_entry(self, resource):
+        """
+        :return: (fetched_at, value, etag) as cached on disk, None if it isn't
+        """
+        entry = self._read_disk().get(resource)
+        if not entry:
+            return None
+        try:
+            fetched_at, value, etag = entry
+            return fetched_at, self._decode(resource, value), etag
+        except (TypeError, ValueError):
+            # Written when the records had other fields, or before ETags
+            # were kept
+            return None
+
+    def get(self, resource, fetch, conditional=False):
+        """
+        :param fetch: callable returning a fresh list of the resource
+        :param conditional: fetch instead takes the ETag of the listing cached
+            last (None without one) and returns (fresh list, or None if
+            that listing is still current; the fresh ETag)
+        :return: the cached list if it is still fresh, else a fetched one
+        """
+        with self._lock:
+            entry = self._memory.get(resource)
+            if entry is not None and self._fresh(resource, entry[0]):
+                return entry[1]
+
+            entry = self._read_entry(resource) or entry
+            if entry is not None and self._fresh(resource, entry[0]):
+                self._memory[resource] = entry
+                return entry[1]
+
+            if not conditional:
+                return self.put(resource, fetch())
+            value, etag = fetch(entry[2] if entry is not None else None)
+            if value is None:
+                # Unchanged since it was cached, fresh again
+                value = entry[1]
+            return self.put(resource, value, etag)
+
+    def put(self, resource, value, etag=None):
+        with self._lock:
+            fetched_at = time.time()
+            self._memory[resource] = (fetched_at, value, etag)
+            self._write_disk(resource, [fetched_at, value, etag])
+            return value
+
+    def invalidate(self, *resources):
+        with self._lock:
+            for resource in resources:
+                self._memory.pop(resource, None)
+                self._write_disk(resource, None)
+
+    def refresh(self):
+        """Ignore everything cached before now"""
+        with self._lock:
+            self.not_before = time.time()
+            self._memory = {}
+
+
+NODE_NAME = re.compile(r'^(?P<cluster>.*?)(?P<index>\d+)$')
+
+
+def parse_node_name(name):
+    """
+    Nodes are named <cluster><index>, the index being every trailing digit,
+    so app10 is node 10 of cluster app and never node 0 of cluster app1
+
+    :return: (cluster name, int index), or (None, None) for foreign names
+    """
+    found = NODE_NAME.match(name)
+    if found is None or not found.group('cluster'):
+        return None, None
+    return found.group('cluster'), int(found.group('index'))
+
+
+class InventoryIndex(object):
+    """
+    Lookup tables over one node listing, built once per refresh so every
+    lookup afterwards is a dict access instead of a scan
+
+    :nodes: the node list the index was built from
+    :by_name: dict of node name -> node
+    :by_cluster: dict of cluster name -> list of nodes, ordered by index
+    :by_index: dict of cluster name -> dict of index -> node
+    :by_status: dict of status -> list of nodes
+    :by_cluster_status: dict of cluster name -> dict of status -> list of nodes
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.by_name = {}
+        self.by_cluster = {}
+        self.by_index = {}
+        self.by_status = {}
+        self.by_cluster_status = {}
+
+        for node in nodes:
+            self.by_name.setdefault(node.name, node)
+            self.by_status.setdefault(node.status, []).append(node)
+
+            cluster, index = parse_node_name(node.name)
+            if cluster is None:
+                continue
+            self.by_cluster.setdefault(cluster, []).append(node)
+            self.by_index.setdefault(cluster, {}).setdefault(index, node)
+            self.by_cluster_status.setdefault(cluster, {}).setdefault(
+                node.status, []
+            ).append(node)
+
+        for cluster_nodes in self.by_cluster.values():
+            cluster_nodes.sort(key=lambda node: (parse_node_name(node.name)[1], node.name))
+
+    def cluster_nodes(self, cluster):
+        return self.by_cluster.get(cluster, [])
+
+    def node(self, name):
+        return self.by_name.get(name)
+
+    def cluster_nodes_with_status(self, cluster, status):
+        return self.by_cluster_status.get(cluster, {}).get(status, [])
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+_refresh_requested = False
+
+
+def refresh_all():
+    """Make every cache in this process, now and later, skip older entries"""
+    global _refresh_requested
+    with _caches_lock:
+        _refresh_requested = True
+        for cache in _caches.values():
+            cache.refresh()
+
+
+def cache_for(config, provider, account, records=None):
+    """
+    Process wide cache for one provider account
+
+    :param account: secret identifying the account (e.g. API token), only a
+        hash of it is used to name the cache file
+    :param records: see InventoryCache
+    """
+    account_hash = hashlib.sha256(account.encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(
+        os.path.expanduser(herd.config.cache_dir(config) or DEFAULT_CACHE_DIR),
+        'inventory-{}-{}.json'.format(provider, account_hash),
+    )
+
+    with _caches_lock:
+        if path not in _caches:
+            cache = InventoryCache(path, herd.config.cache_ttls(config), records)
+            if _refresh_requested:
+                cache.refresh()
+            _caches[path] = cache
+        else:
+            # An agent serves commands with configs edited since
+            _caches[path].ttls = dict(DEFAULT_TTLS, **(herd.config.cache_ttls(config) or {}))
+        return _caches[path]
@@ -0,0 +1,214 @@
+"""
+A durable record of what a deploy did on every node, so one that died
+halfway, or failed on some nodes, can be resumed without redoing what
+already finished.
+
+Each run has a journal, <cache_dir>/runs/<run id>.jsonl, written as
+execution happens: a header line naming the role and the config digest,
+then one line per command outcome on a node,
+
+    {"node": "web3", "task": "nginx", "index": 1, "command": "...", "status": 0}
+
+where index is the command's position in its task. Lines are flushed as
+they are written, so the journal survives herd itself dying. Resuming a run
+appends to the same journal and runs on each node only the commands that
+aren't recorded as done there; a command whose text changed since counts
+as not done.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+import herd.config
+from herd.graph import TaskPlan
+from herd.inventory import DEFAULT_CACHE_DIR
+from herd.output import Sink
+
+
+class JournalException(Exception):
+    pass
+
+
+def run_dir(config):
+    return os.path.join(
+        os.path.expanduser(herd.config.cache_dir(config) or DEFAULT_CACHE_DIR), 'runs',
+    )
+
+
+def journal_path(config, run_id):
+    return os.path.join(run_dir(config), '{}.jsonl'.format(run_id))
+
+
+def new_run_id():
+    return '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:6])
+
+
+def read_journal(config, run_id):
+    """
+    :return: (header dict, list of outcome dicts)
+    :raises JournalException: if there is no such run
+    """
+    path = journal_path(config, run_id)
+    if not os.path.exists(path):
+        raise JournalException('No run {} in {}'.format(run_id, run_dir(config)))
+
+    header, outcomes = None, []
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Cut short by a crash mid write
+                continue
+            if 'run' in entry:
+                header = entry
+            else:
+                outcomes.append(entry)
+    if header is None:
+        raise JournalException('Run {} has no header'.format(run_id))
+    return header, outcomes
+
+
+def run_role(config, run_id):
+    """Name of the role a run deployed"""
+    return read_journal(config, run_id)[0]['role']
+
+
+class _JournalSink(Sink):
+    """Feeds command outcomes to a RunJournal; closing it leaves the journal open"""
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def status(self, node, command, status):
+        self.journal.record(node, command, status)
+
+    def step_done(self, node, step):
+        self.journal.record(node, step, 0)
+
+
+class RunJournal(object):
+    """
+    :run_id: the run's name, see new_run_id
+    :path: journal file, appended to
+    :plan: TaskPlan of the run, its Commands as handed to the executors
+    :done: set of (node, task, index, command text) already done, when
+        resuming
+    """
+
+    def __init__(self, run_id, path, plan, done=None):
+        self.run_id = run_id
+        self.path = path
+        self.plan = plan
+        self.done = set(done or ())
+        self._resumed_nodes = set(node for node, _, _, _ in self.done)
+        self._keys = {
+            id(command): (task, idx)
+            for task in plan.tasks
+            for idx, command in enumerate(plan.commands[task])
+        }
+        self._compiled = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = open(path, 'a')
+
+    @classmethod
+    def start(cls, config, plan, role, digest=None):
+        """Journal for a new run of role"""
+        run_id = new_run_id()
+        journal = cls(run_id, journal_path(config, run_id), plan)
+        journal._write({'run': run_id, 'role': role, 'config': digest, 'started': time.time()})
+        return journal
+
+    @classmethod
+    def resume(cls, config, run_id, plan, role, digest=None):
+        """
+        Journal of an earlier run of role, knowing what it already did
+
+        :raises JournalException: if the run was of another role
+        """
+        header, outcomes = read_journal(config, run_id)
+        if header['role'] != role:
+            raise JournalException('Run {} deployed role {}, not {}'.format(
+                run_id, header['role'], role,
+            ))
+        if digest is not None and header.get('config') != digest:
+            print('The config changed since run {}, changed commands run again'.format(run_id))
+
+        done = set()
+        for outcome in outcomes:
+            key = (outcome['node'], outcome['task'], outcome['index'], outcome['command'])
+            if outcome['status'] == 0:
+                done.add(key)
+            else:
+                done.discard(key)
+        return cls(run_id, journal_path(config, run_id), plan, done)
+
+    def _write(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+            self._file.flush()
+
+    def originals(self, command):
+        """
+        :return: the plan's commands a command the executors ran stands for,
+            compiled steps being made of several
+        """
+        if id(command) in self._keys:
+            return [command]
+        parts = getattr(command, 'merged', None) or getattr(command, 'commands', None) or []
+        return [original for part in parts for original in self.originals(part)]
+
+    def record(self, node, command, status):
+        for original in self.originals(command):
+            task, idx = self._keys[id(original)]
+            key = (node, task, idx, str(original))
+            with self._lock:
+                if status == 0 and key in self.done:
+                    continue
+                if status == 0:
+                    self.done.add(key)
+                else:
+                    self.done.discard(key)
+            self._write({
+                'node': node, 'task': task, 'index': idx, 'command': str(original),
+                'status': status, 'time': time.time(),
+            })
+
+    def remaining(self, node):
+        """
+        :return: TaskPlan of what is left to do on node
+        """
+        return TaskPlan(self.plan.tasks, self.plan.dependencies, {
+            task: [
+                command for idx, command in enumerate(commands)
+                if (node, task, idx, str(command)) not in self.done
+            ]
+            for task, commands in self.plan.commands.items()
+        })
+
+    def node_plan(self, node):
+        """
+        :return: compiled TaskPlan of what is left to do on node, the one
+            shared by every node that has done nothing yet
+        """
+        # Imported here, herd.script builds on herd.handler
+        from herd.script import compile_plan
+
+        if node in self._resumed_nodes:
+            return compile_plan(self.remaining(node))
+        with self._lock:
+            if self._compiled is None:
+                self._compiled = compile_plan(self.plan)
+            return self._compiled
+
+    def sink(self):
+        return _JournalSink(self)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
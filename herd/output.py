@@ -0,0 +1,424 @@
+"""
+Where command output goes.
+
+Output is read from both stdout and stderr as it arrives, split into lines by
+a bounded LineBuffer and handed to a Sink together with the node it came
+from. Sinks serialize their own writes, so any number of nodes can report at
+once without interleaving partial lines.
+
+On large clusters AggregateSink is the one to use: it prints nothing until
+the end, then each distinct output once, for every node that produced it.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from collections import namedtuple
+from collections import OrderedDict
+
+import herd.config
+from herd.inventory import parse_node_name
+
+
+MAX_LINE = 64 * 1024
+# Output AggregateSink holds in memory per node before moving it to a file
+SPILL_BYTES = 64 * 1024
+READ_SIZE = 32 * 1024
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+
+class OutputLine(namedtuple('OutputLine', ['stream', 'text'])):
+    """A line of output, from STDOUT or STDERR"""
+
+    def __str__(self):
+        return self.text
+
+
+class LineBuffer(object):
+    """
+    Splits a byte stream into lines. Anything longer than max_line without a
+    newline is passed on in max_line sized pieces, so memory stays bounded
+    no matter what a node prints.
+    """
+
+    def __init__(self, max_line=MAX_LINE):
+        self.max_line = max_line
+        self._pending = b''
+
+    def feed(self, data):
+        """
+        :return: list of complete lines (str) found so far
+        """
+        *lines, self._pending = (self._pending + data).split(b'\n')
+        while len(self._pending) > self.max_line:
+            lines.append(self._pending[:self.max_line])
+            self._pending = self._pending[self.max_line:]
+
+        return [_decode(line) for line in lines]
+
+    def flush(self):
+        """
+        :return: list with the trailing partial line, if there is one
+        """
+        pending, self._pending = self._pending, b''
+        return [_decode(pending)] if pending else []
+
+
+def _decode(line):
+    return line.decode('utf-8', 'replace').rstrip()
+
+
+def read_available(channel, buffers):
+    """
+    Drain whatever is buffered on both streams of a paramiko channel without
+    blocking. Reading stderr as eagerly as stdout keeps a chatty stderr from
+    filling the channel window and stalling the command.
+
+    :param buffers: dict of STDOUT / STDERR -> LineBuffer
+    :return: list of OutputLines
+    """
+    lines = []
+    while channel.recv_ready():
+        lines += [
+            OutputLine(STDOUT, line)
+            for line in buffers[STDOUT].feed(channel.recv(READ_SIZE))
+        ]
+    while channel.recv_stderr_ready():
+        lines += [
+            OutputLine(STDERR, line)
+            for line in buffers[STDERR].feed(channel.recv_stderr(READ_SIZE))
+        ]
+    return lines
+
+
+def flush_buffers(buffers):
+    return [
+        OutputLine(stream, line)
+        for stream in (STDOUT, STDERR)
+        for line in buffers[stream].flush()
+    ]
+
+
+def line_buffers():
+    return {STDOUT: LineBuffer(), STDERR: LineBuffer()}
+
+
+class Sink(object):
+    """Receives everything the executors have to say about a node"""
+
+    def info(self, node, message):
+        pass
+
+    def line(self, node, line):
+        """
+        :param line: OutputLine
+        """
+        pass
+
+    def status(self, node, command, status):
+        pass
+
+    def step_done(self, node, step):
+        """
+        :param step: a compiled step (Script or Copy) that ran to the end
+        """
+        pass
+
+    def finish(self, node, error):
+        """
+        :param error: what the node failed with, None if it completed
+        """
+        if error is None:
+            self.info(node, "COMPLETED commands on {}".format(node))
+        else:
+            self.info(node, "FAILED commands on {}: {}".format(node, error))
+
+    def close(self):
+        pass
+
+
+class ConsoleSink(Sink):
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def _write(self, text):
+        with self._lock:
+            self.stream.write(text + '\n')
+            self.stream.flush()
+
+    def info(self, node, message):
+        self._write(message)
+
+    def line(self, node, line):
+        self._write('{}: {}'.format(node, line.text))
+
+    def status(self, node, command, status):
+        self._write('{}: [exit {}] {}'.format(node, status, command))
+
+    def close(self):
+        if self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
+
+
+class JsonSink(Sink):
+    """One JSON object per event, for anything that wants to parse output"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def _write(self, event):
+        event['time'] = time.time()
+        text = json.dumps(event, sort_keys=True)
+        with self._lock:
+            self.stream.write(text + '\n')
+            self.stream.flush()
+
+    def info(self, node, message):
+        self._write({'event': 'info', 'node': node, 'message': message})
+
+    def line(self, node, line):
+        self._write({
+            'event': 'line', 'node': node, 'stream': line.stream, 'text': line.text,
+        })
+
+    def status(self, node, command, status):
+        self._write({
+            'event': 'status', 'node': node, 'command': str(command), 'status': status,
+        })
+
+    def close(self):
+        if self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
+
+
+class LogFileSink(Sink):
+    """
+    Writes everything about a node to <log_dir>/<node>.log, rotated once it
+    grows past max_bytes
+    """
+
+    def __init__(self, log_dir, max_bytes=10 * 1024 * 1024, backups=5):
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._handlers = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+
+    def _handler(self, node):
+        with self._lock:
+            if node not in self._handlers:
+                handler = logging.handlers.RotatingFileHandler(
+                    os.path.join(self.log_dir, '{}.log'.format(node)),
+                    maxBytes=self.max_bytes,
+                    backupCount=self.backups,
+                )
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                self._handlers[node] = handler
+            return self._handlers[node]
+
+    def _write(self, node, message):
+        self._handler(node).handle(logging.makeLogRecord({'msg': message}))
+
+    def info(self, node, message):
+        self._write(node, message)
+
+    def line(self, node, line):
+        self._write(node, '{} {}'.format(line.stream, line.text))
+
+    def status(self, node, command, status):
+        self._write(node, 'exit {} {}'.format(status, command))
+
+    def close(self):
+        with self._lock:
+            for handler in self._handlers.values():
+                handler.close()
+            self._handlers = {}
+
+
+def fold_nodes(nodes):
+    """
+    Compact list of node names, e.g. web1, web2, web3, web5 and db1 fold
+    to db1,web[1-3,5]
+    """
+    indexes = defaultdict(set)
+    others = []
+    for node in nodes:
+        cluster, index = parse_node_name(node)
+        if cluster is None:
+            others.append(node)
+        else:
+            indexes[cluster].add(index)
+
+    folded = []
+    for cluster, cluster_indexes in sorted(indexes.items()):
+        ranges = []
+        for index in sorted(cluster_indexes):
+            if ranges and ranges[-1][1] == index - 1:
+                ranges[-1][1] = index
+            else:
+                ranges.append([index, index])
+        if len(ranges) == 1 and ranges[0][0] == ranges[0][1]:
+            folded.append('{}{}'.format(cluster, ranges[0][0]))
+            continue
+        folded.append('{}[{}]'.format(cluster, ','.join(
+            str(first) if first == last else '{}-{}'.format(first, last)
+            for first, last in ranges
+        )))
+    return ','.join(folded + sorted(others))
+
+
+class _NodeOutput(object):
+    """
+    A node's output so far, and its running digest. Several tasks of a node
+    can write at once, each line goes in whole
+    """
+
+    def __init__(self, spill_bytes):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spill_bytes)
+        self.digest = hashlib.sha1()
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        data = (text + '\n').encode('utf-8')
+        with self._lock:
+            self.digest.update(data)
+            self.file.write(data)
+
+    def lines(self):
+        self.file.seek(0)
+        for line in self.file:
+            yield line.decode('utf-8')
+
+
+class AggregateSink(Sink):
+    """
+    Keeps each node's output to itself until close, then prints every
+    distinct output once under the list of nodes that produced it, as
+    clush -b does. A node's output moves from memory to a temporary file
+    once it grows past spill_bytes, so memory stays bounded however much
+    the nodes print.
+
+    Only output, exit statuses and failures are kept, progress messages
+    are dropped.
+    """
+
+    def __init__(self, stream=None, spill_bytes=SPILL_BYTES):
+        self.stream = stream or sys.stdout
+        self.spill_bytes = spill_bytes
+        self._outputs = {}
+        self._lock = threading.Lock()
+
+    def _output(self, node):
+        with self._lock:
+            if node not in self._outputs:
+                self._outputs[node] = _NodeOutput(self.spill_bytes)
+            return self._outputs[node]
+
+    def line(self, node, line):
+        self._output(node).write(line.text)
+
+    def status(self, node, command, status):
+        self._output(node).write('[exit {}] {}'.format(status, command))
+
+    def finish(self, node, error):
+        if error is not None:
+            self._output(node).write('FAILED: {}'.format(error))
+
+    def groups(self):
+        """
+        :return: list of (node names, _NodeOutput) for each distinct output
+        """
+        by_digest = OrderedDict()
+        for node, output in sorted(self._outputs.items()):
+            by_digest.setdefault(output.digest.digest(), (output, []))[1].append(node)
+        return [(nodes, output) for output, nodes in by_digest.values()]
+
+    def close(self):
+        with self._lock:
+            for nodes, output in self.groups():
+                header = '{} ({})'.format(fold_nodes(nodes), len(nodes))
+                rule = '-' * min(len(header), 79)
+                self.stream.write('{}\n{}\n{}\n'.format(rule, header, rule))
+                for line in output.lines():
+                    self.stream.write(line)
+            self.stream.flush()
+
+            for output in self._outputs.values():
+                output.file.close()
+            self._outputs = {}
+        if self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
+
+
+class MultiSink(Sink):
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def info(self, node, message):
+        for sink in self.sinks:
+            sink.info(node, message)
+
+    def line(self, node, line):
+        for sink in self.sinks:
+            sink.line(node, line)
+
+    def status(self, node, command, status):
+        for sink in self.sinks:
+            sink.status(node, command, status)
+
+    def step_done(self, node, step):
+        for sink in self.sinks:
+            sink.step_done(node, step)
+
+    def finish(self, node, error):
+        for sink in self.sinks:
+            sink.finish(node, error)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+OUTPUT_TO_SINK = {
+    'console': ConsoleSink,
+    'json': JsonSink,
+    'aggregate': AggregateSink,
+}
+
+
+def sink_for_config(config):
+    output = herd.config.output(config)
+    if output not in OUTPUT_TO_SINK:
+        raise ValueError('output must be one of {}'.format(list(OUTPUT_TO_SINK.keys())))
+
+    output_file = herd.config.output_file(config)
+    stream = open(output_file, 'a') if output_file else None
+    if output == 'aggregate':
+        sinks = [AggregateSink(stream, spill_bytes=herd.config.output_spill_bytes(config))]
+    else:
+        sinks = [OUTPUT_TO_SINK[output](stream)]
+
+    log_dir = herd.config.log_dir(config)
+    if log_dir:
+        sinks.append(LogFileSink(
+            os.path.expanduser(log_dir),
+            max_bytes=herd.config.log_max_bytes(config),
+            backups=herd.config.log_backups(config),
+        ))
+
+    return sinks[0] if len(sinks) == 1 else MultiSink(sinks)
@@ -0,0 +1,482 @@
+"""
+The config, compiled into a plan before anything runs.
+
+Every cluster, task, command and role is checked up front and kept as a
+small __slots__ object, so a typo fails the run before any provider API
+call or SSH session instead of after some clusters were already changed.
+
+Compiled plans are cached on disk as JSON, keyed by a hash of the config
+file, so a run with an unchanged config skips parsing the TOML and checking
+it. Secrets (the key passphrase, provider tokens) are left out of the cached
+plan, which keeps their line numbers instead: the hash guarantees the file
+is the one they were found in, so only those lines are read again.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import pytoml
+
+from herd.cluster import known_provider
+from herd.cluster import provider_names
+from herd.command import COMMANDS
+from herd.command import parse_command
+from herd.config import ConfigException
+from herd.graph import normalize_dependencies
+from herd.graph import TaskDependencyException
+from herd.graph import TaskGraph
+from herd.graph import TaskPlan
+from herd.inventory import DEFAULT_CACHE_DIR
+
+
+# Bump whenever the classes below change, cached plans of other versions
+# are then compiled again
+PLAN_VERSION = 3
+
+CLUSTER_SIZE_KEYS = ('min_cores', 'min_ram', 'min_disk', 'max_monthly_cost')
+CLUSTER_FLAG_KEYS = ('backups', 'ipv6', 'private_networking')
+CLUSTER_KEYS = frozenset(
+    ('provider', 'server_count', 'region', 'image', 'ssh_keys') +
+    CLUSTER_SIZE_KEYS + CLUSTER_FLAG_KEYS
+)
+
+# What secret_lines looks for, `[providers.digitalocean]` and `token = "..."`
+TABLE_HEADER = re.compile(r'^\s*\[([^\[\]]+)\]\s*(#.*)?$')
+SECRET_LINE = re.compile(
+    r'^\s*(password|token)\s*=\s*("(?:[^"\\]|\\.)*"|\'[^\']*\')\s*(#.*)?$'
+)
+
+
+class ClusterSpec(object):
+    """
+    :settings: the cluster's config table, as handed to its ClusterManager
+    """
+
+    __slots__ = ('name', 'provider', 'server_count', 'settings')
+
+    def __init__(self, name, provider, server_count, settings):
+        self.name = name
+        self.provider = provider
+        self.server_count = server_count
+        self.settings = settings
+
+
+class CommandSpec(object):
+    """A checked command line of a task, built into a Command per run"""
+
+    __slots__ = ('key', 'value')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def build(self, sudo=False):
+        return parse_command(self.key, self.value, sudo)
+
+
+class TaskSpec(object):
+
+    __slots__ = ('name', 'dependencies', 'commands')
+
+    def __init__(self, name, dependencies, commands):
+        self.name = name
+        self.dependencies = dependencies
+        self.commands = commands
+
+
+class RoleSpec(object):
+
+    __slots__ = ('name', 'clusters', 'tasks', 'sudo')
+
+    def __init__(self, name, clusters, tasks, sudo):
+        self.name = name
+        self.clusters = clusters
+        self.tasks = tasks
+        self.sudo = sudo
+
+
+class HerdPlan(object):
+    """
+    :digest: sha256 of the config file it was compiled from, if any
+    :config: the parsed config, for the options read while running
+    :clusters: dict of name -> ClusterSpec
+    :tasks: dict of name -> TaskSpec
+    :roles: dict of name -> RoleSpec
+    :graph: TaskGraph over every task
+    """
+
+    __slots__ = ('digest', 'config', 'clusters', 'tasks', 'roles', 'graph')
+
+    def __init__(self, digest, config, clusters, tasks, roles, graph):
+        self.digest = digest
+        self.config = config
+        self.clusters = clusters
+        self.tasks = tasks
+        self.roles = roles
+        self.graph = graph
+
+    def cluster(self, name):
+        if name not in self.clusters:
+            raise ConfigException('Unknown cluster {}'.format(name))
+        return self.clusters[name]
+
+    def role(self, name):
+        if name not in self.roles:
+            raise ConfigException('Unknown role {}'.format(name))
+        return self.roles[name]
+
+    def task_plan(self, task_names, sudo=False):
+        """
+        :return: TaskPlan of the tasks and everything they depend on, with
+            fresh Commands
+        """
+        tasks = self.graph.closure(task_names)
+        return TaskPlan(
+            tasks,
+            {task: self.tasks[task].dependencies for task in tasks},
+            {
+                task: [command.build(sudo) for command in self.tasks[task].commands]
+                for task in tasks
+            },
+        )
+
+
+def names(value):
+    """A name or list of names, as roles and dependencies accept either"""
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+def compile_clusters(config, problems):
+    clusters = {}
+    for name, cluster in sorted(config.get('clusters', {}).items()):
+        if not isinstance(cluster, dict):
+            problems.append('cluster {} must be a table'.format(name))
+            continue
+        if name[-1:].isdigit():
+            problems.append('cluster {} must not end in a digit'.format(name))
+
+        provider = cluster.get('provider')
+        if provider is None:
+            problems.append('cluster {} has no provider'.format(name))
+        elif not known_provider(provider):
+            problems.append('cluster {} has unknown provider {}, must be one of {}'.format(
+                name, provider, ', '.join(provider_names()),
+            ))
+
+        count = cluster.get('server_count', 0)
+        if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+            problems.append('cluster {} server_count must be a whole number, got {!r}'.format(
+                name, count,
+            ))
+        for key in CLUSTER_SIZE_KEYS:
+            value = cluster.get(key, 0)
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+                problems.append('cluster {} {} must be a number, got {!r}'.format(
+                    name, key, value,
+                ))
+        for key in CLUSTER_FLAG_KEYS:
+            if not isinstance(cluster.get(key, False), bool):
+                problems.append('cluster {} {} must be true or false'.format(name, key))
+        for key in sorted(set(cluster) - CLUSTER_KEYS):
+            problems.append('cluster {} has unknown option {}'.format(name, key))
+
+        clusters[name] = ClusterSpec(name, provider, count, cluster)
+    return clusters
+
+
+def compile_tasks(config, problems):
+    tasks = {}
+    for name, task in sorted(config.get('tasks', {}).items()):
+        if not isinstance(task, dict):
+            problems.append('task {} must be a table'.format(name))
+            continue
+
+        commands = []
+        for key, value in task.items():
+            if key == 'dependencies':
+                continue
+            if key not in COMMANDS:
+                problems.append('task {} has unknown command {}, must be one of {}'.format(
+                    name, key, ', '.join(sorted(COMMANDS)),
+                ))
+                continue
+            error = COMMANDS[key].check(value)
+            if error is not None:
+                problems.append('task {} command {} {}'.format(name, key, error))
+                continue
+            commands.append(CommandSpec(key, value))
+
+        tasks[name] = TaskSpec(name, normalize_dependencies(task), tuple(commands))
+
+    try:
+        graph = TaskGraph(config.get('tasks', {}))
+    except TaskDependencyException as e:
+        problems.append(str(e))
+        graph = None
+    return tasks, graph
+
+
+def compile_roles(config, clusters, tasks, problems):
+    roles = {}
+    for name, role in sorted(config.get('roles', {}).items()):
+        if not isinstance(role, dict):
+            problems.append('role {} must be a table'.format(name))
+            continue
+
+        role_clusters = names(role.get('clusters', ()))
+        role_tasks = names(role.get('tasks', ()))
+        for cluster in role_clusters:
+            if cluster not in clusters:
+                problems.append('role {} uses unknown cluster {}'.format(name, cluster))
+        for task in role_tasks:
+            if task not in tasks:
+                problems.append('role {} uses unknown task {}'.format(name, task))
+        sudo = role.get('sudo', False)
+        if not isinstance(sudo, bool):
+            problems.append('role {} sudo must be true or false'.format(name))
+
+        roles[name] = RoleSpec(name, role_clusters, role_tasks, sudo)
+    return roles
+
+
+def compile_config(config, digest=None):
+    """
+    :param config: parsed config dict
+    :return: HerdPlan
+    :raises ConfigException: listing every problem found
+    """
+    problems = []
+    if 'ssh' in config and 'path' not in config['ssh']:
+        problems.append('[ssh] needs the path of a private key')
+    clusters = compile_clusters(config, problems)
+    tasks, graph = compile_tasks(config, problems)
+    roles = compile_roles(config, clusters, tasks, problems)
+
+    if problems:
+        raise ConfigException('Invalid config:\n  {}'.format('\n  '.join(problems)))
+    return HerdPlan(digest, config, clusters, tasks, roles, graph)
+
+
+def plan_cache_path(digest, cache_dir=None):
+    return os.path.join(
+        os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR),
+        'plan-{}.json'.format(digest[:32]),
+    )
+
+
+def secret_paths(config):
+    """
+    :return: list of key paths to the config's secrets, never written to the
+        plan cache
+    """
+    paths = []
+    if 'password' in config.get('ssh', {}):
+        paths.append(('ssh', 'password'))
+    for provider, settings in sorted(config.get('providers', {}).items()):
+        if isinstance(settings, dict) and 'token' in settings:
+            paths.append(('providers', provider, 'token'))
+    return paths
+
+
+def without_secrets(config, paths):
+    """Copy of config without the values at paths, what isn't on them is shared"""
+    config = dict(config)
+    for path in paths:
+        table = config
+        for key in path[:-1]:
+            table[key] = dict(table[key])
+            table = table[key]
+        del table[path[-1]]
+    return config
+
+
+def set_value(config, path, value):
+    for key in path[:-1]:
+        config = config[key]
+    config[path[-1]] = value
+
+
+def get_value(config, path):
+    for key in path:
+        config = config[key]
+    return config
+
+
+def secret_value(line):
+    """
+    :return: (key, value) of a `key = "string"` line, or None for anything
+        else, escapes other than JSON's included
+    """
+    match = SECRET_LINE.match(line)
+    if match is None:
+        return None
+    key, value = match.group(1), match.group(2)
+    if value.startswith("'"):
+        return key, value[1:-1]
+    if '\\U' in value:
+        return None
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return None
+
+
+def secret_lines(source, config, paths):
+    """
+    Where the secrets at paths are in the config file, so a cached plan can
+    read them back without parsing the file
+
+    :return: list of (path, line number), None unless every secret was found
+        on a line of its own, in a plain table header's table
+    """
+    found = {}
+    table = None
+    for number, line in enumerate(source.splitlines()):
+        header = TABLE_HEADER.match(line)
+        if header:
+            table = tuple(key.strip().strip('"') for key in header.group(1).split('.'))
+            continue
+        if line.lstrip().startswith('['):
+            table = None
+            continue
+        secret = secret_value(line)
+        if table is None or secret is None:
+            continue
+        path = table + (secret[0],)
+        if path in paths and get_value(config, path) == secret[1]:
+            found[path] = number
+
+    if len(found) != len(paths):
+        return None
+    return [(path, found[path]) for path in paths]
+
+
+def plan_to_json(plan, secrets):
+    """
+    :param secrets: list of (path, line number), as secret_lines finds them
+    :return: the plan as JSON values, without the secrets
+    """
+    return {
+        'version': PLAN_VERSION,
+        'digest': plan.digest,
+        'config': without_secrets(plan.config, [path for path, _ in secrets]),
+        'secrets': secrets,
+        'clusters': [
+            [cluster.name, cluster.provider, cluster.server_count]
+            for cluster in plan.clusters.values()
+        ],
+        'tasks': [
+            [task.name, task.dependencies, [[c.key, c.value] for c in task.commands]]
+            for task in plan.tasks.values()
+        ],
+        'roles': [
+            [role.name, role.clusters, role.tasks, role.sudo]
+            for role in plan.roles.values()
+        ],
+    }
+
+
+def plan_from_json(cached):
+    config = cached['config']
+    clusters = {
+        name: ClusterSpec(name, provider, count, config['clusters'][name])
+        for name, provider, count in cached['clusters']
+    }
+    tasks = {
+        name: TaskSpec(name, tuple(dependencies), tuple(
+            CommandSpec(key, value) for key, value in commands
+        ))
+        for name, dependencies, commands in cached['tasks']
+    }
+    roles = {
+        name: RoleSpec(name, tuple(role_clusters), tuple(role_tasks), sudo)
+        for name, role_clusters, role_tasks, sudo in cached['roles']
+    }
+    graph = TaskGraph(config.get('tasks', {}))
+    return HerdPlan(cached['digest'], config, clusters, tasks, roles, graph)
+
+
+def read_cached_plan(path, digest, source):
+    """
+    :param source: the config file's text, the secrets are read back from it
+    :return: HerdPlan, or None if there's no usable one cached
+    """
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached['version'] != PLAN_VERSION or cached['digest'] != digest:
+            return None
+        plan = plan_from_json(cached)
+        lines = source.splitlines()
+        for path, number in cached['secrets']:
+            set_value(plan.config, tuple(path), secret_value(lines[number])[1])
+    except (IOError, OSError, ValueError, KeyError, IndexError, TypeError,
+            TaskDependencyException):
+        return None
+    return plan
+
+
+def write_cached_plan(path, plan, source):
+    """
+    Best effort, a cache that can't be written only costs a recompile. So
+    does a config whose secrets can't be found by line, or one with values
+    JSON has no type for (TOML dates), neither is cached
+    """
+    paths = secret_paths(plan.config)
+    secrets = secret_lines(source, plan.config, paths)
+    if secrets is None:
+        return
+
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+    except OSError:
+        return
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(plan_to_json(plan, secrets), f)
+        os.replace(tmp_path, path)
+    except (TypeError, ValueError):
+        os.unlink(tmp_path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_plan(path, cache_dir=None):
+    """
+    Compiled plan of the config file at path, from the cache if the file
+    hasn't changed since it was last compiled. Plans are cached under
+    ~/.cache/herd, or cache_dir: [herd] cache_dir is inside the very file
+    being looked up.
+
+    :raises ConfigException: if the config doesn't parse or check
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    digest = hashlib.sha256(source).hexdigest()
+    cached = plan_cache_path(digest, cache_dir)
+    try:
+        text = source.decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise ConfigException('Invalid config {}: {}'.format(path, e))
+
+    plan = read_cached_plan(cached, digest, text)
+    if plan is None:
+        plan = compile_config(parse_config(path, text), digest)
+        write_cached_plan(cached, plan, text)
+    return plan
+
+
+def parse_config(path, source):
+    try:
+        return pytoml.loads(source)
+    except pytoml.TomlError as e:
+        raise ConfigException('Invalid config {}: {}'.format(path, e))
@@ -0,0 +1,246 @@
+import atexit
+import threading
+import time
+from collections import namedtuple
+
+
+DEFAULT_MAX_CONNECTIONS = 256
+DEFAULT_IDLE_TIMEOUT = 300
+
+
+class PoolKey(namedtuple('PoolKey', ['ip_address', 'username', 'key_filename', 'port'])):
+    """Identifies a reusable connection: same host and port, same user, same key"""
+
+    def __new__(cls, ip_address, username, key_filename, port=22):
+        return super(PoolKey, cls).__new__(cls, ip_address, username, key_filename, port)
+
+
+class PoolExhaustedException(Exception):
+    pass
+
+
+def transport_is_healthy(client):
+    """
+    :param client: paramiko SSHClient
+    :return: bool, True if the client's transport can still carry channels
+    """
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+
+    try:
+        # Cheap round trip-free liveness check; raises if the socket is dead
+        transport.send_ignore()
+    except Exception:
+        return False
+
+    return True
+
+
+class ConnectionPool(object):
+    """
+    Keeps authenticated SSH clients around between commands, tasks and roles
+    so that a whole deploy only pays the handshake cost once per node.
+
+    A client is checked out exclusively by `acquire` and handed back by
+    `release`. Idle clients are health checked before reuse and closed once
+    they've been idle for longer than `idle_timeout`. At most
+    `max_connections` transports are open at any time; when the cap is hit
+    idle clients for other hosts are closed first, otherwise `acquire`
+    waits for a release.
+
+    :connect: callable taking a PoolKey and returning a connected client
+    :max_connections: cap on open transports across all keys
+    :idle_timeout: seconds an unused client is kept open
+    :acquire_timeout: seconds to wait for a free slot, None waits forever
+    :health_check: callable taking a client and returning whether it is usable
+    """
+
+    def __init__(
+        self, connect, max_connections=DEFAULT_MAX_CONNECTIONS,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT, acquire_timeout=None,
+        health_check=transport_is_healthy,
+    ):
+        self.connect = connect
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.health_check = health_check
+        self._idle = {}  # PoolKey -> [(client, released_at), ...]
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @property
+    def open_connections(self):
+        return self._open
+
+    @property
+    def idle_connections(self):
+        with self._condition:
+            return sum(len(clients) for clients in self._idle.values())
+
+    def acquire(self, key):
+        deadline = (
+            None if self.acquire_timeout is None
+            else time.time() + self.acquire_timeout
+        )
+
+        with self._condition:
+            while True:
+                self._evict_expired()
+                client = self._checkout_idle(key)
+                if client is not None:
+                    return client
+
+                if self._open < self.max_connections:
+                    self._open += 1
+                    break
+
+                if self._evict_oldest_idle():
+                    continue
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhaustedException(
+                        'No connection slot freed up within {}s ({} open)'.format(
+                            self.acquire_timeout, self._open,
+                        )
+                    )
+                self._condition.wait(remaining)
+
+        try:
+            return self.connect(key)
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, key, client):
+        """Hand a client back for reuse, closing it if it has gone bad"""
+        if not self.health_check(client):
+            self.discard(client)
+            return
+
+        with self._condition:
+            if self._closed:
+                # Checked out before the pool was closed, nothing will reuse it
+                _close(client)
+                self._open -= 1
+                return
+            self._idle.setdefault(key, []).append((client, time.time()))
+            self._condition.notify()
+
+    def discard(self, client):
+        """Close a checked out client instead of returning it to the pool"""
+        _close(client)
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def close_all(self):
+        """Close every idle client, and every checked out one as it is released"""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+            for clients in idle.values():
+                for client, _ in clients:
+                    _close(client)
+                    self._open -= 1
+            self._condition.notify_all()
+
+    def _checkout_idle(self, key):
+        clients = self._idle.get(key)
+        while clients:
+            # Most recently released first, it is the least likely to be stale
+            client, _ = clients.pop()
+            if self.health_check(client):
+                return client
+            _close(client)
+            self._open -= 1
+        return None
+
+    def _evict_expired(self):
+        if self.idle_timeout is None:
+            return
+
+        cutoff = time.time() - self.idle_timeout
+        for key, clients in list(self._idle.items()):
+            fresh = []
+            for client, released_at in clients:
+                if released_at < cutoff:
+                    _close(client)
+                    self._open -= 1
+                else:
+                    fresh.append((client, released_at))
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+    def _evict_oldest_idle(self):
+        oldest = None
+        for key, clients in self._idle.items():
+            for idx, (_, released_at) in enumerate(clients):
+                if oldest is None or released_at < oldest[2]:
+                    oldest = (key, idx, released_at)
+
+        if oldest is None:
+            return False
+
+        key, idx, _ = oldest
+        client, _ = self._idle[key].pop(idx)
+        if not self._idle[key]:
+            del self._idle[key]
+        _close(client)
+        self._open -= 1
+        return True
+
+
+def _close(client):
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+_pool = None
+_pool_settings = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(connect, max_connections=None, idle_timeout=None, settings=None):
+    """
+    Process wide pool, created on first use. Asked for with other settings,
+    as a long lived agent is when a command brings another config, the old
+    pool is closed and a new one made.
+
+    :param settings: hashable, whatever connect depends on besides the
+        PoolKey, e.g. the key's passphrase
+    """
+    global _pool, _pool_settings
+    key = (settings, max_connections, idle_timeout)
+    with _pool_lock:
+        if _pool is not None and _pool_settings != key:
+            _pool.close_all()
+            _pool = None
+        if _pool is None:
+            _pool = ConnectionPool(
+                connect,
+                max_connections=max_connections or DEFAULT_MAX_CONNECTIONS,
+                idle_timeout=(
+                    DEFAULT_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+                ),
+            )
+            _pool_settings = key
+        return _pool
+
+
+@atexit.register
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
@@ -0,0 +1,133 @@
+"""
+Runs provider mutations (create, destroy, rename, ...) concurrently on a
+bounded pool, paced by a token bucket so we stay under the provider's API
+rate limit, retrying throttled calls with exponential backoff.
+"""
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent import futures
+
+
+DEFAULT_CONCURRENCY = 8
+# DigitalOcean allows 250 requests a minute
+DEFAULT_RATE = 4
+DEFAULT_BURST = 10
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+
+
+class TokenBucket(object):
+    """
+    :rate: tokens added per second
+    :capacity: most tokens that can pile up, i.e. the allowed burst
+    """
+
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """
+        :return: 0 if a token was taken, otherwise seconds until one is due
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            self.sleep(wait)
+
+
+class ProvisionCall(namedtuple('ProvisionCall', ['action', 'node', 'call'])):
+    """
+    :action: what is being done, e.g. 'create'
+    :node: name of the node it is done to
+    :call: callable doing it
+    """
+
+
+class ProvisionResult(namedtuple('ProvisionResult', ['action', 'node', 'result', 'error'])):
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return '{} {}: ok'.format(self.action, self.node)
+        return '{} {}: FAILED {}'.format(self.action, self.node, self.error)
+
+
+class ProvisionPool(object):
+    """
+    :is_throttled: callable taking an exception, True if the call was
+        rejected for going over the rate limit and should be retried
+    """
+
+    def __init__(
+        self, is_throttled, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE,
+        burst=DEFAULT_BURST, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+        sleep=time.sleep,
+    ):
+        self.is_throttled = is_throttled
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst, sleep=sleep)
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+
+    def _call(self, provision_call):
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                return provision_call.call()
+            except Exception as e:
+                if attempt == self.retries or not self.is_throttled(e):
+                    raise
+                # Full jitter, so throttled callers don't all come back at once
+                self.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def run(self, calls):
+        """
+        :param calls: list of ProvisionCalls
+        :return: list of ProvisionResults, in the same order. A failing call
+            never stops the others
+        """
+        if not calls:
+            return []
+
+        results = {}
+        with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            future_to_idx = {
+                executor.submit(self._call, call): idx
+                for idx, call in enumerate(calls)
+            }
+            for future in futures.as_completed(future_to_idx):
+                idx = future_to_idx[future]
+                call = calls[idx]
+                error = future.exception()
+                results[idx] = ProvisionResult(
+                    call.action, call.node, None if error else future.result(), error,
+                )
+                print(results[idx])
+
+        return [results[idx] for idx in range(len(calls))]
@@ -0,0 +1,168 @@
+"""
+Per node readiness.
+
+A node counts as ready once the provider reports it active and its sshd
+answers with a banner, which is checked with a plain TCP probe. Pending
+nodes are polled together with an adaptive backoff (it starts short, grows
+while nothing changes and resets whenever a node comes up), so each node can
+be handed off the moment it is reachable instead of after the whole cluster
+plus a fixed cooldown.
+"""
+import socket
+import time
+from concurrent import futures
+
+import herd.config
+import herd.timing
+
+
+DEFAULT_TIMEOUT = 600
+PROBE_TIMEOUT = 3
+PROBE_WORKERS = 32
+UNAVAILABLE_STATUSES = ('off', 'archive')
+
+
+class NodeUnavailableException(Exception):
+    pass
+
+
+def probe_ssh(ip_address, port=22, timeout=PROBE_TIMEOUT):
+    """
+    :return: bool, True if something speaking SSH answers on ip:port
+    """
+    try:
+        sock = socket.create_connection((ip_address, port), timeout=timeout)
+    except (socket.error, socket.timeout):
+        return False
+
+    try:
+        return sock.recv(4).startswith(b'SSH-')
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+
+
+class Backoff(object):
+
+    def __init__(self, initial=1.0, maximum=10.0, factor=1.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.interval = initial
+
+    def next(self, progressed):
+        """
+        :param progressed: whether the last poll got anywhere
+        :return: seconds to wait before polling again
+        """
+        if progressed:
+            self.interval = self.initial
+        else:
+            self.interval = min(self.maximum, self.interval * self.factor)
+        return self.interval
+
+
+class ReadinessTracker(object):
+    """
+    :manager: ClusterManager the nodes belong to
+    :port: ssh port to probe
+    :timeout: seconds to wait for a node before giving up on it
+    :probe: callable (ip, port) -> bool
+    """
+
+    def __init__(
+        self, manager, port=22, timeout=DEFAULT_TIMEOUT, probe=probe_ssh,
+        backoff=None, clock=time.time, sleep=time.sleep,
+    ):
+        self.manager = manager
+        self.port = port
+        self.timeout = timeout
+        self.probe = probe
+        self.backoff = backoff or Backoff()
+        self.clock = clock
+        self.sleep = sleep
+
+    @classmethod
+    def for_config(cls, config, manager):
+        return cls(
+            manager,
+            port=herd.config.ssh_port(config),
+            timeout=herd.config.ready_timeout(config),
+        )
+
+    def poll(self, pending, refresh=False):
+        """
+        Check every pending node once
+
+        :param pending: list of node names
+        :param refresh: fetch the node list again rather than use the cache
+        :return: (list of ready node names, dict of node name -> exception
+            for nodes that will never become ready)
+        """
+        if refresh:
+            self.manager.refresh_nodes_list()
+        index = self.manager.index
+
+        unavailable = {}
+        to_probe = []
+        for name in pending:
+            node = index.node(name)
+            if node is None:
+                unavailable[name] = NodeUnavailableException('{} no longer exists'.format(name))
+            elif node.status in UNAVAILABLE_STATUSES:
+                unavailable[name] = NodeUnavailableException(
+                    '{} is {}, commands cannot be run on it'.format(name, node.status)
+                )
+            elif node.status == 'active' and node.ip_address:
+                to_probe.append(name)
+
+        if not to_probe:
+            return [], unavailable
+
+        workers = min(len(to_probe), PROBE_WORKERS)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            reachable = list(executor.map(
+                lambda name: self.probe(index.node(name).ip_address, self.port),
+                to_probe,
+            ))
+
+        return [name for name, ok in zip(to_probe, reachable) if ok], unavailable
+
+    def ready_nodes(self, nodes):
+        """
+        Yields (node name, None) for each node as soon as it is reachable, or
+        (node name, exception) once it's clear a node never will be
+        """
+        pending = list(nodes)
+        deadline = self.clock() + self.timeout
+        started = herd.timing.now()
+        refresh = False
+
+        while pending:
+            ready, unavailable = self.poll(pending, refresh)
+            for name in ready:
+                herd.timing.record(herd.timing.READY, 'wait for ssh', name, started)
+                yield name, None
+            for name, error in unavailable.items():
+                yield name, error
+
+            done = set(ready) | set(unavailable)
+            pending = [name for name in pending if name not in done]
+            if not pending:
+                return
+
+            if self.clock() >= deadline:
+                for name in pending:
+                    yield name, NodeUnavailableException(
+                        '{} not reachable after {}s'.format(name, self.timeout)
+                    )
+                return
+
+            # Only go back to the provider while a node is still being created
+            index = self.manager.index
+            refresh = any(
+                index.node(name) is None or index.node(name).status != 'active'
+                for name in pending
+            )
+            self.sleep(self.backoff.next(bool(done)))
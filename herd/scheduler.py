@@ -0,0 +1,170 @@
+"""
+One session budget for the whole process.
+
+Every SSH session herd opens to run commands first takes a slot here, so
+running several clusters (or roles) at once shares one global limit instead
+of each `execute_parallel` bringing its own. On top of the global limit there
+are optional limits per cluster and per host. Freed slots go to the waiting
+cluster holding the fewest slots, so a big cluster can't starve a small one
+that started later.
+"""
+import itertools
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+import herd.config
+
+
+DEFAULT_MAX_SESSIONS = 4
+DEFAULT_HOST_SESSIONS = 1
+
+
+class SessionRequest(object):
+    """
+    A place in line for one session
+
+    :cluster: cluster the session is for
+    :host: node the session is for
+    :seq: arrival order, breaks ties between equally served clusters
+    """
+
+    def __init__(self, cluster, host, seq):
+        self.cluster = cluster
+        self.host = host
+        self.seq = seq
+        self.granted = False
+        self._callbacks = []
+
+    def add_done_callback(self, callback):
+        """Called once with this request when it's granted, possibly right away"""
+        self._callbacks.append(callback)
+
+
+class SessionScheduler(object):
+    """
+    :max_sessions: sessions open at once across everything
+    :cluster_sessions: sessions open at once per cluster, None for no limit
+    :host_sessions: sessions open at once per host, None for no limit
+    """
+
+    def __init__(
+        self, max_sessions=DEFAULT_MAX_SESSIONS, cluster_sessions=None,
+        host_sessions=DEFAULT_HOST_SESSIONS,
+    ):
+        self.max_sessions = max_sessions
+        self.cluster_sessions = cluster_sessions
+        self.host_sessions = host_sessions
+        self.active = 0
+        self.by_cluster = Counter()
+        self.by_host = Counter()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+
+    def _allowed(self, request):
+        return (
+            (self.cluster_sessions is None or
+             self.by_cluster[request.cluster] < self.cluster_sessions) and
+            (self.host_sessions is None or
+             self.by_host[request.host] < self.host_sessions)
+        )
+
+    def _grant_waiting(self):
+        granted = []
+        while self._waiting and self.active < self.max_sessions:
+            allowed = [r for r in self._waiting if self._allowed(r)]
+            if not allowed:
+                break
+            request = min(allowed, key=lambda r: (self.by_cluster[r.cluster], r.seq))
+            self._waiting.remove(request)
+            self.active += 1
+            self.by_cluster[request.cluster] += 1
+            self.by_host[request.host] += 1
+            request.granted = True
+            granted.append(request)
+
+        if granted:
+            self._condition.notify_all()
+        return granted
+
+    def request(self, cluster, host, callback=None):
+        """
+        Queue up for a session without blocking
+
+        :param callback: called with the SessionRequest once it's granted
+        :return: SessionRequest, hand it to `release` when done
+        """
+        with self._condition:
+            request = SessionRequest(cluster, host, next(self._seq))
+            if callback is not None:
+                request.add_done_callback(callback)
+            self._waiting.append(request)
+            granted = self._grant_waiting()
+        _run_callbacks(granted)
+        return request
+
+    def acquire(self, cluster, host):
+        """Block until a session is granted"""
+        request = self.request(cluster, host)
+        with self._condition:
+            while not request.granted:
+                self._condition.wait()
+        return request
+
+    def release(self, request):
+        with self._condition:
+            if not request.granted:
+                # Given up on before it was granted
+                if request in self._waiting:
+                    self._waiting.remove(request)
+                return
+            request.granted = False
+            self.active -= 1
+            self.by_cluster[request.cluster] -= 1
+            self.by_host[request.host] -= 1
+            granted = self._grant_waiting()
+        _run_callbacks(granted)
+
+    @contextmanager
+    def session(self, cluster, host):
+        request = self.acquire(cluster, host)
+        try:
+            yield request
+        finally:
+            self.release(request)
+
+
+def _run_callbacks(requests):
+    # Outside the lock, a callback may well queue up again
+    for request in requests:
+        for callback in request._callbacks:
+            callback(request)
+
+
+_scheduler = None
+_scheduler_settings = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(config):
+    """
+    Process wide scheduler, made again when asked with a config whose limits
+    differ. Sessions granted by the one it replaces are released to it.
+    """
+    global _scheduler, _scheduler_settings
+    settings = (
+        herd.config.max_sessions(config),
+        herd.config.cluster_sessions(config),
+        herd.config.host_sessions(config),
+    )
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler_settings != settings:
+            max_sessions, cluster_sessions, host_sessions = settings
+            _scheduler = SessionScheduler(
+                max_sessions=max_sessions,
+                cluster_sessions=cluster_sessions,
+                host_sessions=host_sessions,
+            )
+            _scheduler_settings = settings
+        return _scheduler
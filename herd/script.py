@@ -0,0 +1,288 @@
+"""
+Compiles a node's command list into as few remote executions as possible.
+
+Runs of adjacent Install / Uninstall commands collapse into one apt-get call
+(apt-get install treats a trailing '-' on a package as a removal), so the
+dpkg lock is only taken once. Everything between two Copy commands is then
+sent as one shell script over a single channel. The script prints a marker
+line after each command, which is how the exit status of every original
+command still makes it back, and stops at the first command that fails. A
+script that ends before every marker came back has failed, whatever its own
+exit status.
+"""
+import re
+import uuid
+
+from herd import handler
+from herd.command import Command
+from herd.command import Copy
+from herd.command import Install
+from herd.command import Uninstall
+from herd.graph import TaskPlan
+from herd.handler import CommandFailedException
+from herd.handler import CommandStatus
+from herd.output import OutputLine
+from herd.output import STDOUT
+
+
+# Status of a command whose marker never came back, as paramiko reports a
+# channel that closed without an exit status
+NO_STATUS = -1
+
+
+class PackageChange(Command):
+    """Several Install / Uninstall commands merged into one apt-get call"""
+
+    def __init__(self, sudo=False):
+        super(PackageChange, self).__init__(sudo)
+        self.install = []
+        self.remove = []
+        self.merged = []
+
+    def accepts(self, command):
+        if not isinstance(command, (Install, Uninstall)) or command.sudo != self.sudo:
+            return False
+        # Installing and removing the same package in one call is ambiguous
+        if isinstance(command, Install):
+            return not set(command.packages) & set(self.remove)
+        return not set(command.packages) & set(self.install)
+
+    def merge(self, command):
+        target = self.install if isinstance(command, Install) else self.remove
+        target.extend(p for p in command.packages if p not in target)
+        self.merged.append(command)
+
+    @property
+    def _format(self):
+        if self.install:
+            return "apt-get install -y {}"
+        return "apt-get remove -y {}"
+
+    @property
+    def command(self):
+        if not self.install:
+            return self.format.format(' '.join(self.remove))
+        return self.format.format(
+            ' '.join(self.install + ['{}-'.format(p) for p in self.remove])
+        )
+
+
+def merge_package_commands(commands):
+    """
+    :param commands: list of Commands
+    :return: list of Commands with adjacent package commands merged
+    """
+    merged = []
+    for command in commands:
+        current = merged[-1] if merged else None
+        if isinstance(current, PackageChange) and current.accepts(command):
+            current.merge(command)
+        elif isinstance(command, (Install, Uninstall)):
+            change = PackageChange(command.sudo)
+            change.merge(command)
+            merged.append(change)
+        else:
+            merged.append(command)
+
+    return [
+        c.merged[0] if isinstance(c, PackageChange) and len(c.merged) == 1 else c
+        for c in merged
+    ]
+
+
+class Script(Command):
+    """
+    A list of commands sent to a node in one exec request. Running it yields
+    output lines as they arrive, plus a CommandStatus once each command ends.
+    """
+
+    def __init__(self, commands):
+        super(Script, self).__init__()
+        self.commands = commands
+        self.marker = '__HERD_STATUS_{}__'.format(uuid.uuid4().hex)
+        self._marker_re = re.compile(r'{} (\d+) (\d+)$'.format(self.marker))
+
+    @property
+    def command(self):
+        lines = []
+        for idx, command in enumerate(self.commands):
+            lines.append(command.command)
+            lines.append(
+                "__herd_status=$?; printf '{} {} %d\\n' $__herd_status; "
+                "[ $__herd_status -eq 0 ] || exit $__herd_status".format(self.marker, idx)
+            )
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return '; '.join(str(c) for c in self.commands)
+
+    def parse_line(self, line):
+        """
+        :param line: OutputLine
+        :return: (OutputLine or None, CommandStatus or None)
+        """
+        found = self._marker_re.search(line.text) if line.stream == STDOUT else None
+        if found is None:
+            return line, None
+
+        idx, status = int(found.group(1)), int(found.group(2))
+        status = CommandStatus(self.commands[idx], status)
+        # Output that didn't end in a newline shares its last line with the
+        # marker
+        text = line.text[:found.start()]
+        return OutputLine(STDOUT, text) if text else None, status
+
+    def check(self, statuses, status):
+        """
+        :param statuses: list of the CommandStatuses parse_line found
+        :param status: the script's exit status
+        :raises: CommandFailedException unless every command reported success
+        """
+        for found in statuses:
+            if found.status != 0:
+                raise CommandFailedException(found.command, found.status)
+        if status != 0:
+            # Died without reaching a marker, blame the whole script
+            raise CommandFailedException(self, status)
+        if len(statuses) < len(self.commands):
+            # Exited early with 0, say a command ran `exit 0`: the commands
+            # after it never ran
+            raise CommandFailedException(self.commands[len(statuses)], NO_STATUS)
+
+    def run(self, node_handler):
+        """
+        :raises: CommandFailedException for the first command that fails, or
+            that never reported back
+        """
+        lines = handler.execute(node_handler, self.command)
+        statuses = []
+        try:
+            for line in lines:
+                out, status = self.parse_line(line)
+                if out is not None:
+                    yield out
+                if status is not None:
+                    yield status
+                    statuses.append(status)
+                    if status.status != 0:
+                        raise CommandFailedException(status.command, status.status)
+            self.check(statuses, 0)
+        except CommandFailedException as e:
+            if e.command == self.command:
+                # Died without reaching a marker, blame the whole script
+                raise CommandFailedException(self, e.status)
+            raise
+        finally:
+            # Closes the channel right away rather than whenever the
+            # generator is collected
+            lines.close()
+
+
+def compile_commands(commands):
+    """
+    :param commands: list of Commands
+    :return: list of Scripts and Copy commands, in the original order
+    """
+    steps = []
+    pending = []
+    for command in merge_package_commands(commands):
+        if isinstance(command, Copy):
+            if pending:
+                steps.append(Script(pending))
+                pending = []
+            steps.append(command)
+        else:
+            pending.append(command)
+
+    if pending:
+        steps.append(Script(pending))
+
+    return steps
+
+
+def compile_plan(plan):
+    return TaskPlan(
+        plan.tasks,
+        plan.dependencies,
+        {task: compile_commands(commands) for task, commands in plan.commands.items()},
+    )
+
+
+def original_commands(step):
+    """
+    :param step: Script or Copy of a compiled plan
+    :return: list of the Commands it was compiled from
+    """
+    if not isinstance(step, Script):
+        return [step]
+    originals = []
+    for command in step.commands:
+        if isinstance(command, PackageChange):
+            originals.extend(command.merged)
+        else:
+            originals.append(command)
+    return originals
+
+
+def may_be_satisfied(plan):
+    """
+    Whether any command of a compiled plan could be found done by a node's
+    facts, nothing else looks at them
+    """
+    return any(
+        # Command.satisfied itself never finds anything done
+        type(command).satisfied is not Command.satisfied
+        for task in plan.tasks
+        for step in plan.commands[task]
+        for command in original_commands(step)
+    )
+
+
+def skip_satisfied(plan, facts):
+    """
+    Drop the commands a node's facts say are already done. A command is
+    only dropped if nothing kept before it (in plan order) touches the same
+    package, service or file, since the facts predate those changes.
+
+    :param plan: compiled TaskPlan
+    :param facts: herd.facts.NodeFacts of the node
+    :return: (TaskPlan, list of skipped Commands)
+    """
+    skipped = []
+    changing = set()
+    changes_everything = False
+
+    def keep(command):
+        nonlocal changes_everything
+        touched = command.touches()
+        if (
+            not changes_everything and command.satisfied(facts) and
+            not (touched and touched & changing)
+        ):
+            skipped.append(command)
+            return False
+        if touched is None:
+            changes_everything = True
+        else:
+            changing.update(touched)
+        return True
+
+    commands = {}
+    for task in plan.tasks:
+        steps = []
+        for step in plan.commands[task]:
+            if not isinstance(step, Script):
+                if keep(step):
+                    steps.append(step)
+                continue
+
+            originals = original_commands(step)
+            kept = [command for command in originals if keep(command)]
+
+            if len(kept) == len(originals):
+                steps.append(step)
+            elif kept:
+                steps.append(Script(merge_package_commands(kept)))
+        commands[task] = steps
+
+    return TaskPlan(plan.tasks, plan.dependencies, commands), skipped
@@ -0,0 +1,171 @@
+"""
+Cluster reconciliation: compare the nodes a cluster has with what its
+config asks for, work out the fewest provider actions that close the gap,
+then run them.
+
+Planning reads state only (one node listing, one size listing) and makes
+no API calls of its own, so a cluster that is already in sync costs
+nothing beyond those listings, which usually come from the inventory
+cache. Actions that don't depend on each other run concurrently.
+"""
+from collections import namedtuple
+
+from herd.inventory import parse_node_name
+from herd.provision import ProvisionCall
+from herd.provision import ProvisionResult
+
+
+class ClusterSyncException(Exception):
+    pass
+
+
+class SyncAction(namedtuple('SyncAction', ['action', 'node', 'target', 'after'])):
+    """
+    :action: 'destroy', 'resize', 'rename' or 'create'
+    :node: name of the node acted on, for create the name it will get
+    :target: new name for rename, size slug for resize and create
+    :after: tuple of indexes of the actions in the plan this waits for
+    """
+
+    def __str__(self):
+        if self.action == 'rename':
+            return 'rename {} to {}'.format(self.node, self.target)
+        if self.action == 'resize':
+            return 'resize {} to {}'.format(self.node, self.target)
+        if self.action == 'create':
+            return 'create {} ({})'.format(self.node, self.target)
+        return '{} {}'.format(self.action, self.node)
+
+
+def node_index(cluster_name, node):
+    cluster, index = parse_node_name(node.name)
+    return index if cluster == cluster_name else None
+
+
+def diff_cluster(cluster_name, nodes, desired_count, size, fits, resizable):
+    """
+    Nodes keep their name wherever it is already one of <cluster>1..desired,
+    surplus nodes with the highest indexes go first, and a node of the wrong
+    size is resized in place rather than replaced when the provider can.
+    Nodes still being created are left alone.
+
+    :param nodes: the cluster's nodes as listed by the provider
+    :param size: size new or resized nodes get
+    :param fits: callable, whether a node's size meets the config
+    :param resizable: callable taking a node and a size, whether the node
+        can be resized to it in place
+    :return: list of SyncActions, empty if the cluster is in sync
+    """
+    actions = []
+
+    def add(action, node, target=None, after=()):
+        actions.append(SyncAction(action, node, target, tuple(after)))
+        return len(actions) - 1
+
+    pinned = [node for node in nodes if node.status == 'new']
+    movable = [node for node in nodes if node.status != 'new']
+
+    # Fitting nodes first, then by name, so surplus and misfits are dropped
+    def keep_order(node):
+        index = node_index(cluster_name, node)
+        return (not fits(node), index is None, index or 0)
+
+    movable.sort(key=keep_order)
+    wanted = max(desired_count - len(pinned), 0)
+    kept, surplus = movable[:wanted], movable[wanted:]
+
+    kept_misfits = [node for node in kept if not fits(node)]
+    replaced = [node for node in kept_misfits if not resizable(node, size)]
+    kept = [node for node in kept if node not in replaced]
+    resized = [node for node in kept_misfits if node not in replaced]
+
+    # Which name each slot is freed by, so renames and creates can wait
+    freed_by = {}
+    for node in sorted(surplus + replaced, key=lambda n: n.name):
+        index = node_index(cluster_name, node)
+        step = add('destroy', node.name)
+        if index is not None:
+            freed_by[index] = step
+
+    taken = set(node_index(cluster_name, node) for node in pinned + kept)
+    free = [
+        index for index in range(1, desired_count + 1)
+        if index not in taken
+    ]
+    movers = sorted(
+        (
+            node for node in kept
+            if not 1 <= (node_index(cluster_name, node) or 0) <= desired_count
+        ),
+        key=lambda n: n.name,
+    )
+
+    renamed = {}
+    for node, index in zip(movers, free):
+        renamed[node.name] = add(
+            'rename', node.name, '{}{}'.format(cluster_name, index),
+            [freed_by[index]] if index in freed_by else (),
+        )
+    for node in sorted(resized, key=lambda n: n.name):
+        add('resize', node.name, size.slug, [renamed[node.name]] if node.name in renamed else ())
+
+    missing = desired_count - len(pinned) - len(kept)
+    for index in free[len(movers):len(movers) + missing]:
+        add(
+            'create', '{}{}'.format(cluster_name, index), size.slug,
+            [freed_by[index]] if index in freed_by else (),
+        )
+
+    return actions
+
+
+def format_plan(cluster_name, actions):
+    if not actions:
+        return 'Cluster {} is in sync, nothing to do'.format(cluster_name)
+    return '\n'.join(
+        ['Cluster {}: {} change{}'.format(
+            cluster_name, len(actions), '' if len(actions) == 1 else 's',
+        )] +
+        ['  {}'.format(action) for action in actions]
+    )
+
+
+def apply_actions(actions, call_for, pool):
+    """
+    Runs the plan in rounds, each round every action whose dependencies are
+    done, at once through the pool. An action whose dependency failed is
+    not run and fails too.
+
+    :param call_for: callable taking a SyncAction, returning the callable
+        doing it
+    :param pool: herd.provision.ProvisionPool
+    :return: list of ProvisionResults, in plan order
+    """
+    results = {}
+    waiting = list(range(len(actions)))
+    while waiting:
+        ready = [
+            idx for idx in waiting
+            if all(dep in results for dep in actions[idx].after)
+        ]
+        waiting = [idx for idx in waiting if idx not in ready]
+
+        runnable = []
+        for idx in ready:
+            failed = [actions[dep] for dep in actions[idx].after if not results[dep].ok]
+            if failed:
+                results[idx] = ProvisionResult(
+                    actions[idx].action, actions[idx].node, None,
+                    ClusterSyncException('skipped, {} failed'.format(failed[0])),
+                )
+                print(results[idx])
+            else:
+                runnable.append(idx)
+
+        round_results = pool.run([
+            ProvisionCall(actions[idx].action, actions[idx].node, call_for(actions[idx]))
+            for idx in runnable
+        ])
+        results.update(zip(runnable, round_results))
+
+    return [results[idx] for idx in range(len(actions))]
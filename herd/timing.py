@@ -0,0 +1,164 @@
+"""
+Per phase timing.
+
+Code that may be slow wraps itself in `span(phase, node)`: provider API
+calls, the SSH handshake, waiting for a node to come up, gathering facts,
+every remote command and every transfer. Spans cost next to nothing until
+a Profiler is enabled (herd --profile), which then records them all and can
+write a Chrome trace (load it in chrome://tracing or Perfetto) and
+summarize where the time went.
+"""
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+
+API = 'api'
+CONNECT = 'connect'
+READY = 'ready'
+FACTS = 'facts'
+EXECUTE = 'execute'
+COPY = 'copy'
+
+
+class Span(namedtuple('Span', ['phase', 'name', 'node', 'start', 'end', 'thread'])):
+    """
+    :phase: one of the phase names above
+    :name: what was timed, e.g. the command
+    :node: node it was timed for, None for process wide work
+    """
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Profiler(object):
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, phase, name, node, start, end):
+        span = Span(phase, name, node, start, end, threading.current_thread().name)
+        with self._lock:
+            self.spans.append(span)
+
+    def trace_events(self):
+        """Chrome trace events, one row per node plus one per thread for the rest"""
+        rows = {}
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            row = span.node or 'thread {}'.format(span.thread)
+            if row not in rows:
+                rows[row] = len(rows) + 1
+                events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': rows[row],
+                    'args': {'name': row},
+                })
+            events.append({
+                'name': span.name,
+                'cat': span.phase,
+                'ph': 'X',
+                'ts': int((span.start - self.started) * 1e6),
+                'dur': int(span.duration * 1e6),
+                'pid': os.getpid(),
+                'tid': rows[row],
+                'args': {'node': span.node, 'phase': span.phase},
+            })
+        return events
+
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+    def phase_totals(self):
+        """dict of phase -> (seconds spent across all nodes, number of spans)"""
+        totals = {}
+        for span in self.spans:
+            seconds, count = totals.get(span.phase, (0, 0))
+            totals[span.phase] = (seconds + span.duration, count + 1)
+        return totals
+
+    def node_times(self):
+        """dict of node -> seconds from its first span starting to its last ending"""
+        bounds = {}
+        for span in self.spans:
+            if span.node is None:
+                continue
+            start, end = bounds.get(span.node, (span.start, span.end))
+            bounds[span.node] = (min(start, span.start), max(end, span.end))
+        return {node: end - start for node, (start, end) in bounds.items()}
+
+    def summary(self, top=5):
+        lines = ['Profile: {:.2f}s total'.format(self.clock() - self.started)]
+
+        lines.append('Time per phase (summed over nodes):')
+        totals = self.phase_totals()
+        for phase, (seconds, count) in sorted(totals.items(), key=lambda i: -i[1][0]):
+            lines.append('  {:<10} {:>9.3f}s in {} spans'.format(phase, seconds, count))
+
+        lines.append('Slowest nodes:')
+        node_times = self.node_times()
+        for node, seconds in sorted(node_times.items(), key=lambda i: -i[1])[:top]:
+            lines.append('  {:<20} {:>9.3f}s'.format(node, seconds))
+
+        lines.append('Slowest steps:')
+        for span in sorted(self.spans, key=lambda s: -s.duration)[:top]:
+            lines.append('  {:<10} {:>9.3f}s {} {}'.format(
+                span.phase, span.duration, span.node or '-', span.name,
+            ))
+        return '\n'.join(lines)
+
+
+_profiler = None
+
+
+def enable(clock=time.time):
+    """Start recording spans in this process"""
+    global _profiler
+    _profiler = Profiler(clock)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def active():
+    return _profiler
+
+
+def now():
+    profiler = _profiler
+    return profiler.clock() if profiler is not None else 0
+
+
+def record(phase, name, node, start):
+    """Record a span that started at `start` (taken from now()) and ends now"""
+    profiler = _profiler
+    if profiler is not None:
+        profiler.record(phase, str(name), node, start, profiler.clock())
+
+
+@contextmanager
+def span(phase, name, node=None):
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+
+    start = profiler.clock()
+    try:
+        yield
+    finally:
+        profiler.record(phase, str(name), node, start, profiler.clock())
@@ -15,16 +15,15 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
     ],
     install_requires=[
-        'cached-property',
         'paramiko',
-        'python-digitalocean',
         'pytoml',
+        'requests',
         'scp'
     ],
     scripts=[
         'bin/herd',
-    ]
+    ],
 )
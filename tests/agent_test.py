@@ -0,0 +1,122 @@
+import io
+import os
+import threading
+
+import pytest
+import pytoml
+
+import herd.pool
+from herd import agent
+from herd import handler
+from herd.agent import AgentServer
+from herd.cli import dispatch
+from herd.facts import get_fact_cache
+from herd.scheduler import get_scheduler
+
+
+@pytest.fixture
+def socket_path(tmpdir):
+    return str(tmpdir.join('agent.sock'))
+
+
+def start(path, dispatch):
+    server = AgentServer(path, dispatch)
+
+    def serve():
+        server.serve_forever()
+        server.server_close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server, thread
+
+
+def test_commands_run_in_the_agent(tmpdir, socket_path):
+    seen = []
+
+    def fake_dispatch(argv):
+        seen.append((argv, os.getcwd()))
+        print('ran {}'.format(' '.join(argv)))
+        return 3
+
+    server, thread = start(socket_path, fake_dispatch)
+    out = io.StringIO()
+    try:
+        with tmpdir.as_cwd():
+            assert agent.forward(['exec', 'web', 'uptime'], socket_path, stdout=out) == 3
+    finally:
+        assert agent.stop(socket_path)
+        thread.join(5)
+
+    assert seen == [(['exec', 'web', 'uptime'], str(tmpdir))]
+    assert out.getvalue() == 'ran exec web uptime\n'
+    # Stopped agents clean up, and the CLI then runs commands itself
+    assert not os.path.exists(socket_path)
+    assert agent.forward(['info', 'web'], socket_path) is None
+
+
+def test_errors_come_back_as_exit_status(tmpdir, socket_path):
+    server, thread = start(socket_path, dispatch)
+    err = io.StringIO()
+    try:
+        status = agent.forward(
+            ['info', 'web', '--config', str(tmpdir.join('missing.toml'))], socket_path,
+            stdout=io.StringIO(), stderr=err,
+        )
+    finally:
+        server.shutdown()
+        thread.join(5)
+
+    assert status == 2
+    assert 'No such file or directory' in err.getvalue()
+
+
+class FakeClient(object):
+    """An SSHClient that is its own healthy transport"""
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return True
+
+    def send_ignore(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_every_request_gets_its_own_config(tmpdir, socket_path, monkeypatch):
+    connected = []
+    monkeypatch.setattr(handler, 'open_client', lambda config, key: connected.append(
+        config['ssh']['password'],
+    ) or FakeClient())
+    seen = []
+
+    def fake_dispatch(argv):
+        with open(argv[0]) as f:
+            config = pytoml.load(f)
+        handler.NodeHandler.connect(config, '10.0.0.1').release()
+        seen.append((get_scheduler(config).max_sessions, get_fact_cache(config).ttl))
+        return 0
+
+    for name, password, sessions, ttl in (('a', 'one', 8, 30), ('b', 'two', 16, 5)):
+        tmpdir.join('{}.toml'.format(name)).write(
+            '[ssh]\npath = "/key"\npassword = "{}"\n'
+            '[herd]\nmax_sessions = {}\nfacts_ttl = {}\n'.format(password, sessions, ttl)
+        )
+
+    herd.pool.close_pool()
+    server, thread = start(socket_path, fake_dispatch)
+    try:
+        for name in ('a', 'a', 'b', 'a'):
+            assert agent.forward([str(tmpdir.join('{}.toml'.format(name)))], socket_path) == 0
+    finally:
+        server.shutdown()
+        thread.join(5)
+        herd.pool.close_pool()
+
+    # Pooled connections are reused until a config brings another passphrase
+    assert connected == ['one', 'two', 'one']
+    assert seen == [(8, 30), (8, 30), (16, 5), (8, 30)]
@@ -0,0 +1,69 @@
+import asyncio
+import os
+from concurrent import futures
+
+from herd import aio
+from herd.output import OutputLine
+from herd.output import STDERR
+from herd.output import STDOUT
+
+
+class FakeChannel(object):
+    """Just enough of a paramiko Channel to drive run_remote"""
+
+    def __init__(self, stdout, stderr, status):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+        self.status = status
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b'x')
+        self.closed = False
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return not self.stdout and not self.stderr
+
+    @property
+    def exit_status(self):
+        return self.status
+
+    def fileno(self):
+        return self.read_fd
+
+    def close(self):
+        self.closed = True
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+def test_run_remote_collects_output_and_status(monkeypatch):
+    channel = FakeChannel([b'hello\n', b'world'], [b'oops\n'], 3)
+    monkeypatch.setattr(aio, 'open_channel', lambda client, command: channel)
+    lines = []
+
+    loop = asyncio.new_event_loop()
+    pool = futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        status = loop.run_until_complete(
+            aio.run_remote(loop, pool, None, 'echo hello', lines.append)
+        )
+    finally:
+        pool.shutdown()
+        loop.close()
+
+    assert status == 3
+    assert lines == [
+        OutputLine(STDOUT, 'hello'), OutputLine(STDERR, 'oops'), OutputLine(STDOUT, 'world'),
+    ]
+    assert channel.closed
@@ -0,0 +1,123 @@
+import json
+import threading
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import pytest
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+from herd.api import APIException
+from herd.api import DigitalOceanClient
+
+
+def droplet_json(idx, tags=()):
+    return {
+        'id': idx, 'name': 'web{}'.format(idx), 'status': 'active', 'size_slug': 's-1vcpu-1gb',
+        'networks': {'v4': [
+            {'type': 'public', 'ip_address': '1.1.1.{}'.format(idx)},
+            {'type': 'private', 'ip_address': '10.0.0.{}'.format(idx)},
+        ]},
+        'tags': list(tags),
+    }
+
+
+class FakeAPI(BaseAdapter):
+    """Serves the slice of the DigitalOcean API under test, in memory"""
+
+    def __init__(self, droplets=0):
+        super(FakeAPI, self).__init__()
+        self.droplets = [droplet_json(idx, ['herd-web'] if idx % 2 else []) for idx in range(1, droplets + 1)]
+        self.requests = []
+        self.threads = set()
+        self.status = None
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.requests.append((request.method, url.path, query, request.headers.get('If-None-Match')))
+        self.threads.add(threading.current_thread().name)
+
+        response = Response()
+        response.request = request
+        response.url = request.url
+        response.headers['Content-Type'] = 'application/json'
+        body = {}
+        if self.status is not None:
+            response.status_code = self.status
+            body = {'id': 'too_many_requests', 'message': 'API rate limit exceeded'}
+        elif url.path.endswith('/droplets') and request.method == 'GET':
+            droplets = [
+                d for d in self.droplets
+                if 'tag_name' not in query or query['tag_name'] in d['tags']
+            ]
+            page, per_page = int(query['page']), int(query['per_page'])
+            response.status_code = 200
+            body = {
+                'droplets': droplets[(page - 1) * per_page:page * per_page],
+                'meta': {'total': len(droplets)},
+            }
+        elif url.path.endswith('/sizes'):
+            if request.headers.get('If-None-Match') == '"v1"':
+                response.status_code = 304
+            else:
+                response.status_code = 200
+                response.headers['ETag'] = '"v1"'
+                body = {'sizes': [{
+                    'slug': 's-1vcpu-1gb', 'vcpus': 1, 'memory': 1024, 'disk': 25,
+                    'price_monthly': 5,
+                }], 'meta': {'total': 1}}
+        elif url.path.endswith('/actions'):
+            response.status_code = 201
+            body = {'action': dict(json.loads(request.body.decode('utf-8')), id=1, status='completed')}
+        response._content = b'' if response.status_code == 304 else json.dumps(body).encode('utf-8')
+        return response
+
+    def close(self):
+        pass
+
+
+def client_with(api):
+    client = DigitalOceanClient('token', url='https://api.test/v2/')
+    client.session.mount('https://', api)
+    return client
+
+
+def test_pages_are_fetched_at_once_and_filtered_by_tag():
+    api = FakeAPI(droplets=450)
+    client = client_with(api)
+
+    droplets = client.list_droplets()
+    assert [d.id for d in droplets] == list(range(1, 451))
+    assert droplets[0].ip_address == '1.1.1.1'
+    assert droplets[0].private_ip_address == '10.0.0.1'
+    assert sorted(query['page'] for _, _, query, _ in api.requests) == ['1', '2', '3']
+    assert len(api.threads) > 1
+
+    assert len(client.list_droplets(tag='herd-web')) == 225
+    assert api.requests[-1][2]['tag_name'] == 'herd-web'
+
+
+def test_catalogs_are_conditional_on_their_etag():
+    api = FakeAPI()
+    client = client_with(api)
+
+    sizes, etag = client.list_sizes()
+    assert ([size.slug for size in sizes], etag) == (['s-1vcpu-1gb'], '"v1"')
+    assert client.list_sizes(etag) == (None, '"v1"')
+    assert [etag for _, _, _, etag in api.requests] == [None, '"v1"']
+
+
+def test_actions_and_errors():
+    api = FakeAPI()
+    client = client_with(api)
+
+    action = client.rename(7, 'web2')
+    assert api.requests[-1][:2] == ('POST', '/v2/droplets/7/actions')
+    assert (action['type'], action['name']) == ('rename', 'web2')
+    assert client.wait_for_action(action)
+
+    api.status = 429
+    with pytest.raises(APIException) as e:
+        client.shutdown(7)
+    assert e.value.throttled
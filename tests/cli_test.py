@@ -0,0 +1,94 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import herd.cli
+from herd.handler import ClusterExecutionException
+from herd.handler import ClusterExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loads the CLI and parses a config the way every subcommand does, then
+# reports what got imported and how long it took
+STARTUP = """
+import json, sys, time
+started = time.time()
+import herd.cli as cli
+args, plan = cli.parse_args(cli.argparse.ArgumentParser(), ['--config', {config!r}])
+import herd.cluster
+print(json.dumps({{
+    'seconds': time.time() - started,
+    'modules': sorted(m for m in {heavy!r} if m in sys.modules),
+}}))
+"""
+
+HEAVY = ['paramiko', 'scp', 'digitalocean', 'requests', 'cryptography']
+
+# Generous, importing paramiko and its crypto alone takes about this long
+STARTUP_BUDGET = 0.5
+
+
+@pytest.fixture
+def config_path(tmpdir):
+    path = tmpdir.join('config.toml')
+    path.write('\n'.join([
+        '[ssh]',
+        'path = "~/.ssh/id_rsa"',
+        '[clusters.web]',
+        'provider = "digitalocean"',
+        'server_count = 2',
+    ]))
+    return str(path)
+
+
+def env(config_path):
+    # Compiled plans are cached, and the agent listens, under ~/.cache/herd
+    return dict(os.environ, PYTHONPATH=ROOT, HOME=os.path.dirname(config_path))
+
+
+def startup(config_path):
+    output = subprocess.check_output([sys.executable, '-c', STARTUP.format(
+        config=config_path, heavy=HEAVY,
+    )], cwd=ROOT, env=env(config_path))
+    return json.loads(output.decode('utf-8'))
+
+
+def test_startup_skips_provider_and_ssh_libraries(config_path):
+    assert startup(config_path)['modules'] == []
+
+
+def test_startup_import_budget(config_path):
+    # Best of a few, so a busy machine doesn't fail it
+    assert min(startup(config_path)['seconds'] for _ in range(3)) < STARTUP_BUDGET
+
+
+def test_invalid_config_exits_before_running(tmpdir):
+    path = tmpdir.join('config.toml')
+    path.write('[roles.app]\nclusters = ["missing"]\n')
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'bin', 'herd'), 'deploy', 'app', '--config', str(path)],
+        cwd=ROOT, env=env(str(path)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    assert result.returncode == 2
+    assert b'role app uses unknown cluster missing' in result.stderr
+    assert b'paramiko' not in result.stderr
+
+
+def test_failed_nodes_are_listed_with_a_failing_status(config_path, monkeypatch, capsys):
+    def execute_parallel(config, commands, cluster):
+        raise ClusterExecutionException(cluster, {
+            'web2': ValueError('apt-get exited with status 100'),
+            'web1': ValueError('unreachable'),
+        })
+    monkeypatch.setenv('HOME', os.path.dirname(config_path))
+    monkeypatch.setattr(ClusterExecutor, 'execute_parallel', staticmethod(execute_parallel))
+
+    assert herd.cli.dispatch(['install', 'web', 'nginx', '--config', config_path]) == 1
+    assert capsys.readouterr().out.splitlines() == [
+        'web1 (web): FAILED unreachable',
+        'web2 (web): FAILED apt-get exited with status 100',
+    ]
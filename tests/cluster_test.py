@@ -0,0 +1,141 @@
+import pytest
+
+import herd.cluster
+from herd.api import Droplet
+from herd.api import Size
+from herd.cluster import cluster_manager_for_provider
+from herd.cluster import ClusterManager
+from herd.cluster import DigitalOceanClusterManager
+from herd.cluster import missing_methods
+from herd.cluster import PROVIDER_TO_CLUSTER_MANAGER
+from herd.cluster import ProviderException
+
+
+def droplet(name, status='active', ip_address=None, size_slug=None):
+    return Droplet(1, name, status, size_slug, ip_address, None, ())
+
+
+def make_manager(tmpdir, nodes):
+    config = {
+        'herd': {'cache_dir': str(tmpdir)},
+        'providers': {'digitalocean': {'token': 'token'}},
+    }
+    manager = DigitalOceanClusterManager(config)
+    manager.inventory.put('nodes', nodes)
+    return manager
+
+
+def test_cluster_lookups_are_exact(tmpdir):
+    manager = make_manager(tmpdir, [
+        droplet('app1', ip_address='10.0.0.1'),
+        droplet('app10', 'new', ip_address='10.0.0.10'),
+        droplet('app11', ip_address='10.0.0.11'),
+    ])
+
+    assert [n.name for n in manager.node_in_cluster('app')] == ['app1', 'app10', 'app11']
+    assert manager.node_in_cluster('app1') == []
+    assert manager.node_index('app', 'app10') == 10
+    assert manager.ip_for_node('app11') == '10.0.0.11'
+    assert manager.ip_for_node('app12') is None
+    assert [n.name for n in manager.cluster_status('app')['new']] == ['app10']
+
+
+def test_index_follows_node_list(tmpdir):
+    manager = make_manager(tmpdir, [droplet('app1')])
+    assert len(manager.node_in_cluster('app')) == 1
+
+    manager.inventory.put('nodes', [droplet('app1'), droplet('app2')])
+    assert len(manager.node_in_cluster('app')) == 2
+
+
+def size(slug, vcpus=1, memory=1024, disk=25, price_monthly=5):
+    return Size(slug, vcpus, memory, disk, price_monthly)
+
+
+def sync_manager(tmpdir, monkeypatch, nodes):
+    manager = make_manager(tmpdir, nodes)
+    manager.inventory.put('sizes', [
+        size('tiny', memory=128, price_monthly=2),
+        size('big-disk', memory=128, disk=100, price_monthly=3),
+        size('s-1vcpu-1gb'),
+    ])
+    calls = []
+    monkeypatch.setattr(manager, 'destroy_node', lambda node: calls.append(('destroy', node.name)))
+    monkeypatch.setattr(manager, 'rename_node', lambda node, name: calls.append(('rename', node.name, name)))
+    monkeypatch.setattr(manager, 'resize_node', lambda node, size: calls.append(('resize', node.name, size.slug)))
+    monkeypatch.setattr(manager, 'launch_node', lambda cfg: calls.append(('create', cfg.name, cfg.size)))
+    return manager, calls
+
+
+def sized(name, slug, status='active'):
+    return droplet(name, status, size_slug=slug)
+
+
+def test_start_cluster_runs_every_change(tmpdir, monkeypatch):
+    manager, calls = sync_manager(tmpdir, monkeypatch, [
+        sized('app1', 'tiny'), sized('app3', 'big-disk'), sized('app5', 's-1vcpu-1gb'),
+        sized('app7', 's-1vcpu-1gb'),
+    ])
+
+    results = manager.start_cluster('app', {'server_count': 3, 'min_ram': 512})
+
+    # Nodes that fit are kept first, so app3 is surplus; app1 is resized in place
+    assert all(result.ok for result in results)
+    assert sorted(calls) == [
+        ('destroy', 'app3'),
+        ('rename', 'app5', 'app2'),
+        ('rename', 'app7', 'app3'),
+        ('resize', 'app1', 's-1vcpu-1gb'),
+    ]
+
+
+def test_synced_cluster_changes_nothing(tmpdir, monkeypatch):
+    manager, calls = sync_manager(tmpdir, monkeypatch, [
+        sized('app1', 's-1vcpu-1gb'), sized('app2', 's-1vcpu-1gb'),
+    ])
+    assert manager.start_cluster('app', {'server_count': 2, 'min_ram': 512}) == []
+
+    # A dry run only prints
+    assert manager.start_cluster('app', {'server_count': 3, 'min_ram': 512}, dry_run=True) == []
+    assert calls == []
+
+
+class EntryPoint(object):
+
+    def __init__(self, name, loaded):
+        self.name = name
+        self.loaded = loaded
+
+    def load(self):
+        return self.loaded
+
+
+class PartialManager(ClusterManager):
+
+    @property
+    def provider(self):
+        return 'partial'
+
+    def shutdown_node(self, node):
+        pass
+
+
+def test_providers_are_discovered_and_must_be_complete(monkeypatch):
+    for manager_class in PROVIDER_TO_CLUSTER_MANAGER.values():
+        assert missing_methods(manager_class) == []
+
+    monkeypatch.setattr(herd.cluster, 'provider_entry_points', lambda: {
+        'linode': EntryPoint('linode', DigitalOceanClusterManager),
+        'partial': EntryPoint('partial', PartialManager),
+        'broken': EntryPoint('broken', object),
+    })
+    assert herd.cluster.provider_names() == ['broken', 'digitalocean', 'fake', 'linode', 'partial']
+    assert cluster_manager_for_provider('linode') is DigitalOceanClusterManager
+
+    with pytest.raises(ProviderException) as e:
+        cluster_manager_for_provider('partial')
+    assert 'nodes_list, refresh_nodes_list, best_node_size_match' in str(e.value)
+    with pytest.raises(ProviderException):
+        cluster_manager_for_provider('broken')
+    with pytest.raises(ValueError):
+        cluster_manager_for_provider('nowhere')
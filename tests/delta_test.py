@@ -0,0 +1,225 @@
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+
+import herd.delta
+from herd.delta import digest_cache
+from herd.delta import DigestCache
+from herd.delta import file_digest
+from herd.delta import link_command
+from herd.delta import link_lines
+from herd.delta import Manifest
+from herd.delta import store_query_command
+from herd.delta import store_upload_command
+from herd.delta import tree_unpack_command
+from herd.delta import write_blob_tar
+from herd.delta import parse_remote_digests
+from herd.delta import unpack_command
+from herd.delta import write_tar
+from herd.delta import write_tree_tar
+
+
+def make_tree(root):
+    root.join('a.txt').write('alpha')
+    root.mkdir('sub').join('b.txt').write('beta')
+    return root
+
+
+def remote_digests(manifest):
+    output = subprocess.check_output(['sh', '-c', manifest.remote_digest_command()])
+    return parse_remote_digests(output.decode('utf-8').splitlines())
+
+
+def send(manifest, relpaths, compress=False):
+    process = subprocess.Popen(
+        ['sh', '-c', unpack_command(manifest.remote_dir, compress)],
+        stdin=subprocess.PIPE,
+    )
+    write_tar(process.stdin, manifest, relpaths, compress)
+    process.stdin.close()
+    assert process.wait() == 0
+
+
+def test_file_manifest_targets_dest(tmpdir):
+    src = tmpdir.join('release.tar')
+    src.write('payload')
+    manifest = Manifest.build(str(src), '/srv/app/release.tar')
+
+    assert manifest.remote_dir == '/srv/app'
+    assert manifest.files == {'release.tar': (str(src), file_digest(str(src)))}
+
+
+def test_directory_manifest_is_relative(tmpdir):
+    src = make_tree(tmpdir.mkdir('src'))
+    manifest = Manifest.build(str(src), '/srv/app/', recursive=True)
+
+    assert manifest.remote_dir == '/srv/app'
+    assert sorted(manifest.files) == ['a.txt', 'sub/b.txt']
+
+
+def test_only_changed_files_are_sent(tmpdir):
+    src = make_tree(tmpdir.mkdir('src'))
+    dest = tmpdir.join('dest')
+    manifest = Manifest.build(str(src), str(dest), recursive=True)
+
+    assert manifest.changed(remote_digests(manifest)) == ['a.txt', 'sub/b.txt']
+    send(manifest, manifest.changed({}), compress=True)
+    assert dest.join('sub', 'b.txt').read() == 'beta'
+    assert manifest.changed(remote_digests(manifest)) == []
+
+    src.join('a.txt').write('changed')
+    manifest = Manifest.build(str(src), str(dest), recursive=True)
+    assert manifest.changed(remote_digests(manifest)) == ['a.txt']
+
+    send(manifest, ['a.txt'])
+    assert dest.join('a.txt').read() == 'changed'
+
+
+def owners(write):
+    archive = io.BytesIO()
+    write(archive)
+    archive.seek(0)
+    with tarfile.open(fileobj=archive) as tar:
+        return [(m.name, m.uid, m.gid, m.uname, m.gname) for m in tar.getmembers()]
+
+
+def test_sent_files_belong_to_whoever_unpacks_them(tmpdir):
+    src = make_tree(tmpdir.mkdir('src'))
+    manifest = Manifest.build(str(src), '/srv/app', recursive=True)
+
+    assert owners(lambda f: write_tar(f, manifest, sorted(manifest.files))) == [
+        ('a.txt', 0, 0, '', ''), ('sub/b.txt', 0, 0, '', ''),
+    ]
+    blob = manifest.blob('a.txt')
+    assert owners(lambda f: write_blob_tar(f, manifest, {blob: 'a.txt'})) == [
+        (blob, 0, 0, '', ''),
+    ]
+
+
+def test_large_files_hash_the_same_through_mmap(tmpdir, monkeypatch):
+    monkeypatch.setattr(herd.delta, 'MMAP_THRESHOLD', 1024)
+    big = tmpdir.join('big')
+    big.write_binary(os.urandom(3 * 1024 + 7))
+
+    assert file_digest(str(big)) == hashlib.sha256(big.read_binary()).hexdigest()
+
+
+def test_digests_are_cached_by_size_and_mtime(tmpdir, monkeypatch):
+    src = make_tree(tmpdir.mkdir('src'))
+    for path in (src.join('a.txt'), src.join('sub', 'b.txt')):
+        path.setmtime(path.mtime() - 60)
+    hashed = []
+    monkeypatch.setattr(herd.delta, 'file_digest', lambda path: hashed.append(path) or 'digest')
+
+    path = str(tmpdir.join('cache', 'digests.json'))
+    Manifest.build(str(src), '/srv/app', recursive=True, digests=DigestCache(path))
+    assert len(hashed) == 2
+
+    # A new process reads them back; only what changed is hashed again
+    src.join('a.txt').write('alpha, longer')
+    manifest = Manifest.build(str(src), '/srv/app', recursive=True, digests=DigestCache(path))
+    assert hashed[2:] == [str(src.join('a.txt'))]
+    assert manifest.files['sub/b.txt'][1] == 'digest'
+
+
+def test_digest_cache_lives_in_the_configured_cache_dir(tmpdir):
+    cache = digest_cache({'herd': {'cache_dir': str(tmpdir)}})
+    assert cache.path == str(tmpdir.join(herd.delta.DIGEST_CACHE_FILE))
+    assert digest_cache({'herd': {'cache_dir': str(tmpdir)}}) is cache
+
+
+def on_node(home, command, lines=None, write=None):
+    process = subprocess.Popen(
+        ['sh', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        env=dict(os.environ, HOME=str(home)),
+    )
+    if write is not None:
+        write(process.stdin)
+    else:
+        process.stdin.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+    process.stdin.close()
+    output = process.stdout.read().decode('utf-8').splitlines()
+    assert process.wait() == 0
+    return output
+
+
+def cached_copy(home, manifest):
+    """What handler.cached_copy runs on the node, run locally"""
+    relpaths = sorted(manifest.files)
+    blobs = {}
+    for relpath in relpaths:
+        blobs.setdefault(manifest.blob(relpath), relpath)
+    present = set(on_node(home, store_query_command(), sorted(blobs)))
+    missing = {blob: relpath for blob, relpath in blobs.items() if blob not in present}
+    if missing:
+        on_node(home, store_upload_command(compress=True), write=lambda stdin: write_blob_tar(
+            stdin, manifest, missing, compress=True,
+        ))
+    on_node(home, link_command(manifest.remote_dir), link_lines(manifest, relpaths))
+    return sorted(missing)
+
+
+def test_cached_copies_send_each_blob_once(tmpdir):
+    home = tmpdir.mkdir('home')
+    src = make_tree(tmpdir.mkdir('src'))
+    src.join('sub', 'same.txt').write('alpha')
+
+    first = Manifest.build(str(src), str(tmpdir.join('first')), recursive=True)
+    assert len(cached_copy(home, first)) == 2
+    assert tmpdir.join('first', 'sub', 'same.txt').read() == 'alpha'
+    store = home.join('.cache', 'herd', 'blobs')
+    assert tmpdir.join('first', 'a.txt').samefile(store.join(first.blob('a.txt')))
+
+    # Already in the store, and copying over the same links again is fine
+    second = Manifest.build(str(src), str(tmpdir.join('second')), recursive=True)
+    assert cached_copy(home, second) == []
+    assert cached_copy(home, first) == []
+    assert tmpdir.join('second', 'sub', 'b.txt').read() == 'beta'
+    assert len(store.listdir()) == 2
+
+
+def test_blobs_edited_through_a_link_are_sent_again(tmpdir):
+    home = tmpdir.mkdir('home')
+    src = make_tree(tmpdir.mkdir('src'))
+    first = Manifest.build(str(src), str(tmpdir.join('first')), recursive=True)
+    cached_copy(home, first)
+
+    with open(str(tmpdir.join('first', 'a.txt')), 'a') as f:
+        f.write(' edited')
+    second = Manifest.build(str(src), str(tmpdir.join('second')), recursive=True)
+    assert cached_copy(home, second) == [first.blob('a.txt')]
+    assert tmpdir.join('second', 'a.txt').read() == 'alpha'
+
+    # Putting the first copy back relinks it to the fresh blob
+    assert cached_copy(home, first) == []
+    assert tmpdir.join('first', 'a.txt').read() == 'alpha'
+
+
+def send_tree(src, dest):
+    process = subprocess.Popen(['sh', '-c', tree_unpack_command(src, dest)], stdin=subprocess.PIPE)
+    write_tree_tar(process.stdin, src)
+    process.stdin.close()
+    assert process.wait() == 0
+
+
+def test_trees_land_where_scp_would_put_them(tmpdir):
+    src = make_tree(tmpdir.mkdir('src'))
+    src.mkdir('empty')
+    src.join('link').mksymlinkto('a.txt')
+    src.join('run.sh').write('#!/bin/sh')
+    src.join('run.sh').chmod(0o755)
+
+    # A new dest becomes the tree, an existing one gets the tree inside it
+    send_tree(str(src), str(tmpdir.join('new')))
+    send_tree(str(src) + '/', str(tmpdir.mkdir('existing')))
+
+    for dest in (tmpdir.join('new'), tmpdir.join('existing', 'src')):
+        assert sorted(dest.listdir(lambda p: True)) == sorted(
+            dest.join(name) for name in ('a.txt', 'empty', 'link', 'run.sh', 'sub')
+        )
+        assert dest.join('sub', 'b.txt').read() == 'beta'
+        assert dest.join('empty').check(dir=1)
+        assert dest.join('link').readlink() == 'a.txt'
+        assert dest.join('run.sh').stat().mode & 0o777 == 0o755
@@ -0,0 +1,60 @@
+from herd.facts import FactCache
+from herd.facts import MARKER
+from herd.facts import parse_facts
+
+
+def section(name, *lines):
+    return ['{} {}'.format(MARKER, name)] + list(lines)
+
+
+def test_parse_facts():
+    facts = parse_facts(
+        section('os', 'NAME="Ubuntu"', 'VERSION_ID="22.04"') +
+        section(
+            'packages',
+            'install ok installed nginx 1.18.0-6ubuntu14',
+            'deinstall ok config-files apache2 2.4.52',
+            'install ok installed git 1:2.34.1',
+        ) +
+        section(
+            'systemd',
+            'nginx.service loaded active running A high performance web server',
+            'cron.service loaded inactive dead Regular background program',
+        ) +
+        section('apt_age', '120')
+    )
+
+    assert facts.os_release['VERSION_ID'] == '22.04'
+    assert facts.has_package('nginx')
+    assert facts.has_package('git=1:2.34.1')
+    assert not facts.has_package('git=1:2.30')
+    assert not facts.has_package('apache2')
+    assert facts.service_state('nginx') == 'running'
+    assert facts.service_state('cron') == 'stopped'
+    assert facts.apt_age == 120
+
+
+def test_missing_facts_stay_unknown():
+    facts = parse_facts(section('os') + section('sysv', ' [ + ]  ssh', ' [ ? ]  hwclock.sh'))
+
+    assert facts.packages is None
+    assert not facts.has_package('nginx')
+    assert facts.services == {'ssh': 'running'}
+    assert facts.apt_age is None
+
+
+def test_fact_cache_expires_and_invalidates():
+    now = [0]
+    cache = FactCache(ttl=10, clock=lambda: now[0])
+    gathered = []
+
+    def gather():
+        gathered.append(1)
+        return len(gathered)
+
+    assert cache.get('10.0.0.1', gather) == 1
+    assert cache.get('10.0.0.1', gather) == 1
+    now[0] = 11
+    assert cache.get('10.0.0.1', gather) == 2
+    cache.invalidate('10.0.0.1')
+    assert cache.get('10.0.0.1', gather) == 3
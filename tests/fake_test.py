@@ -0,0 +1,214 @@
+import json
+import os
+import threading
+
+import paramiko
+import pytest
+
+from herd import timing
+from herd.cluster import manage_clusters
+from herd.cluster import manager_for_cluster
+from herd.cluster import MultiClusterSyncException
+from herd.command import parse_command
+from herd.fake import FakeCloud
+from herd.fake import FakeSSHServer
+from herd.fake import loopback_addresses
+from herd.facts import GATHER_COMMAND
+from herd.fake import register_cloud
+from herd.handler import ClusterExecutionException
+from herd.handler import ClusterExecutor
+from herd.handler import NodeHandler
+from herd.handler import stream
+from herd.herd import Herd
+
+
+@pytest.fixture(scope='module')
+def key_path(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('keys').join('id_ecdsa'))
+    paramiko.ECDSAKey.generate().write_private_key_file(path)
+    return path
+
+
+def fake_setup(tmpdir, key_path, nodes, **server_kwargs):
+    addresses = loopback_addresses(nodes + 2)
+    server = FakeSSHServer(addresses, **server_kwargs).start()
+    cloud = register_cloud(FakeCloud(os.path.basename(str(tmpdir)), addresses))
+    cloud.add_nodes('web', nodes)
+    config = {
+        'herd': {
+            'cache_dir': str(tmpdir.join('cache')),
+            'output': 'json',
+            'output_file': str(tmpdir.join('output.jsonl')),
+            'ready_timeout': 10,
+        },
+        'ssh': {'path': key_path, 'port': server.port},
+        'providers': {'fake': {'cloud': cloud.name}},
+        'clusters': {'web': {'provider': 'fake', 'server_count': nodes}},
+    }
+    return config, cloud, server
+
+
+def events(config):
+    with open(config['herd']['output_file']) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_execute_parallel_end_to_end(tmpdir, key_path):
+    config, cloud, server = fake_setup(tmpdir, key_path, 3)
+    src = tmpdir.join('motd')
+    src.write('hello')
+    profiler = timing.enable()
+    try:
+        ClusterExecutor.execute_parallel(config, [
+            parse_command('update', None),
+            parse_command('install', 'nginx'),
+            parse_command('copy', {'src': str(src), 'dest': '/etc/motd'}),
+            parse_command('start', 'nginx'),
+        ], 'web')
+    finally:
+        timing.disable()
+        server.stop()
+
+    statuses = [e for e in events(config) if e['event'] == 'status']
+    assert len(statuses) == 3 * 3
+    assert all(e['status'] == 0 for e in statuses)
+    assert sorted(server.received.values()) == [5, 5, 5]
+    assert set(profiler.node_times()) == {'web1', 'web2', 'web3'}
+    assert set(profiler.phase_totals()) == {'api', 'ready', 'connect', 'facts', 'execute', 'copy'}
+
+
+def test_facts_are_only_gathered_for_commands_they_could_skip(tmpdir, key_path):
+    config, cloud, server = fake_setup(tmpdir, key_path, 2)
+    src = tmpdir.join('motd')
+    src.write('hello')
+    try:
+        ClusterExecutor.execute_parallel(config, [
+            parse_command('exec', 'uptime'),
+            parse_command('copy', {'src': str(src), 'dest': '/etc/motd'}),
+        ], 'web')
+        assert not any(command == GATHER_COMMAND for _, command in server.commands)
+
+        ClusterExecutor.execute_parallel(config, [parse_command('start', 'nginx')], 'web')
+        assert sum(command == GATHER_COMMAND for _, command in server.commands) == 2
+    finally:
+        server.stop()
+
+
+def test_recursive_copies_are_one_tar_stream(tmpdir, key_path):
+    config, cloud, server = fake_setup(tmpdir, key_path, 2)
+    src = tmpdir.mkdir('app')
+    for idx in range(50):
+        src.join('{}.py'.format(idx)).write('print({})'.format(idx))
+    try:
+        ClusterExecutor.copy_parallel(config, str(src), '/srv/app', 'web', recursive=True)
+    finally:
+        server.stop()
+
+    copies = [command for _, command in server.commands if 'tar -xzf' in command]
+    assert len(copies) == 2
+    assert not any(command.startswith('scp ') for _, command in server.commands)
+    assert all(received > 0 for received in server.received.values())
+
+
+def test_stream_gives_up_when_its_writer_fails(tmpdir, key_path):
+    config, cloud, server = fake_setup(tmpdir, key_path, 1)
+    handler = NodeHandler.connect(config, server.addresses[0])
+    outcome = []
+
+    def unreadable(stdin):
+        stdin.write(b'partial')
+        raise PermissionError('unreadable')
+
+    def run():
+        try:
+            stream(handler, 'tar -xf - -C /srv/app', unreadable)
+        except PermissionError as e:
+            outcome.append(e)
+
+    try:
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        assert not thread.is_alive()
+        assert [str(e) for e in outcome] == ['unreadable']
+    finally:
+        handler.discard()
+        server.stop()
+
+
+def test_failures_are_reported_per_node(tmpdir, key_path):
+    config, cloud, server = fake_setup(tmpdir, key_path, 4, failure_rate=1)
+    try:
+        with pytest.raises(ClusterExecutionException) as e:
+            ClusterExecutor.execute_parallel(config, [parse_command('stop', 'nginx')], 'web')
+    finally:
+        server.stop()
+
+    assert sorted(e.value.failures) == ['web1', 'web2', 'web3', 'web4']
+
+
+def test_start_cluster_against_fake_provider(tmpdir, key_path):
+    config, cloud, server = fake_setup(tmpdir, key_path, 2)
+    server.stop()
+    config['herd'].update(provision_rate=100, provision_burst=100)
+
+    manager = manager_for_cluster(config, 'web')
+    results = manager.start_cluster('web', {'provider': 'fake', 'server_count': 4})
+
+    assert [(r.action, r.node) for r in results] == [('create', 'web3'), ('create', 'web4')]
+    assert manager.node_names('web') == ['web1', 'web2', 'web3', 'web4']
+
+
+def test_nodes_can_be_listed_by_cluster_tag(tmpdir, key_path):
+    config, cloud, server = fake_setup(tmpdir, key_path, 1)
+    server.stop()
+    config['providers']['fake']['list_by_tag'] = True
+    config['herd'].update(provision_rate=100, provision_burst=100)
+
+    # web1 predates tagging, so it isn't listed and a tagged web1 is made
+    manager = manager_for_cluster(config, 'web')
+    manager.start_cluster('web', {'provider': 'fake', 'server_count': 1})
+
+    assert [(d.name, d.tags) for d in manager.nodes_list] == [('web1', ('herd-web',))]
+    assert ('list', ('herd-web',)) in [(action, args) for action, args, _ in cloud.calls]
+
+
+def test_clusters_are_managed_at_once_with_results_per_cluster(tmpdir, key_path):
+    config, cloud, server = fake_setup(tmpdir, key_path, 1)
+    server.stop()
+    config['herd'].update(provision_rate=100, provision_burst=100)
+    config['clusters']['db'] = {'provider': 'fake', 'server_count': 2}
+
+    results = manage_clusters(config, 'start', [('web', 'fake'), ('db', 'fake')])
+    assert {key: [(r.action, r.node) for r in result] for key, result in results.items()} == {
+        ('web', 'fake'): [],
+        ('db', 'fake'): [('create', 'db1'), ('create', 'db2')],
+    }
+
+    # One cluster failing doesn't stop the others
+    with pytest.raises(MultiClusterSyncException) as e:
+        manage_clusters(config, 'stop', [('web', 'fake'), ('db', 'fake'), ('db', 'nowhere')])
+    assert sorted(e.value.failures) == [('db', 'nowhere')]
+    assert sorted(e.value.results) == [('db', 'fake'), ('web', 'fake')]
+    assert sorted(d.name for d in cloud.list_droplets() if d.status == 'off') == ['db1', 'db2', 'web1']
+
+    manage_clusters(config, 'destroy', [('web', 'fake'), ('db', 'fake')])
+    assert cloud.list_droplets() == []
+
+
+@pytest.mark.parametrize('executor', ['thread', 'asyncio'])
+def test_resumed_deploy_skips_nodes_that_finished(tmpdir, key_path, executor):
+    config, cloud, server = fake_setup(tmpdir, key_path, 3)
+    config['tasks'] = {'nginx': {'install': 'nginx', 'start': 'nginx'}}
+    config['roles'] = {'web': {'clusters': ['web'], 'tasks': ['nginx']}}
+    config['herd']['executor'] = executor
+    try:
+        run_id = Herd(config=config).deploy('web')
+        sent = len(server.commands)
+        assert sent
+
+        Herd(config=config).deploy('web', resume=run_id)
+        assert len(server.commands) == sent
+    finally:
+        server.stop()
@@ -0,0 +1,226 @@
+import os
+import subprocess
+import threading
+import time
+
+from herd import handler
+from herd import timing
+from herd.command import parse_command
+from herd.graph import TaskPlan
+from herd.handler import ClusterExecutor
+from herd.output import OutputLine
+from herd.output import Sink
+from herd.output import STDOUT
+
+
+class FakeManager(object):
+
+    def ip_for_node(self, node):
+        return 'public-{}'.format(node)
+
+    def private_ip_for_node(self, node):
+        return 'private-{}'.format(node)
+
+
+class FakeNodeHandler(object):
+
+    def __init__(self, ip_address):
+        self.ip_address = ip_address
+
+    @classmethod
+    def connect(cls, config, ip_address):
+        return cls(ip_address)
+
+    def release(self):
+        pass
+
+
+class Install(object):
+    phase = timing.EXECUTE
+
+    def __init__(self, package, runs):
+        self.package = package
+        self.runs = runs
+
+    def run(self, node_handler):
+        start = time.time()
+        time.sleep(0.05)
+        self.runs.append((self.package, start, time.time()))
+        return []
+
+    def __str__(self):
+        return 'apt-get install -y {}'.format(self.package)
+
+
+def test_independent_tasks_run_one_at_a_time_in_role_order(monkeypatch):
+    monkeypatch.setattr(handler, 'NodeHandler', FakeNodeHandler)
+    runs = []
+    plan = TaskPlan(('git', 'curl'), {'git': (), 'curl': ()}, {
+        'git': [Install('git', runs)],
+        'curl': [Install('curl', runs)],
+    })
+
+    config = {'ssh': {}, 'herd': {'gather_facts': False}}
+    ClusterExecutor.execute(plan, config, FakeManager(), 'app1', Sink())
+
+    assert [package for package, _, _ in runs] == ['git', 'curl']
+    (_, _, git_done), (_, curl_started, _) = runs
+    assert git_done <= curl_started
+
+
+def test_relay_tree_only_relays_from_holders(monkeypatch):
+    holders = {'app1'}
+    lock = threading.Lock()
+    relays = []
+
+    def relay(node_handler, path, target_ip, username):
+        source = node_handler.ip_address[len('public-'):]
+        target = target_ip[len('private-'):]
+        with lock:
+            assert source in holders
+            relays.append((source, target))
+            holders.add(target)
+
+    monkeypatch.setattr(handler, 'NodeHandler', FakeNodeHandler)
+    monkeypatch.setattr(handler, 'relay', relay)
+    targets = ['app{}'.format(i) for i in range(2, 17)]
+    failures = {}
+
+    ClusterExecutor.relay_tree(
+        {'ssh': {}}, FakeManager(), 'app1', targets, '/srv/app', 4, Sink(), failures,
+    )
+
+    assert failures == {}
+    assert holders == set(['app1'] + targets)
+    assert len(relays) == len(targets)
+
+
+def test_relay_tree_reports_failed_targets(monkeypatch):
+    def relay(node_handler, path, target_ip, username):
+        if target_ip == 'private-app3':
+            raise IOError('unreachable')
+
+    monkeypatch.setattr(handler, 'NodeHandler', FakeNodeHandler)
+    monkeypatch.setattr(handler, 'relay', relay)
+    failures = {}
+
+    ClusterExecutor.relay_tree(
+        {'ssh': {}}, FakeManager(), 'app1', ['app2', 'app3', 'app4'], '/srv/app', 2,
+        Sink(), failures,
+    )
+
+    assert list(failures) == ['app3']
+
+
+def test_relay_tree_stops_using_holders_that_cannot_serve(monkeypatch):
+    lock = threading.Lock()
+    served = []
+
+    def relay(node_handler, path, target_ip, username):
+        source = node_handler.ip_address[len('public-'):]
+        with lock:
+            served.append(source)
+        if source == 'app2':
+            raise IOError('disk gone')
+
+    monkeypatch.setattr(handler, 'NodeHandler', FakeNodeHandler)
+    monkeypatch.setattr(handler, 'relay', relay)
+    failures = {}
+
+    ClusterExecutor.relay_tree(
+        {'ssh': {}}, FakeManager(), 'app1', ['app{}'.format(i) for i in range(2, 9)],
+        '/srv/app', 2, Sink(), failures,
+    )
+
+    assert failures == {}
+    assert served.count('app2') == 1
+
+
+def test_relay_tree_uploads_when_no_holder_is_left(monkeypatch):
+    def relay(node_handler, path, target_ip, username):
+        raise IOError('cannot serve')
+
+    monkeypatch.setattr(handler, 'NodeHandler', FakeNodeHandler)
+    monkeypatch.setattr(handler, 'relay', relay)
+    uploaded = []
+    failures = {}
+
+    ClusterExecutor.relay_tree(
+        {'ssh': {}}, FakeManager(), 'app1', ['app2', 'app3'], '/srv/app', 2, Sink(), failures,
+        upload=uploaded.append,
+    )
+
+    assert failures == {}
+    assert sorted(uploaded) == ['app2', 'app3']
+
+
+def test_relay_tree_blames_unreachable_targets(monkeypatch):
+    def relay(node_handler, path, target_ip, username):
+        if target_ip == 'private-app2':
+            raise handler.CommandFailedException('ssh app2', handler.SSH_ERROR_STATUS)
+
+    monkeypatch.setattr(handler, 'NodeHandler', FakeNodeHandler)
+    monkeypatch.setattr(handler, 'relay', relay)
+    failures = {}
+
+    ClusterExecutor.relay_tree(
+        {'ssh': {}}, FakeManager(), 'app1', ['app2', 'app3', 'app4'], '/srv/app', 1,
+        Sink(), failures,
+    )
+
+    assert list(failures) == ['app2']
+
+
+def test_copies_land_where_scp_would_put_them(monkeypatch):
+    def execute(node_handler, command):
+        if '/srv/app' in command:
+            yield OutputLine(STDOUT, 'dir')
+    monkeypatch.setattr(handler, 'execute', execute)
+
+    assert handler.copy_target(None, 'build/', '/srv/app') == '/srv/app/build'
+    assert handler.copy_target(None, 'build', '/srv/new') == '/srv/new'
+    assert handler.copy_target(None, 'motd', '/etc/') == '/etc/motd'
+
+
+def test_synced_copies_land_where_scp_would_put_them(tmpdir, monkeypatch):
+    def execute(node_handler, command):
+        if '/opt' in command:
+            yield OutputLine(STDOUT, 'dir')
+    synced = []
+
+    def sync(node_handler, manifest, compress):
+        synced.append((manifest.remote_dir, sorted(manifest.files)))
+        return []
+    monkeypatch.setattr(handler, 'execute', execute)
+    monkeypatch.setattr(handler, 'sync', sync)
+    node = FakeNodeHandler('10.0.0.2')
+    node.config = {'herd': {'cache_dir': str(tmpdir.join('cache'))}}
+    tmpdir.join('motd').write('hello')
+    tmpdir.mkdir('app').join('main.py').write('print(1)')
+
+    for src, dest in (('motd', '/etc/'), ('motd', '/etc/motd'), ('app', '/opt'), ('app', '/srv/app')):
+        parse_command('copy', {
+            'src': str(tmpdir.join(src)), 'dest': dest, 'recursive': True, 'sync': True,
+        }).run(node)
+
+    assert synced == [
+        ('/etc', ['motd']), ('/etc', ['motd']), ('/opt/app', ['main.py']), ('/srv/app', ['main.py']),
+    ]
+
+
+def test_relays_fail_when_the_source_cant_be_read(tmpdir):
+    # A stand-in ssh that takes the stream and succeeds, whatever it gets
+    bin_dir = tmpdir.mkdir('bin')
+    bin_dir.join('ssh').write('#!/bin/sh\ncat > /dev/null\n')
+    bin_dir.join('ssh').chmod(0o755)
+    tmpdir.mkdir('app').join('main.py').write('print(1)')
+    env = dict(os.environ, PATH='{}:{}'.format(bin_dir, os.environ['PATH']))
+
+    def run(path):
+        return subprocess.call(
+            ['sh', '-c', handler.relay_command(path, '10.0.0.2', 'root')],
+            env=env, stderr=subprocess.DEVNULL,
+        )
+
+    assert run(str(tmpdir.join('app'))) == 0
+    assert run(str(tmpdir.join('missing'))) != 0
@@ -0,0 +1,121 @@
+import json
+import os
+from collections import namedtuple
+
+from herd.inventory import InventoryCache
+from herd.inventory import InventoryIndex
+from herd.inventory import parse_node_name
+
+
+class Fetcher(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return ['node{}'.format(self.calls)]
+
+
+def cache_at(tmpdir, **ttls):
+    return InventoryCache(os.path.join(str(tmpdir), 'cache', 'inventory.json'), ttls)
+
+
+def test_fresh_entries_are_shared_across_processes(tmpdir):
+    fetch = Fetcher()
+
+    assert cache_at(tmpdir).get('sizes', fetch) == ['node1']
+    assert cache_at(tmpdir).get('sizes', fetch) == ['node1']
+    assert fetch.calls == 1
+
+
+def test_expired_entries_are_fetched_again(tmpdir):
+    fetch = Fetcher()
+    cache = cache_at(tmpdir, nodes=0)
+
+    cache.get('nodes', fetch)
+    assert cache.get('nodes', fetch) == ['node2']
+
+
+def test_invalidate_drops_entry_everywhere(tmpdir):
+    fetch = Fetcher()
+    cache = cache_at(tmpdir)
+    cache.get('nodes', fetch)
+
+    cache.invalidate('nodes')
+
+    assert cache_at(tmpdir).get('nodes', fetch) == ['node2']
+
+
+def test_refresh_ignores_older_entries(tmpdir):
+    fetch = Fetcher()
+    cache_at(tmpdir).get('regions', fetch)
+
+    cache = cache_at(tmpdir)
+    cache.refresh()
+
+    assert cache.get('regions', fetch) == ['node2']
+    assert cache.get('regions', fetch) == ['node2']
+
+
+def test_expired_catalogs_are_fetched_on_their_etag(tmpdir):
+    etags = []
+
+    def fetch(etag):
+        etags.append(etag)
+        return (None, etag) if etag else (['s-1vcpu-1gb'], '"v1"')
+
+    cache_at(tmpdir, sizes=0).get('sizes', fetch, conditional=True)
+    # Another process, once the listing expired
+    assert cache_at(tmpdir, sizes=0).get('sizes', fetch, conditional=True) == ['s-1vcpu-1gb']
+    assert etags == [None, '"v1"']
+
+
+Record = namedtuple('Record', ['name', 'tags'])
+
+
+def test_records_come_back_from_json(tmpdir):
+    path = os.path.join(str(tmpdir), 'inventory.json')
+    InventoryCache(path).put('nodes', [Record('app1', ('herd-app',))])
+
+    with open(path) as f:
+        assert json.load(f)['nodes'][1] == [['app1', ['herd-app']]]
+    node, = InventoryCache(path, records={'nodes': Record}).get('nodes', Fetcher())
+    assert node == Record('app1', ('herd-app',))
+
+    # Records whose fields changed since are fetched again
+    Renamed = namedtuple('Renamed', ['name', 'tags', 'size'])
+    assert InventoryCache(path, records={'nodes': Renamed}).get('nodes', Fetcher()) == ['node1']
+
+
+class Node(object):
+
+    def __init__(self, name, status='active'):
+        self.name = name
+        self.status = status
+
+
+def test_parse_node_name():
+    assert parse_node_name('app10') == ('app', 10)
+    assert parse_node_name('db-replica2') == ('db-replica', 2)
+    assert parse_node_name('bastion') == (None, None)
+    assert parse_node_name('42') == (None, None)
+
+
+def test_index_matches_clusters_exactly():
+    nodes = [Node('app10'), Node('app2'), Node('app1'), Node('appserver1')]
+    index = InventoryIndex(nodes)
+
+    assert [n.name for n in index.cluster_nodes('app')] == ['app1', 'app2', 'app10']
+    assert index.cluster_nodes('app1') == []
+    assert index.by_index['app'][10] is nodes[0]
+    assert index.node('appserver1') is nodes[3]
+
+
+def test_index_by_status():
+    nodes = [Node('app1'), Node('app2', 'new'), Node('db1', 'new')]
+    index = InventoryIndex(nodes)
+
+    assert index.cluster_nodes_with_status('app', 'new') == [nodes[1]]
+    assert index.by_status['new'] == [nodes[1], nodes[2]]
+    assert index.cluster_nodes_with_status('app', 'off') == []
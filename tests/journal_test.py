@@ -0,0 +1,85 @@
+import pytest
+
+from herd.command import parse_command
+from herd.graph import TaskPlan
+from herd.journal import JournalException
+from herd.journal import read_journal
+from herd.journal import run_role
+from herd.journal import RunJournal
+
+
+def make_plan():
+    return TaskPlan(('base', 'web'), {'base': (), 'web': ('base',)}, {
+        'base': [parse_command('install', 'git'), parse_command('install', 'curl')],
+        'web': [parse_command('exec', 'make'), parse_command('copy', {'src': 'a', 'dest': '/b'})],
+    })
+
+
+def run(journal, node, fail=None):
+    """Report every step of the node's plan the way the executors do"""
+    sink = journal.sink()
+    plan = journal.node_plan(node)
+    for task in plan.tasks:
+        for step in plan.commands[task]:
+            for command in getattr(step, 'commands', [step]):
+                if str(command) == fail:
+                    sink.status(node, command, 1)
+                    return
+                if command is not step:
+                    sink.status(node, command, 0)
+            sink.step_done(node, step)
+
+
+def remaining(journal, node):
+    plan = journal.remaining(node)
+    return [str(command) for task in plan.tasks for command in plan.commands[task]]
+
+
+def test_resume_runs_only_what_did_not_finish(tmpdir):
+    config = {'herd': {'cache_dir': str(tmpdir)}}
+    journal = RunJournal.start(config, make_plan(), 'web', 'digest')
+    run(journal, 'web1')
+    run(journal, 'web2', fail='make')
+    journal.close()
+
+    assert run_role(config, journal.run_id) == 'web'
+    _, outcomes = read_journal(config, journal.run_id)
+    # The merged install counts for both of its commands
+    assert [(o['task'], o['index'], o['command'], o['status']) for o in outcomes if o['node'] == 'web2'] == [
+        ('base', 0, 'apt-get install -y git', 0),
+        ('base', 1, 'apt-get install -y curl', 0),
+        ('web', 0, 'make', 1),
+    ]
+
+    # Resumed against a freshly built plan, as a later herd run would
+    resumed = RunJournal.resume(config, journal.run_id, make_plan(), 'web', 'digest')
+    assert remaining(resumed, 'web1') == []
+    assert remaining(resumed, 'web2') == ['make', 'copy a to /b']
+    assert remaining(resumed, 'web3') == [
+        'apt-get install -y git', 'apt-get install -y curl', 'make', 'copy a to /b',
+    ]
+
+    # Finishing web2 is journaled too, so resuming again has nothing left
+    run(resumed, 'web2')
+    resumed.close()
+    again = RunJournal.resume(config, journal.run_id, make_plan(), 'web')
+    assert remaining(again, 'web2') == []
+    again.close()
+
+    with pytest.raises(JournalException):
+        RunJournal.resume(config, journal.run_id, make_plan(), 'db')
+    with pytest.raises(JournalException):
+        run_role(config, 'no-such-run')
+
+
+def test_changed_commands_run_again(tmpdir):
+    config = {'herd': {'cache_dir': str(tmpdir)}}
+    journal = RunJournal.start(config, make_plan(), 'web')
+    run(journal, 'web1')
+    journal.close()
+
+    plan = make_plan()
+    plan.commands['web'][0] = parse_command('exec', 'make install')
+    resumed = RunJournal.resume(config, journal.run_id, plan, 'web')
+    assert remaining(resumed, 'web1') == ['make install']
+    resumed.close()
@@ -0,0 +1,142 @@
+import io
+import json
+import os
+import threading
+
+from herd.output import AggregateSink
+from herd.output import ConsoleSink
+from herd.output import fold_nodes
+from herd.output import JsonSink
+from herd.output import LineBuffer
+from herd.output import LogFileSink
+from herd.output import OutputLine
+from herd.output import read_available
+from herd.output import line_buffers
+from herd.output import STDERR
+from herd.output import STDOUT
+
+
+class FakeChannel(object):
+
+    def __init__(self, stdout, stderr):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+
+def test_line_buffer_keeps_partial_lines():
+    buf = LineBuffer()
+
+    assert buf.feed(b'one\ntw') == ['one']
+    assert buf.feed(b'o\n') == ['two']
+    assert buf.feed(b'three') == []
+    assert buf.flush() == ['three']
+    assert buf.flush() == []
+
+
+def test_line_buffer_is_bounded():
+    buf = LineBuffer(max_line=4)
+
+    assert buf.feed(b'abcdefghij') == ['abcd', 'efgh']
+    assert buf.flush() == ['ij']
+
+
+def test_read_available_reads_both_streams():
+    channel = FakeChannel([b'one\ntw', b'o\nthr'], [b'err\n'])
+    buffers = line_buffers()
+
+    assert read_available(channel, buffers) == [
+        OutputLine(STDOUT, 'one'), OutputLine(STDOUT, 'two'), OutputLine(STDERR, 'err'),
+    ]
+    assert buffers[STDOUT].flush() == ['thr']
+
+
+def test_console_sink():
+    stream = io.StringIO()
+    sink = ConsoleSink(stream)
+    sink.line('app1', OutputLine(STDOUT, 'hello'))
+    sink.status('app1', 'apt-get update -y', 1)
+
+    assert stream.getvalue() == 'app1: hello\napp1: [exit 1] apt-get update -y\n'
+
+
+def test_json_sink():
+    stream = io.StringIO()
+    JsonSink(stream).line('app1', OutputLine(STDERR, 'oops'))
+    event = json.loads(stream.getvalue())
+
+    assert event['node'] == 'app1'
+    assert event['stream'] == 'stderr'
+    assert event['text'] == 'oops'
+
+
+def test_log_file_sink_writes_per_node(tmpdir):
+    sink = LogFileSink(str(tmpdir))
+    sink.line('app1', OutputLine(STDOUT, 'hello'))
+    sink.line('app2', OutputLine(STDOUT, 'bye'))
+    sink.close()
+
+    assert sorted(os.listdir(str(tmpdir))) == ['app1.log', 'app2.log']
+    assert 'stdout hello' in tmpdir.join('app1.log').read()
+
+
+def test_fold_nodes():
+    assert fold_nodes(['web3', 'web1', 'db1', 'web2', 'web5', 'localhost']) == 'db1,web[1-3,5],localhost'
+    assert fold_nodes(['web10', 'web9']) == 'web[9-10]'
+
+
+def test_aggregate_sink_prints_each_distinct_output_once(tmpdir):
+    path = str(tmpdir.join('output'))
+    sink = AggregateSink(open(path, 'w'), spill_bytes=64)
+    for node in ('web1', 'web2', 'web3', 'web4'):
+        sink.info(node, 'Executing uptime on {}'.format(node))
+        for idx in range(10):
+            sink.line(node, OutputLine(STDOUT, 'line {}'.format(idx)))
+        sink.status(node, 'uptime', 0)
+    sink.line('web4', OutputLine(STDERR, 'oops'))
+    sink.finish('web4', IOError('boom'))
+
+    # Past spill_bytes, output waits in a temporary file
+    assert all(output.file._rolled for output in sink._outputs.values())
+    sink.close()
+
+    lines = ['line {}'.format(idx) for idx in range(10)] + ['[exit 0] uptime']
+    with open(path) as f:
+        output = f.read()
+    assert output.split('\n') == (
+        ['-' * 12, 'web[1-3] (3)', '-' * 12] + lines +
+        ['-' * 8, 'web4 (1)', '-' * 8] + lines + ['oops', 'FAILED: boom', '']
+    )
+
+
+def test_aggregate_sink_keeps_lines_whole_across_tasks(tmpdir):
+    path = str(tmpdir.join('output'))
+    sink = AggregateSink(open(path, 'w'), spill_bytes=256)
+    text = 'x' * 200
+
+    def task(name):
+        for idx in range(200):
+            sink.line('web1', OutputLine(STDOUT, '{} {} {}'.format(name, idx, text)))
+
+    tasks = [threading.Thread(target=task, args=(name,)) for name in ('git', 'curl', 'nginx')]
+    for thread in tasks:
+        thread.start()
+    for thread in tasks:
+        thread.join()
+    sink.close()
+
+    with open(path) as f:
+        lines = f.read().splitlines()[3:]
+    assert len(lines) == 600
+    assert all(line.endswith(' ' + text) for line in lines)
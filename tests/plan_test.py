@@ -0,0 +1,243 @@
+import os
+import threading
+
+import pytest
+import pytoml
+
+import herd.plan
+from herd.config import ConfigException
+from herd.graph import run_plan
+from herd.plan import compile_config
+from herd.plan import load_plan
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = '''
+[ssh]
+path = "~/.ssh/id_rsa"
+
+[clusters.web]
+provider = "digitalocean"
+server_count = 2
+
+[tasks.base]
+update = true
+
+[tasks.web]
+dependencies = "base"
+install = ["nginx", "git"]
+start = "nginx"
+
+[roles.app]
+clusters = ["web"]
+tasks = ["web"]
+sudo = true
+'''
+
+
+def test_compiles_tasks_into_plans(tmpdir):
+    plan = load_plan(os.path.join(ROOT, 'config.example.toml'), str(tmpdir))
+    assert plan.cluster('app').server_count == 2
+
+    plan = compile_config(pytoml.loads(CONFIG))
+    role = plan.role('app')
+    task_plan = plan.task_plan(role.tasks, role.sudo)
+
+    assert task_plan.tasks == ('base', 'web')
+    assert task_plan.dependencies['web'] == ('base',)
+    assert [c.command for c in task_plan.commands['web']] == [
+        'sudo apt-get install -y nginx git', 'sudo service nginx start',
+    ]
+    # Every plan gets its own Commands
+    assert plan.task_plan(['web']).commands['web'][0] is not task_plan.commands['web'][0]
+
+
+def test_tasks_keep_the_order_the_role_lists_them_in():
+    plan = compile_config(pytoml.loads(CONFIG + '''
+[tasks.git]
+install = "git"
+
+[tasks.curl]
+install = "curl"
+'''))
+    assert plan.task_plan(['git', 'curl']).tasks == ('git', 'curl')
+    assert plan.task_plan(['web', 'curl', 'git']).tasks == ('base', 'web', 'curl', 'git')
+
+
+def test_every_problem_is_reported():
+    with pytest.raises(ConfigException) as e:
+        compile_config({
+            'ssh': {},
+            'clusters': {
+                'web1': {'provider': 'digitalocean', 'server_count': -1, 'min_disk_space': 10},
+                'db': {'provider': 'nope'},
+            },
+            'tasks': {
+                'web': {'dependencies': ['base'], 'instal': 'nginx'},
+                'release': {'copy': {'src': 'build/'}, 'start': ['a', 'b']},
+            },
+            'roles': {'app': {'clusters': ['db', 'cache'], 'tasks': 'web', 'sudo': 'yes'}},
+        })
+
+    assert str(e.value).splitlines()[1:] == [
+        '  [ssh] needs the path of a private key',
+        '  cluster db has unknown provider nope, must be one of digitalocean, fake',
+        '  cluster web1 must not end in a digit',
+        '  cluster web1 server_count must be a whole number, got -1',
+        '  cluster web1 has unknown option min_disk_space',
+        "  task release command copy needs dest as a string, got None",
+        "  task release command start needs a service as a string, got ['a', 'b']",
+        '  task web has unknown command instal, must be one of '
+        'copy, exec, install, start, stop, uninstall, update, upgrade',
+        '  Task web depends on unknown task base',
+        '  role app uses unknown cluster cache',
+        '  role app sudo must be true or false',
+    ]
+
+
+def test_plans_are_cached_by_config_hash(tmpdir, monkeypatch):
+    path = tmpdir.join('config.toml')
+    path.write(CONFIG)
+    cache_dir = str(tmpdir.join('cache'))
+    first = load_plan(str(path), cache_dir)
+
+    def fail(source):
+        raise AssertionError('parsed a cached config')
+    monkeypatch.setattr(herd.plan.pytoml, 'loads', fail)
+    cached = load_plan(str(path), cache_dir)
+    assert cached.digest == first.digest
+    assert [c.value for c in cached.tasks['web'].commands] == [['nginx', 'git'], 'nginx']
+
+    # A changed file is compiled again, and a bad one is never cached
+    monkeypatch.undo()
+    path.write(CONFIG.replace('start = "nginx"', 'strat = "nginx"'))
+    with pytest.raises(ConfigException):
+        load_plan(str(path), cache_dir)
+    with pytest.raises(ConfigException):
+        load_plan(str(path), cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_secrets_stay_out_of_the_plan_cache(tmpdir, monkeypatch):
+    path = tmpdir.join('config.toml')
+    path.write(CONFIG.replace('path = "~/.ssh/id_rsa"', 'path = "~/.ssh/id_rsa"\npassword = "hunter2"') + '''
+[providers.digitalocean]
+token = 'do-secret'  # read only
+''')
+    cache_dir = tmpdir.join('cache')
+    load_plan(str(path), str(cache_dir))
+
+    cached, = cache_dir.listdir()
+    assert b'hunter2' not in cached.read_binary()
+    assert b'do-secret' not in cached.read_binary()
+
+    def fail(source):
+        raise AssertionError('parsed a cached config')
+    monkeypatch.setattr(herd.plan.pytoml, 'loads', fail)
+    plan = load_plan(str(path), str(cache_dir))
+    assert plan.config['ssh'] == {'path': '~/.ssh/id_rsa', 'password': 'hunter2'}
+    assert plan.config['providers']['digitalocean']['token'] == 'do-secret'
+    assert plan.role('app').tasks == ('web',)
+
+
+def test_secrets_that_cant_be_found_by_line_are_never_cached(tmpdir):
+    path = tmpdir.join('config.toml')
+    path.write(CONFIG + '''
+[providers]
+digitalocean = {token = "do-secret"}
+''')
+    cache_dir = tmpdir.join('cache')
+    for _ in range(2):
+        plan = load_plan(str(path), str(cache_dir))
+        assert plan.config['providers']['digitalocean']['token'] == 'do-secret'
+    assert not cache_dir.check()
+
+
+def command_lines(task_plan):
+    return [c.command for task in task_plan.tasks for c in task_plan.commands[task]]
+
+
+def test_task_commands():
+    plan = compile_config({'tasks': {
+        'git': {'install': 'git'},
+        'tools': {'install': ['git', 'nginx']},
+    }})
+
+    assert command_lines(plan.task_plan(['git'])) == ['apt-get install -y git']
+    assert command_lines(plan.task_plan(['tools'])) == ['apt-get install -y git nginx']
+
+
+def test_dependencies_come_first():
+    plan = compile_config({'tasks': {
+        'git': {'dependencies': ['nginx', 'nginx_start'], 'install': ['git']},
+        'nginx': {'install': ['nginx']},
+        'nginx_start': {'start': 'nginx'},
+    }})
+
+    assert command_lines(plan.task_plan(['git'])) == [
+        'apt-get install -y nginx', 'service nginx start', 'apt-get install -y git',
+    ]
+
+
+def diamond_config():
+    return {
+        'tasks': {
+            'base': {'update': True},
+            'left': {'dependencies': 'base', 'install': 'git'},
+            'right': {'dependencies': 'base', 'install': 'nginx'},
+            'top': {'dependencies': ['left', 'right'], 'start': 'nginx'},
+        },
+    }
+
+
+def test_diamond_dependency_runs_once():
+    config = diamond_config()
+    task_plan = compile_config(config).task_plan(['top'])
+
+    assert task_plan.tasks == ('base', 'left', 'right', 'top')
+    assert task_plan.dependencies['left'] == ('base',)
+    assert command_lines(task_plan).count('apt-get update -y') == 1
+    assert config['tasks']['top']['dependencies'] == ['left', 'right']
+
+
+@pytest.mark.parametrize('tasks,problem', [
+    ({'a': {'dependencies': 'b'}, 'b': {'dependencies': 'c'}, 'c': {'dependencies': 'a'}},
+     'Dependency cycle: a -> b -> c -> a'),
+    ({'a': {'dependencies': 'missing'}}, 'Task a depends on unknown task missing'),
+])
+def test_broken_dependencies_are_rejected(tasks, problem):
+    with pytest.raises(ConfigException) as e:
+        compile_config({'tasks': tasks})
+    assert problem in str(e.value)
+
+
+def test_run_plan_runs_independent_branches_together():
+    task_plan = compile_config(diamond_config()).task_plan(['top'])
+    both_branches = threading.Barrier(2, timeout=5)
+    ran = []
+
+    def run_task(task):
+        if task in ('left', 'right'):
+            # Deadlocks (and times out) unless both branches run at once
+            both_branches.wait()
+        ran.append(task)
+
+    run_plan(task_plan, run_task, max_parallel=4)
+
+    assert ran[0] == 'base'
+    assert ran[-1] == 'top'
+
+
+def test_run_plan_skips_dependents_of_failed_task():
+    task_plan = compile_config(diamond_config()).task_plan(['top'])
+    ran = []
+
+    def run_task(task):
+        ran.append(task)
+        if task == 'left':
+            raise RuntimeError('left failed')
+
+    with pytest.raises(RuntimeError):
+        run_plan(task_plan, run_task, max_parallel=4)
+
+    assert 'top' not in ran
@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+
+from herd.pool import ConnectionPool
+from herd.pool import PoolExhaustedException
+from herd.pool import PoolKey
+
+
+class FakeClient(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.healthy = True
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(**kwargs):
+    connected = []
+
+    def connect(key):
+        client = FakeClient(key)
+        connected.append(client)
+        return client
+
+    kwargs.setdefault('health_check', lambda client: client.healthy)
+    return ConnectionPool(connect, **kwargs), connected
+
+
+KEY_A = PoolKey('10.0.0.1', 'root', '/key')
+KEY_B = PoolKey('10.0.0.2', 'root', '/key')
+
+
+def test_reuses_released_connection():
+    pool, connected = make_pool()
+    client = pool.acquire(KEY_A)
+    pool.release(KEY_A, client)
+
+    assert pool.acquire(KEY_A) is client
+    assert len(connected) == 1
+
+
+def test_different_keys_get_different_connections():
+    pool, connected = make_pool()
+    pool.release(KEY_A, pool.acquire(KEY_A))
+
+    assert pool.acquire(KEY_B).key == KEY_B
+    assert len(connected) == 2
+
+
+def test_closed_pool_closes_what_is_released_to_it():
+    pool, connected = make_pool()
+    idle = pool.acquire(KEY_A)
+    busy = pool.acquire(KEY_B)
+    pool.release(KEY_A, idle)
+    pool.close_all()
+    assert idle.closed and not busy.closed
+
+    pool.release(KEY_B, busy)
+    assert busy.closed
+    assert pool.open_connections == 0
+
+
+def test_unhealthy_connection_is_replaced():
+    pool, connected = make_pool()
+    client = pool.acquire(KEY_A)
+    pool.release(KEY_A, client)
+    client.healthy = False
+
+    assert pool.acquire(KEY_A) is not client
+    assert client.closed
+    assert pool.open_connections == 1
+
+
+def test_idle_connections_expire():
+    pool, connected = make_pool(idle_timeout=0)
+    client = pool.acquire(KEY_A)
+    pool.release(KEY_A, client)
+
+    assert pool.acquire(KEY_A) is not client
+    assert client.closed
+
+
+def test_cap_evicts_idle_connection_for_other_host():
+    pool, connected = make_pool(max_connections=1)
+    client = pool.acquire(KEY_A)
+    pool.release(KEY_A, client)
+
+    pool.acquire(KEY_B)
+    assert client.closed
+    assert pool.open_connections == 1
+
+
+def test_cap_blocks_until_release():
+    pool, connected = make_pool(max_connections=1, acquire_timeout=5)
+    client = pool.acquire(KEY_A)
+    acquired = []
+
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire(KEY_A)))
+    thread.start()
+    pool.release(KEY_A, client)
+    thread.join()
+
+    assert acquired == [client]
+
+
+def test_cap_times_out():
+    pool, connected = make_pool(max_connections=1, acquire_timeout=0)
+    pool.acquire(KEY_A)
+
+    with pytest.raises(PoolExhaustedException):
+        pool.acquire(KEY_B)
+
+
+def test_failed_connect_frees_slot():
+    def connect(key):
+        raise IOError('nope')
+
+    pool = ConnectionPool(connect, max_connections=1)
+    with pytest.raises(IOError):
+        pool.acquire(KEY_A)
+
+    assert pool.open_connections == 0
@@ -0,0 +1,94 @@
+from herd.provision import ProvisionCall
+from herd.provision import ProvisionPool
+from herd.provision import TokenBucket
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Throttled(Exception):
+    pass
+
+
+def test_token_bucket_allows_burst_then_paces():
+    clock = Clock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock, sleep=clock.sleep)
+
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.now == 0
+
+    bucket.acquire()
+    assert clock.now == 0.5
+
+    bucket.acquire()
+    assert clock.now == 1.0
+
+
+def make_pool(**kwargs):
+    kwargs.setdefault('rate', 1000)
+    kwargs.setdefault('burst', 1000)
+    return ProvisionPool(
+        lambda e: isinstance(e, Throttled), sleep=lambda seconds: None, **kwargs
+    )
+
+
+def test_failures_do_not_stop_other_calls():
+    def fail():
+        raise ValueError('boom')
+
+    results = make_pool().run([
+        ProvisionCall('create', 'app1', lambda: 'droplet1'),
+        ProvisionCall('create', 'app2', fail),
+        ProvisionCall('create', 'app3', lambda: 'droplet3'),
+    ])
+
+    assert [r.node for r in results] == ['app1', 'app2', 'app3']
+    assert [r.ok for r in results] == [True, False, True]
+    assert results[0].result == 'droplet1'
+    assert isinstance(results[1].error, ValueError)
+
+
+def test_throttled_calls_are_retried():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Throttled()
+        return 'ok'
+
+    result, = make_pool().run([ProvisionCall('rename', 'app1', flaky)])
+
+    assert result.ok
+    assert len(attempts) == 3
+
+
+def test_retries_give_up():
+    def throttled():
+        raise Throttled()
+
+    result, = make_pool(retries=2).run([ProvisionCall('destroy', 'app1', throttled)])
+
+    assert isinstance(result.error, Throttled)
+
+
+def test_other_errors_are_not_retried():
+    attempts = []
+
+    def broken():
+        attempts.append(1)
+        raise ValueError()
+
+    make_pool().run([ProvisionCall('destroy', 'app1', broken)])
+
+    assert len(attempts) == 1
@@ -0,0 +1,116 @@
+import socket
+import threading
+
+from herd.inventory import InventoryIndex
+from herd.readiness import Backoff
+from herd.readiness import NodeUnavailableException
+from herd.readiness import probe_ssh
+from herd.readiness import ReadinessTracker
+
+
+class Node(object):
+
+    def __init__(self, name, status='active', ip_address=None):
+        self.name = name
+        self.status = status
+        self.ip_address = ip_address or '10.0.0.{}'.format(name[-1])
+
+
+class Manager(object):
+    """Nodes come up one poll after another, in the order given"""
+
+    def __init__(self, nodes, boot_order):
+        self.nodes = nodes
+        self.boot_order = list(boot_order)
+        self.refreshes = 0
+        self.index = InventoryIndex(nodes)
+
+    def refresh_nodes_list(self):
+        self.refreshes += 1
+        if self.boot_order:
+            name = self.boot_order.pop(0)
+            self.nodes = [
+                Node(n.name, 'active') if n.name == name else n for n in self.nodes
+            ]
+            self.index = InventoryIndex(self.nodes)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def tracker_for(manager, probe=lambda ip, port: True, timeout=600):
+    clock = Clock()
+    tracker = ReadinessTracker(
+        manager, timeout=timeout, probe=probe, clock=clock, sleep=clock.sleep,
+    )
+    return tracker, clock
+
+
+def test_nodes_are_yielded_as_they_come_up():
+    manager = Manager(
+        [Node('app1', 'new'), Node('app2'), Node('app3', 'new')], ['app3', 'app1'],
+    )
+    tracker, clock = tracker_for(manager)
+
+    ready = list(tracker.ready_nodes(['app1', 'app2', 'app3']))
+
+    assert ready == [('app2', None), ('app3', None), ('app1', None)]
+    assert manager.refreshes == 2
+    # Every poll made progress, so the wait never grew
+    assert clock.sleeps == [1.0, 1.0]
+
+
+def test_unavailable_and_unreachable_nodes_are_reported():
+    manager = Manager([Node('app1', 'off'), Node('app2')], [])
+    tracker, clock = tracker_for(manager, probe=lambda ip, port: False, timeout=5)
+
+    ready = dict(tracker.ready_nodes(['app1', 'app2', 'app3']))
+
+    assert isinstance(ready['app1'], NodeUnavailableException)
+    assert isinstance(ready['app3'], NodeUnavailableException)
+    assert 'not reachable' in str(ready['app2'])
+    # Active nodes are only probed, the provider isn't asked again
+    assert manager.refreshes == 0
+    assert clock.sleeps == [1.0, 1.5, 2.25, 3.375]
+
+
+def test_backoff_grows_and_resets():
+    backoff = Backoff(initial=1, maximum=3, factor=2)
+
+    assert [backoff.next(False) for _ in range(3)] == [2, 3, 3]
+    assert backoff.next(True) == 1
+
+
+def test_probe_ssh_reads_banner():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(2)
+    port = server.getsockname()[1]
+
+    def serve():
+        for banner in (b'SSH-2.0-OpenSSH_9.6\r\n', b'HTTP/1.1 400\r\n'):
+            conn, _ = server.accept()
+            conn.sendall(banner)
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        assert probe_ssh('127.0.0.1', port)
+        assert not probe_ssh('127.0.0.1', port)
+    finally:
+        thread.join()
+        server.close()
+
+    assert not probe_ssh('127.0.0.1', port, timeout=0.5)
@@ -0,0 +1,79 @@
+import threading
+
+from herd.scheduler import SessionScheduler
+
+
+def test_global_limit_and_fair_share():
+    scheduler = SessionScheduler(max_sessions=2, host_sessions=None)
+    granted = []
+
+    held = [
+        scheduler.request('big', 'big{}'.format(idx), granted.append)
+        for idx in range(4)
+    ]
+    small = scheduler.request('small', 'small1', granted.append)
+
+    assert [r.host for r in granted] == ['big0', 'big1']
+
+    # The small cluster holds nothing, so it goes before the big one's backlog
+    scheduler.release(held[0])
+    assert granted[-1] is small
+
+    scheduler.release(held[1])
+    assert granted[-1] is held[2]
+    assert scheduler.active == 2
+
+
+def test_cluster_and_host_limits():
+    scheduler = SessionScheduler(max_sessions=10, cluster_sessions=2, host_sessions=1)
+
+    first = scheduler.request('app', 'app1')
+    same_host = scheduler.request('app', 'app1')
+    second = scheduler.request('app', 'app2')
+    third = scheduler.request('app', 'app3')
+    other = scheduler.request('db', 'db1')
+
+    assert [r.granted for r in (first, same_host, second, third, other)] == [
+        True, False, True, False, True,
+    ]
+
+    scheduler.release(first)
+    assert same_host.granted
+    assert not third.granted
+
+
+def test_releasing_a_waiting_request_gives_up_its_place():
+    scheduler = SessionScheduler(max_sessions=1)
+    held = scheduler.request('app', 'app1')
+    waiting = scheduler.request('app', 'app2')
+    after = scheduler.request('app', 'app3')
+
+    scheduler.release(waiting)
+    scheduler.release(held)
+
+    assert after.granted
+    assert not waiting.granted
+
+
+def test_sessions_block_until_granted():
+    scheduler = SessionScheduler(max_sessions=2)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def work(idx):
+        with scheduler.session('app', 'app{}'.format(idx)):
+            with lock:
+                running.append(idx)
+                peak.append(len(running))
+            with lock:
+                running.remove(idx)
+
+    threads = [threading.Thread(target=work, args=(idx,)) for idx in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) <= 2
+    assert scheduler.active == 0
@@ -0,0 +1,167 @@
+import subprocess
+
+import pytest
+
+import herd.script
+from herd.command import parse_command
+from herd.facts import NodeFacts
+from herd.graph import TaskPlan
+from herd.handler import CommandFailedException
+from herd.output import OutputLine
+from herd.output import STDOUT
+from herd.script import CommandStatus
+from herd.script import compile_commands
+from herd.script import compile_plan
+from herd.script import merge_package_commands
+from herd.script import Script
+from herd.script import skip_satisfied
+
+
+def commands(*pairs, **kwargs):
+    return [parse_command(key, value, **kwargs) for key, value in pairs]
+
+
+def test_adjacent_installs_merge():
+    merged = merge_package_commands(commands(
+        ('install', 'git'), ('install', ['nginx', 'git']), ('uninstall', 'apache2'),
+    ))
+
+    assert [c.command for c in merged] == [
+        'apt-get install -y git nginx apache2-',
+    ]
+
+
+def test_only_removals_use_remove():
+    merged = merge_package_commands(commands(
+        ('uninstall', 'git'), ('uninstall', 'nginx'),
+    ))
+
+    assert [c.command for c in merged] == ['apt-get remove -y git nginx']
+
+
+def test_single_install_is_left_alone():
+    install = commands(('install', 'git'))
+
+    assert merge_package_commands(install) == install
+
+
+def test_conflicting_package_commands_do_not_merge():
+    merged = merge_package_commands(commands(
+        ('install', 'git'), ('uninstall', 'git'),
+    ))
+
+    assert [c.command for c in merged] == [
+        'apt-get install -y git', 'apt-get remove -y git',
+    ]
+
+
+def test_non_adjacent_installs_do_not_merge():
+    merged = merge_package_commands(commands(
+        ('install', 'git'), ('start', 'nginx'), ('install', 'curl'),
+    ))
+
+    assert len(merged) == 3
+
+
+def test_sudo_is_kept():
+    merged = merge_package_commands(commands(
+        ('install', 'git'), ('install', 'curl'), sudo=True,
+    ))
+
+    assert [c.command for c in merged] == ['sudo apt-get install -y git curl']
+
+
+def test_copy_splits_scripts():
+    steps = compile_commands(commands(
+        ('start', 'nginx'),
+        ('copy', {'src': 'a', 'dest': 'b'}),
+        ('stop', 'nginx'),
+        ('start', 'nginx'),
+    ))
+
+    assert [type(step).__name__ for step in steps] == ['Script', 'Copy', 'Script']
+    assert len(steps[2].commands) == 2
+
+
+def run_locally(script):
+    process = subprocess.Popen(['sh', '-c', script.command], stdout=subprocess.PIPE)
+    output, _ = process.communicate()
+    results = []
+    for line in output.decode('utf-8').splitlines():
+        for out in script.parse_line(OutputLine(STDOUT, line)):
+            if out is not None:
+                results.append(out)
+    return results, process.returncode
+
+
+class Shell(object):
+
+    def __init__(self, command):
+        self.command = command
+
+
+def test_script_reports_status_per_command():
+    script = Script([Shell('echo one'), Shell('printf two'), Shell('true')])
+
+    assert run_locally(script) == ([
+        OutputLine(STDOUT, 'one'),
+        CommandStatus(script.commands[0], 0),
+        OutputLine(STDOUT, 'two'),
+        CommandStatus(script.commands[1], 0),
+        CommandStatus(script.commands[2], 0),
+    ], 0)
+
+
+def test_script_stops_at_first_failure():
+    script = Script([Shell('echo one'), Shell('false'), Shell('echo never')])
+
+    assert run_locally(script) == ([
+        OutputLine(STDOUT, 'one'),
+        CommandStatus(script.commands[0], 0),
+        CommandStatus(script.commands[1], 1),
+    ], 1)
+
+
+def test_script_fails_when_a_command_never_reports(monkeypatch):
+    def execute(node_handler, command):
+        process = subprocess.Popen(['sh', '-c', command], stdout=subprocess.PIPE)
+        output, _ = process.communicate()
+        for line in output.decode('utf-8').splitlines():
+            yield OutputLine(STDOUT, line)
+        if process.returncode != 0:
+            raise CommandFailedException(command, process.returncode)
+    monkeypatch.setattr(herd.script.handler, 'execute', execute)
+    script = Script([Shell('echo one'), Shell('exit 0'), Shell('echo never')])
+
+    with pytest.raises(CommandFailedException) as e:
+        list(script.run(None))
+    assert e.value.command is script.commands[1]
+    with pytest.raises(CommandFailedException):
+        script.check([CommandStatus(script.commands[0], 0)], 0)
+    script.check([CommandStatus(command, 0) for command in script.commands], 0)
+
+
+def test_skip_satisfied_drops_done_commands():
+    facts = NodeFacts({}, {'git': '1:2.34', 'nginx': '1.18'}, {'nginx': 'running'}, 60)
+    plan = compile_plan(TaskPlan.from_commands(commands(
+        ('update', None), ('install', 'git'), ('install', 'curl'), ('start', 'nginx'),
+    )))
+
+    plan, skipped = skip_satisfied(plan, facts)
+
+    assert [str(c) for c in skipped] == [
+        'apt-get update -y', 'apt-get install -y git', 'service nginx start',
+    ]
+    script, = plan.commands['commands']
+    assert [c.command for c in script.commands] == ['apt-get install -y curl']
+
+
+def test_skip_satisfied_keeps_commands_after_related_changes():
+    facts = NodeFacts({}, {'git': '1:2.34'}, {}, None)
+    plan = compile_plan(TaskPlan.from_commands(commands(
+        ('uninstall', 'git'), ('install', 'git'),
+    )))
+
+    plan, skipped = skip_satisfied(plan, facts)
+
+    assert skipped == []
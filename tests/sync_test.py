@@ -0,0 +1,56 @@
+from herd.provision import ProvisionPool
+from herd.sync import apply_actions
+from herd.sync import diff_cluster
+from herd.sync import SyncAction
+
+
+class Node(object):
+
+    def __init__(self, name, fits=True, status='active'):
+        self.name = name
+        self.fits = fits
+        self.status = status
+
+
+class Size(object):
+    slug = 'small'
+
+
+def diff(nodes, count, resizable=False):
+    return diff_cluster(
+        'web', nodes, count, Size(), lambda node: node.fits, lambda node, size: resizable,
+    )
+
+
+def test_renames_and_creates_wait_for_the_names_they_take():
+    actions = diff([Node('web1', fits=False), Node('web4'), Node('web2', status='new')], 3)
+
+    assert actions == [
+        SyncAction('destroy', 'web1', None, ()),
+        SyncAction('rename', 'web4', 'web1', (0,)),
+        SyncAction('create', 'web3', 'small', ()),
+    ]
+    assert diff([Node('web1'), Node('web2')], 2) == []
+    assert diff([Node('web1', fits=False)], 1, resizable=True) == [
+        SyncAction('resize', 'web1', 'small', ()),
+    ]
+
+
+def test_actions_after_a_failure_are_skipped():
+    actions = diff([Node('web1', fits=False), Node('web2', fits=False), Node('web3')], 2)
+    ran = []
+
+    def call_for(action):
+        def call():
+            ran.append(str(action))
+            if action.node == 'web1':
+                raise ValueError('API error')
+        return call
+
+    results = apply_actions(actions, call_for, ProvisionPool(lambda e: False, sleep=lambda s: None))
+
+    assert [str(a) for a in actions] == [
+        'destroy web1', 'destroy web2', 'rename web3 to web1', 'create web2 (small)',
+    ]
+    assert [r.ok for r in results] == [False, True, False, True]
+    assert 'rename web3 to web1' not in ran
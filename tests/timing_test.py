@@ -0,0 +1,46 @@
+from herd import timing
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_spans_are_free_when_disabled():
+    timing.disable()
+    with timing.span(timing.EXECUTE, 'true', 'app1'):
+        pass
+    assert timing.active() is None
+
+
+def test_trace_and_summary():
+    clock = Clock()
+    profiler = timing.enable(clock)
+    try:
+        with timing.span(timing.CONNECT, 'connect', 'app1'):
+            clock.now += 0.5
+        with timing.span(timing.EXECUTE, 'apt-get update -y', 'app1'):
+            clock.now += 2
+        with timing.span(timing.EXECUTE, 'apt-get update -y', 'app2'):
+            clock.now += 1
+        with timing.span(timing.API, 'list nodes'):
+            clock.now += 0.25
+    finally:
+        timing.disable()
+
+    assert profiler.phase_totals() == {'connect': (0.5, 1), 'execute': (3, 2), 'api': (0.25, 1)}
+    assert profiler.node_times() == {'app1': 2.5, 'app2': 1}
+
+    events = profiler.trace_events()
+    names = [e['args']['name'] for e in events if e['ph'] == 'M']
+    assert names[:2] == ['app1', 'app2']
+    update = [e for e in events if e['ph'] == 'X'][1]
+    assert (update['ts'], update['dur'], update['cat']) == (500000, 2000000, 'execute')
+
+    summary = profiler.summary(top=1)
+    assert 'execute        3.000s in 2 spans' in summary
+    assert 'app1                     2.500s' in summary